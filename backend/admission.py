@@ -0,0 +1,162 @@
+"""
+Admission control for team runs.
+
+A run can start a Playwright browser, a Docker executor, MCP connections and
+model clients, so concurrent runs are capped per worker (RUN_LIMIT_PER_WORKER),
+per user (RUN_LIMIT_PER_USER) and per agent (RUN_LIMIT_PER_AGENT, e.g.
+"WebSurfer=2,Coder=4"). A limit of 0 means unlimited.
+
+Runs over a limit wait in a queue of at most RUN_QUEUE_LIMIT entries. The
+queue is fair between users: it is ordered by how many runs each user already
+has waiting ahead, then by arrival, so one user's burst does not hold back
+everybody else. A waiting run that does not fit (e.g. its WebSurfer limit is
+reached) does not block the runs behind it that do.
+"""
+import asyncio
+import itertools
+import os
+from typing import AsyncIterator, Dict, List, Optional
+
+
+def parse_agent_limits(value: str) -> Dict[str, int]:
+    limits = {}
+    for item in (value or "").split(","):
+        name, _, limit = item.partition("=")
+        if name.strip() and limit.strip():
+            limits[name.strip()] = int(limit)
+    return limits
+
+
+def agent_resources(agents: List[dict]) -> List[str]:
+    """Names the per-agent limits apply to: built-in MagenticOne agents by name, others by type."""
+    names = set()
+    for agent in agents or []:
+        if agent.get("type") == "MagenticOne":
+            names.add(agent.get("name"))
+        elif agent.get("type"):
+            names.add(agent.get("type"))
+    return sorted(n for n in names if n)
+
+
+class Ticket:
+    def __init__(self, seq: int, user_id: str, resources: List[str]):
+        self.seq = seq
+        self.user_id = user_id
+        self.resources = resources
+        self.admitted = False
+        self.released = False
+        self.changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class AdmissionController:
+    def __init__(self, per_worker: int = None, per_user: int = None, per_agent: Dict[str, int] = None, queue_limit: int = None):
+        self.per_worker = per_worker if per_worker is not None else int(os.getenv("RUN_LIMIT_PER_WORKER", "4"))
+        self.per_user = per_user if per_user is not None else int(os.getenv("RUN_LIMIT_PER_USER", "2"))
+        self.per_agent = per_agent if per_agent is not None else parse_agent_limits(os.getenv("RUN_LIMIT_PER_AGENT", ""))
+        self.queue_limit = queue_limit if queue_limit is not None else int(os.getenv("RUN_QUEUE_LIMIT", "100"))
+        self._seq = itertools.count()
+        self.waiting: List[Ticket] = []
+        self.running: List[Ticket] = []
+        self.admitted_total = 0
+        self.queued_total = 0
+
+    # ---------------- limits ----------------
+    def _fits(self, ticket: Ticket) -> bool:
+        if self.per_worker and len(self.running) >= self.per_worker:
+            return False
+        if self.per_user and sum(1 for t in self.running if t.user_id == ticket.user_id) >= self.per_user:
+            return False
+        for resource in ticket.resources:
+            limit = self.per_agent.get(resource)
+            if limit and sum(1 for t in self.running if resource in t.resources) >= limit:
+                return False
+        return True
+
+    def _fair_order(self) -> List[Ticket]:
+        # (number of earlier waiting tickets of the same user, arrival)
+        rank: Dict[str, int] = {}
+        keyed = []
+        for ticket in self.waiting:  # waiting is in arrival order
+            keyed.append((rank.get(ticket.user_id, 0), ticket.seq, ticket))
+            rank[ticket.user_id] = rank.get(ticket.user_id, 0) + 1
+        return [ticket for _, _, ticket in sorted(keyed, key=lambda k: (k[0], k[1]))]
+
+    def _dispatch(self) -> None:
+        for ticket in self._fair_order():
+            if self._fits(ticket):
+                self.waiting.remove(ticket)
+                self.running.append(ticket)
+                ticket.admitted = True
+                self.admitted_total += 1
+        # Positions changed for everybody still waiting
+        for ticket in self.waiting:
+            ticket._notify()
+        for ticket in self.running:
+            ticket._notify()
+
+    # ---------------- API ----------------
+    def queue_full(self) -> bool:
+        return self.queue_limit > 0 and len(self.waiting) >= self.queue_limit
+
+    def submit(self, user_id: str, resources: List[str]) -> Ticket:
+        ticket = Ticket(next(self._seq), user_id, resources)
+        self.waiting.append(ticket)
+        self._dispatch()
+        if not ticket.admitted:
+            self.queued_total += 1
+        return ticket
+
+    def position(self, ticket: Ticket) -> Optional[int]:
+        """1-based place in the queue, or None once admitted."""
+        if ticket.admitted:
+            return None
+        return self._fair_order().index(ticket) + 1
+
+    async def wait(self, ticket: Ticket) -> AsyncIterator[int]:
+        """Yield the queue position whenever it changes, until the ticket is admitted."""
+        last = None
+        while not ticket.admitted:
+            changed = ticket.changed
+            position = self.position(ticket)
+            if position != last:
+                yield position
+                last = position
+                continue
+            await changed.wait()
+
+    def release(self, ticket: Ticket) -> None:
+        """Give back a slot (run ended) or leave the queue (cancelled while waiting)."""
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket in self.running:
+            self.running.remove(ticket)
+        elif ticket in self.waiting:
+            self.waiting.remove(ticket)
+        self._dispatch()
+
+    def metrics(self) -> Dict:
+        per_user: Dict[str, int] = {}
+        per_agent: Dict[str, int] = {}
+        for ticket in self.running:
+            per_user[ticket.user_id] = per_user.get(ticket.user_id, 0) + 1
+            for resource in ticket.resources:
+                per_agent[resource] = per_agent.get(resource, 0) + 1
+        return {
+            "running": len(self.running),
+            "waiting": len(self.waiting),
+            "running_per_user": per_user,
+            "running_per_agent": per_agent,
+            "limits": {
+                "per_worker": self.per_worker,
+                "per_user": self.per_user,
+                "per_agent": self.per_agent,
+                "queue": self.queue_limit,
+            },
+            "admitted_total": self.admitted_total,
+            "queued_total": self.queued_total,
+        }
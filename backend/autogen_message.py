@@ -0,0 +1,93 @@
+"""
+The streamed event message (AutoGenMessage) and its cached JSON encoding.
+
+Every event used to be a pydantic model whose to_json() dict was encoded with
+json.dumps for the SSE frame and again by each persistence sink. The message is
+now a plain slotted class that encodes itself once: to_json() returns a
+MessageJSON (a dict that carries its compact JSON text) and encode() returns
+that text. The SSE frame, the local conversation log and the SQLite store all
+reuse it through encode_message(). Setting any field drops the cached encoding,
+so a message whose content is formatted later is encoded again, once.
+"""
+import json
+from typing import Optional
+
+FIELDS = (
+    "time",
+    "type",
+    "source",
+    "content",
+    "stop_reason",
+    "models_usage",
+    "content_image",
+    "content_thumbnail",
+    "session_id",
+    "session_user",
+    "event_id",
+)
+
+_encoder = json.JSONEncoder(separators=(",", ":"))
+
+
+class MessageJSON(dict):
+    """A message dict with its JSON text attached; don't modify it after it is created."""
+    __slots__ = ("encoded",)
+
+
+def encode_message(message: dict) -> str:
+    """Compact JSON of a message, reusing the cached encoding of a MessageJSON."""
+    encoded = getattr(message, "encoded", None)
+    if encoded is None:
+        encoded = _encoder.encode(message)
+    return encoded
+
+
+class AutoGenMessage:
+    __slots__ = FIELDS + ("_json",)
+
+    def __init__(
+        self,
+        time: str,
+        type: Optional[str] = None,
+        source: Optional[str] = None,
+        content: Optional[str] = None,
+        stop_reason: Optional[str] = None,
+        models_usage: Optional[str] = None,
+        content_image: Optional[str] = None,
+        content_thumbnail: Optional[str] = None,
+        session_id: Optional[str] = None,
+        session_user: Optional[str] = None,
+        event_id: Optional[str] = None,
+    ):
+        # object.__setattr__ skips the cache invalidation below
+        set_field = object.__setattr__
+        set_field(self, "time", time)
+        set_field(self, "type", type)
+        set_field(self, "source", source)
+        set_field(self, "content", content)
+        set_field(self, "stop_reason", stop_reason)
+        set_field(self, "models_usage", models_usage)
+        set_field(self, "content_image", content_image)
+        set_field(self, "content_thumbnail", content_thumbnail)
+        set_field(self, "session_id", session_id)
+        set_field(self, "session_user", session_user)
+        set_field(self, "event_id", event_id)
+        set_field(self, "_json", None)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, "_json", None)
+
+    def __repr__(self):
+        return f"AutoGenMessage(type={self.type!r}, source={self.source!r}, event_id={self.event_id!r})"
+
+    def to_json(self) -> MessageJSON:
+        cached = self._json
+        if cached is None:
+            cached = MessageJSON((name, getattr(self, name)) for name in FIELDS)
+            cached.encoded = _encoder.encode(cached)
+            object.__setattr__(self, "_json", cached)
+        return cached
+
+    def encode(self) -> str:
+        return self.to_json().encoded
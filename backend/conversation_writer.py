@@ -0,0 +1,179 @@
+"""
+Write-behind buffer for conversation persistence.
+
+Streaming events are put on a bounded per-session asyncio queue and a background
+task hands them to the persistence sinks in batches, so storage latency is not added to the time between SSE events. A batch is written
+when it reaches `batch_size` messages or `flush_interval` seconds after its
+first message, whichever comes first.
+
+Each batch is handed to every sink: the local conversation log (crud, run in a
+worker thread) by default, plus e.g. AsyncCosmosDB.append_conversation_messages
+so Cosmos DB receives the run incrementally. A failing sink does not stop the
+others.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import crud
+
+logger = logging.getLogger("conversation_writer")
+
+# sink(user_id, session_id, messages, timestamp)
+ConversationSink = Callable[[str, str, List[dict], str], Awaitable[None]]
+
+
+async def crud_sink(user_id: str, session_id: str, messages: List[dict], timestamp: str) -> None:
+    await asyncio.to_thread(
+        crud.save_messages,
+        id=None,  # header is created by /start
+        user_id=user_id,
+        session_id=session_id,
+        messages=messages,
+        agents=None,
+        run_mode_locally=None,
+        timestamp=timestamp,
+    )
+
+
+class _SessionBuffer:
+    def __init__(self, user_id: str, session_id: str, max_queue_size: int):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self.task: Optional[asyncio.Task] = None
+
+
+class ConversationWriter:
+    def __init__(
+        self,
+        batch_size: int = None,
+        flush_interval: float = None,
+        max_queue_size: int = None,
+        sinks: List[ConversationSink] = None,
+    ) -> None:
+        self.sinks = sinks or [crud_sink]
+        self.batch_size = batch_size or int(os.getenv("CONVERSATION_WRITE_BATCH_SIZE", "20"))
+        self.flush_interval = flush_interval or float(os.getenv("CONVERSATION_WRITE_FLUSH_INTERVAL", "0.5"))
+        self.max_queue_size = max_queue_size or int(os.getenv("CONVERSATION_WRITE_QUEUE_SIZE", "1000"))
+        self._sessions: Dict[Tuple[str, str], _SessionBuffer] = {}
+        self._closed = False
+        # Metrics
+        self._flush_count = 0
+        self._messages_written = 0
+        self._messages_written_per_sink: Dict[str, int] = {}
+        self._messages_failed = 0
+        self._write_errors: Dict[str, int] = {}
+        self._flush_latency_total = 0.0
+        self._flush_latency_max = 0.0
+        self._flush_latency_last = 0.0
+        self._max_queue_depth = 0
+
+    def _get_buffer(self, user_id: str, session_id: str) -> _SessionBuffer:
+        key = (user_id, session_id)
+        buffer = self._sessions.get(key)
+        if buffer is None:
+            buffer = _SessionBuffer(user_id, session_id, self.max_queue_size)
+            buffer.task = asyncio.create_task(self._run(buffer))
+            self._sessions[key] = buffer
+        return buffer
+
+    async def enqueue(self, user_id: str, session_id: str, message: dict, timestamp: str) -> None:
+        """Queue a message for persistence. Waits only when the session queue is full."""
+        if self._closed:
+            raise RuntimeError("ConversationWriter is closed")
+        buffer = self._get_buffer(user_id, session_id)
+        await buffer.queue.put((message, timestamp))
+        self._max_queue_depth = max(self._max_queue_depth, buffer.queue.qsize())
+
+    async def flush(self, user_id: str, session_id: str) -> None:
+        """Wait until every message queued so far for the session is on disk."""
+        buffer = self._sessions.get((user_id, session_id))
+        if buffer is not None:
+            await buffer.queue.join()
+
+    async def close_session(self, user_id: str, session_id: str) -> None:
+        """Flush the session and stop its background task."""
+        buffer = self._sessions.pop((user_id, session_id), None)
+        if buffer is None:
+            return
+        await buffer.queue.join()
+        buffer.task.cancel()
+        try:
+            await buffer.task
+        except asyncio.CancelledError:
+            pass
+
+    async def close(self) -> None:
+        """Flush all sessions and stop accepting messages (lifespan shutdown)."""
+        self._closed = True
+        for user_id, session_id in list(self._sessions.keys()):
+            await self.close_session(user_id, session_id)
+
+    async def _run(self, buffer: _SessionBuffer) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await buffer.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(buffer.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._write_batch(buffer, batch)
+            for _ in batch:
+                buffer.queue.task_done()
+
+    async def _write_batch(self, buffer: _SessionBuffer, batch: list) -> None:
+        started = time.perf_counter()
+        messages = [message for message, _ in batch]
+        results = await asyncio.gather(
+            *(sink(buffer.user_id, buffer.session_id, messages, batch[0][1]) for sink in self.sinks),
+            return_exceptions=True,
+        )
+        written = False
+        for sink, result in zip(self.sinks, results):
+            name = getattr(sink, "__name__", repr(sink))
+            if isinstance(result, BaseException):
+                self._write_errors[name] = self._write_errors.get(name, 0) + 1
+                logger.error(f"{name} failed to persist {len(batch)} message(s) for session {buffer.session_id}: {result}")
+            else:
+                self._messages_written_per_sink[name] = self._messages_written_per_sink.get(name, 0) + len(batch)
+                written = True
+        # Written = stored by at least one sink
+        if written:
+            self._messages_written += len(batch)
+        else:
+            self._messages_failed += len(batch)
+        latency = time.perf_counter() - started
+        self._flush_count += 1
+        self._flush_latency_last = latency
+        self._flush_latency_total += latency
+        self._flush_latency_max = max(self._flush_latency_max, latency)
+
+    def metrics(self) -> dict:
+        depths = {session_id: b.queue.qsize() for (_, session_id), b in self._sessions.items()}
+        return {
+            "sessions": len(self._sessions),
+            "queue_depth": depths,
+            "queue_depth_total": sum(depths.values()),
+            "queue_depth_max_seen": self._max_queue_depth,
+            "queue_capacity": self.max_queue_size,
+            "batch_size": self.batch_size,
+            "flush_interval_seconds": self.flush_interval,
+            "flushes": self._flush_count,
+            "messages_written": self._messages_written,
+            "messages_written_per_sink": self._messages_written_per_sink,
+            "messages_failed": self._messages_failed,
+            "write_errors": self._write_errors,
+            "flush_latency_ms": {
+                "last": round(self._flush_latency_last * 1000, 3),
+                "avg": round(self._flush_latency_total / self._flush_count * 1000, 3) if self._flush_count else 0.0,
+                "max": round(self._flush_latency_max * 1000, 3),
+            },
+        }
@@ -1,10 +1,79 @@
 # File: crud.py
 import os, json, uuid
 from datetime import datetime
-from typing import List
+from typing import List, Iterable, Iterator, Optional, Tuple
+from autogen_message import encode_message
 
 DATA_DIR = "./data/conversations"
 
+# Conversations are stored as append-only JSON Lines logs: the first line is the
+# header record (id, user_id, session_id, agents, run_mode_locally, timestamp)
+# and every following line is a single message. Appending a message is one
+# small write instead of re-reading and re-writing the whole document.
+LOG_EXTENSION = ".jsonl"
+LEGACY_EXTENSION = ".json"
+
+# CONVERSATION_STORE=sqlite switches every function below to the embedded
+# SQLite store (see sqlite_store.py) and CONVERSATION_STORE=memory to a
+# process-local dict (load tests); the default is the JSON Lines logs.
+SQLITE_PATH = "./data/conversations.db"
+_sqlite_store = None
+_memory_store = None
+
+class MemoryConversationStore:
+    def __init__(self):
+        self.conversations = {}
+        self.stream_events = {}
+
+    def save_messages(self, id, user_id: str, session_id: str, messages: Iterable[dict], agents, run_mode_locally, timestamp: str) -> Optional[dict]:
+        header = None
+        conversation = self.conversations.get((user_id, session_id))
+        if conversation is None:
+            header = _conversation_header(id, user_id, session_id, agents, run_mode_locally, timestamp)
+            conversation = self.conversations[(user_id, session_id)] = {**header, "messages": []}
+        conversation["messages"].extend(messages)
+        return header
+
+    def get_conversation(self, user_id: str, session_id: str) -> Optional[dict]:
+        return self.conversations.get((user_id, session_id))
+
+    def get_all_conversations(self) -> List[dict]:
+        return list(self.conversations.values())
+
+    def get_user_conversations(self, user_id: str) -> List[dict]:
+        return [c for (uid, _), c in self.conversations.items() if uid == user_id]
+
+    def delete_conversation(self, user_id: str, session_id: str) -> bool:
+        return self.conversations.pop((user_id, session_id), None) is not None
+
+    def save_stream_events(self, user_id: str, session_id: str, events: List[Tuple[int, str]]) -> None:
+        self.stream_events.setdefault((user_id, session_id), []).extend(events)
+
+    def get_stream_events(self, user_id: str, session_id: str, after_id: int) -> List[Tuple[int, str]]:
+        return [e for e in self.stream_events.get((user_id, session_id), []) if e[0] > after_id]
+
+    def delete_stream_events(self, user_id: str, session_id: str) -> None:
+        self.stream_events.pop((user_id, session_id), None)
+
+def get_conversation_store():
+    """The store selected by CONVERSATION_STORE, or None for the JSON Lines logs."""
+    global _memory_store
+    store = os.getenv("CONVERSATION_STORE", "jsonl").lower()
+    if store == "sqlite":
+        return get_sqlite_store()
+    if store == "memory":
+        if _memory_store is None:
+            _memory_store = MemoryConversationStore()
+        return _memory_store
+    return None
+
+def get_sqlite_store():
+    global _sqlite_store
+    if _sqlite_store is None:
+        from sqlite_store import SQLiteConversationStore
+        _sqlite_store = SQLiteConversationStore(os.getenv("CONVERSATION_SQLITE_PATH", SQLITE_PATH))
+    return _sqlite_store
+
 def ensure_data_dir():
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
@@ -12,38 +81,84 @@ def ensure_data_dir():
 
 def get_conversation_filepath(user_id: str, session_id: str) -> str:
     ensure_data_dir()
-    return os.path.join(DATA_DIR, f"{user_id}_{session_id}.json")
+    return os.path.join(DATA_DIR, f"{user_id}_{session_id}{LOG_EXTENSION}")
+
+def get_legacy_conversation_filepath(user_id: str, session_id: str) -> str:
+    ensure_data_dir()
+    return os.path.join(DATA_DIR, f"{user_id}_{session_id}{LEGACY_EXTENSION}")
+
+def _conversation_header(id, user_id: str, session_id: str, agents, run_mode_locally, timestamp: str) -> dict:
+    return {
+        "id": str(id),
+        "user_id": user_id,
+        "session_id": session_id,
+        "agents": agents,
+        "run_mode_locally": run_mode_locally,
+        "timestamp": timestamp
+    }
 
-# Save a message to a conversation JSON file.
+def _dumps_line(record: dict) -> str:
+    # Messages from to_json() carry their encoding already
+    return encode_message(record) + "\n"
+
+# Save a message to a conversation log (appends a single line).
 def save_message(id: str, user_id: str, session_id: str, message: dict, agents: dict, run_mode_locally: bool, timestamp: str):
+    return save_messages(id, user_id, session_id, [message], agents, run_mode_locally, timestamp)
+
+# Append a batch of messages to a conversation log in one write.
+def save_messages(id: str, user_id: str, session_id: str, messages: Iterable[dict], agents: dict, run_mode_locally: bool, timestamp: str):
+    store = get_conversation_store()
+    if store is not None:
+        return store.save_messages(id, user_id, session_id, messages, agents, run_mode_locally, timestamp)
     filepath = get_conversation_filepath(user_id, session_id)
-    if os.path.exists(filepath):
-        with open(filepath, "r") as f:
-            conversation = json.load(f)
-    else:
-        conversation = {
-            "id": str(id),
-            "user_id": user_id,
-            "session_id": session_id,
-            "messages": [],
-            "agents": agents,
-            "run_mode_locally": run_mode_locally,
-            "timestamp": timestamp
-        }
-    # Append message with timestamp
-    # message["id"] = str(uuid.uuid4())
-    # message["timestamp"] = datetime.now().isoformat()
-    conversation["messages"].append(message)
-    with open(filepath, "w") as f:
-        json.dump(conversation, f, indent=2)
+    if not os.path.exists(filepath):
+        migrate_conversation(user_id, session_id)
+    lines = []
+    header = None
+    if not os.path.exists(filepath):
+        header = _conversation_header(id, user_id, session_id, agents, run_mode_locally, timestamp)
+        lines.append(_dumps_line(header))
+    lines.extend(_dumps_line(m) for m in messages)
+    with open(filepath, "a", encoding="utf-8") as f:
+        f.write("".join(lines))
+    return header
+
+def _iter_log_records(filepath: str) -> Iterator[dict]:
+    with open(filepath, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A partially written trailing line (e.g. crash mid-append) is skipped.
+                print(f"Skipping corrupt line in {filepath}")
+
+def _read_log(filepath: str) -> Optional[dict]:
+    records = _iter_log_records(filepath)
+    header = next(records, None)
+    if header is None:
+        return None
+    conversation = dict(header)
+    conversation["messages"] = list(records)
     return conversation
 
+def _read_legacy(filepath: str) -> dict:
+    with open(filepath, "r", encoding="utf-8") as f:
+        return json.load(f)
+
 # Retrieve a single conversation.
 def get_conversation(user_id: str, session_id: str):
+    store = get_conversation_store()
+    if store is not None:
+        return store.get_conversation(user_id, session_id)
     filepath = get_conversation_filepath(user_id, session_id)
     if os.path.exists(filepath):
-        with open(filepath, "r") as f:
-            return json.load(f)
+        return _read_log(filepath)
+    legacy_path = get_legacy_conversation_filepath(user_id, session_id)
+    if os.path.exists(legacy_path):
+        return _read_legacy(legacy_path)
     return None
 
 def extract_session_id(filepath: str) -> str:
@@ -51,44 +166,171 @@ def extract_session_id(filepath: str) -> str:
     session_id = filename.split('_', 1)[-1].rsplit('.', 1)[0]
     return session_id
 
+def _conversation_files(prefix: str = "") -> List[str]:
+    """Return conversation files, preferring the .jsonl log over a legacy .json of the same session."""
+    ensure_data_dir()
+    logs, legacy = {}, {}
+    for fname in os.listdir(DATA_DIR):
+        if not fname.startswith(prefix):
+            continue
+        stem, ext = os.path.splitext(fname)
+        if ext == LOG_EXTENSION:
+            logs[stem] = fname
+        elif ext == LEGACY_EXTENSION:
+            legacy[stem] = fname
+    files = {**legacy, **logs}
+    return [os.path.join(DATA_DIR, fname) for fname in files.values()]
+
+def _load_conversation_file(path: str) -> Optional[dict]:
+    if path.endswith(LOG_EXTENSION):
+        return _read_log(path)
+    return _read_legacy(path)
+
 # List all conversations.
 def get_all_conversations() -> List[dict]:
-    ensure_data_dir()
+    store = get_conversation_store()
+    if store is not None:
+        return store.get_all_conversations()
     conversations = []
-    for fname in os.listdir(DATA_DIR):
-        if fname.endswith(".json"):
-            path = os.path.join(DATA_DIR, fname)
-            try:
-                with open(path, "r") as f:
-                    conversations.append(json.load(f))
-            except json.JSONDecodeError:
-                print(f"Error decoding JSON from file {path}")
-                conversations.append({
-                        "id": "DUMMY-b666-4943-9c3d-ec9482751601",
-                        "user_id": "user123",
-                        "session_id": extract_session_id(path),
-                        "messages": [],
-                        "agents": [],
-                        "run_mode_locally": "false",
-                        "timestamp": "ERROR"
-
-                    })
+    for path in _conversation_files():
+        try:
+            conversation = _load_conversation_file(path)
+            if conversation is not None:
+                conversations.append(conversation)
+        except json.JSONDecodeError:
+            print(f"Error decoding JSON from file {path}")
+            conversations.append({
+                    "id": "DUMMY-b666-4943-9c3d-ec9482751601",
+                    "user_id": "user123",
+                    "session_id": extract_session_id(path),
+                    "messages": [],
+                    "agents": [],
+                    "run_mode_locally": "false",
+                    "timestamp": "ERROR"
+
+                })
     return conversations
 
 # List conversations for a particular user.
 def get_user_conversations(user_id: str):
-    ensure_data_dir()
+    store = get_conversation_store()
+    if store is not None:
+        return store.get_user_conversations(user_id)
     conversations = []
-    for fname in os.listdir(DATA_DIR):
-        if fname.startswith(user_id+"_") and fname.endswith(".json"):
-            path = os.path.join(DATA_DIR, fname)
-            with open(path, "r") as f:
-                conversations.append(json.load(f))
+    for path in _conversation_files(prefix=user_id + "_"):
+        conversation = _load_conversation_file(path)
+        if conversation is not None:
+            conversations.append(conversation)
     return conversations
 
 def delete_conversation(user_id: str, session_id: str) -> bool:
-    filepath = get_conversation_filepath(user_id, session_id)
+    store = get_conversation_store()
+    if store is not None:
+        return store.delete_conversation(user_id, session_id)
+    deleted = False
+    for filepath in (get_conversation_filepath(user_id, session_id), get_legacy_conversation_filepath(user_id, session_id)):
+        if os.path.exists(filepath):
+            os.remove(filepath)
+            deleted = True
+    return deleted
+
+# ------------------------- SSE event spill -------------------------
+# Stream events that fell out of a run's in-memory ring buffer (run_manager.py),
+# kept until the run is dropped so a reconnecting client can still catch up.
+def get_stream_events_filepath(user_id: str, session_id: str) -> str:
+    directory = os.path.join(ensure_data_dir(), "events")
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return os.path.join(directory, f"{user_id}_{session_id}{LOG_EXTENSION}")
+
+def save_stream_events(user_id: str, session_id: str, events: List[Tuple[int, str]]):
+    store = get_conversation_store()
+    if store is not None:
+        return store.save_stream_events(user_id, session_id, events)
+    with open(get_stream_events_filepath(user_id, session_id), "a", encoding="utf-8") as f:
+        f.write("".join(_dumps_line({"id": event_id, "frame": frame}) for event_id, frame in events))
+
+def get_stream_events(user_id: str, session_id: str, after_id: int) -> List[Tuple[int, str]]:
+    store = get_conversation_store()
+    if store is not None:
+        return store.get_stream_events(user_id, session_id, after_id)
+    filepath = get_stream_events_filepath(user_id, session_id)
+    if not os.path.exists(filepath):
+        return []
+    return [(r["id"], r["frame"]) for r in _iter_log_records(filepath) if r["id"] > after_id]
+
+def delete_stream_events(user_id: str, session_id: str):
+    store = get_conversation_store()
+    if store is not None:
+        return store.delete_stream_events(user_id, session_id)
+    filepath = get_stream_events_filepath(user_id, session_id)
     if os.path.exists(filepath):
         os.remove(filepath)
-        return True
-    return False
\ No newline at end of file
+
+# ----------------------------- Migration -----------------------------
+def _migrate_file(legacy_path: str) -> bool:
+    """Convert one legacy {user}_{session}.json document into a .jsonl log.
+
+    The log is written to a temporary file and renamed into place, so a crash
+    leaves either the legacy document or the complete log. The legacy file is
+    removed only after the rename succeeded.
+    """
+    target = os.path.splitext(legacy_path)[0] + LOG_EXTENSION
+    if os.path.exists(target):
+        return False
+    conversation = _read_legacy(legacy_path)
+    messages = conversation.pop("messages", []) or []
+    tmp_path = target + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(_dumps_line(conversation))
+        for message in messages:
+            f.write(_dumps_line(message))
+    os.replace(tmp_path, target)
+    os.remove(legacy_path)
+    return True
+
+def migrate_conversation(user_id: str, session_id: str) -> bool:
+    legacy_path = get_legacy_conversation_filepath(user_id, session_id)
+    if not os.path.exists(legacy_path):
+        return False
+    return _migrate_file(legacy_path)
+
+# Convert all legacy JSON conversation documents to the JSON Lines log format.
+def migrate_legacy_conversations() -> int:
+    ensure_data_dir()
+    migrated = 0
+    for fname in os.listdir(DATA_DIR):
+        if not fname.endswith(LEGACY_EXTENSION):
+            continue
+        path = os.path.join(DATA_DIR, fname)
+        try:
+            if _migrate_file(path):
+                migrated += 1
+        except json.JSONDecodeError:
+            print(f"Error decoding JSON from file {path}; left in place")
+    return migrated
+
+# Copy all file-based conversations (.jsonl logs and legacy .json) into the SQLite store.
+def import_conversations_to_sqlite() -> int:
+    store = get_sqlite_store()
+    imported = 0
+    for path in _conversation_files():
+        try:
+            conversation = _load_conversation_file(path)
+        except json.JSONDecodeError:
+            print(f"Error decoding JSON from file {path}; skipped")
+            continue
+        if conversation is not None and store.import_conversation(conversation):
+            imported += 1
+    return imported
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "sqlite":
+        # python crud.py sqlite -> import ./data/conversations/* into the SQLite store
+        count = import_conversations_to_sqlite()
+        print(f"Imported {count} conversation(s) into {os.getenv('CONVERSATION_SQLITE_PATH', SQLITE_PATH)}.")
+    else:
+        # python crud.py -> migrate ./data/conversations/*.json to *.jsonl
+        count = migrate_legacy_conversations()
+        print(f"Migrated {count} conversation(s) to {LOG_EXTENSION} logs in {DATA_DIR}.")
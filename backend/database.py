@@ -1,19 +1,332 @@
 import os
+import asyncio
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.cosmos import CosmosClient, PartitionKey
+from azure.cosmos.exceptions import CosmosResourceNotFoundError, CosmosResourceExistsError, CosmosHttpResponseError, CosmosAccessConditionFailedError, CosmosBatchOperationError
+from azure.core import MatchConditions
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
 from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
 from typing import Optional, List, Dict
 
 from autogen_agentchat.base import TaskResult
-from autogen_agentchat.messages import MultiModalMessage, TextMessage, ToolCallExecutionEvent, ToolCallRequestEvent, SelectSpeakerEvent, ToolCallSummaryMessage
 
+from message_normalizer import normalize_message
 from schemas import AutoGenMessage
+from storage import Storage, StorageBase
+from team_cache import TeamCache
 import uuid
 from dotenv import load_dotenv
 import time
-import glob
 import json
+import random
+from concurrent.futures import ThreadPoolExecutor
 
-class CosmosDB:
+class CosmosDBBase(StorageBase):
+    """Document shaping and query building shared by CosmosDB and AsyncCosmosDB."""
+
+    CONTAINER_PARTITION_KEYS = {
+        "ag_demo": "/user_id",
+        "agent_teams": "/team_id",
+        # Materialized daily run counters, one item per (date, user_id)
+        "ag_stats": "/month",
+    }
+    # Index only the paths we filter or sort on; message bodies and images are never indexed
+    INDEXING_POLICIES = {
+        "ag_demo": {
+            "indexingMode": "consistent",
+            "automatic": True,
+            "includedPaths": [
+                {"path": "/user_id/?"},
+                {"path": "/session_id/?"},
+                {"path": "/timestamp/?"},
+                {"path": "/doc_type/?"},
+                {"path": "/seq/?"},
+                {"path": "/counted_date/?"},
+            ],
+            "excludedPaths": [{"path": "/*"}],
+            "compositeIndexes": [
+                [
+                    {"path": "/user_id", "order": "ascending"},
+                    {"path": "/timestamp", "order": "descending"},
+                ],
+            ],
+        },
+        "agent_teams": {
+            "indexingMode": "consistent",
+            "automatic": True,
+            "includedPaths": [
+                {"path": "/team_id/?"},
+                {"path": "/_ts/?"},
+            ],
+            "excludedPaths": [{"path": "/*"}],
+        },
+        "ag_stats": {
+            "indexingMode": "consistent",
+            "automatic": True,
+            "includedPaths": [
+                {"path": "/month/?"},
+                {"path": "/date/?"},
+                {"path": "/user_id/?"},
+            ],
+            "excludedPaths": [{"path": "/*"}],
+        },
+    }
+    INCREMENT_COUNT = [{"op": "incr", "path": "/count", "value": 1}]
+    DECREMENT_COUNT = [{"op": "incr", "path": "/count", "value": -1}]
+    # Items of a user's sessions, with what's needed to decrement the counters of deleted sessions
+    DELETE_ITEMS_QUERY = "SELECT c.id, c.doc_type, c.timestamp, c.counted_date FROM c WHERE c.user_id = @userId"
+    # Transactional batches are limited to 100 operations within one partition key
+    MAX_BATCH_OPERATIONS = 100
+    BULK_CONCURRENCY = int(os.getenv("COSMOS_DB_BULK_CONCURRENCY", "8"))
+    THROTTLE_RETRIES = 5
+    # Streamed conversations are stored as a small "session" header item plus one
+    # "message" item per message, all in the user's partition. Older documents
+    # without doc_type embed their messages and are read as-is.
+    SESSION_FILTER = "(NOT IS_DEFINED(c.doc_type) OR c.doc_type = 'session')"
+    MESSAGE_COUNT_PATH = "/message_count"
+    # Set on a session once it is counted in ag_stats, to the date it was counted on.
+    # Decrements and the backfill only look at this, so they count what was incremented.
+    COUNTED_DATE_PATH = "/counted_date"
+    NOT_COUNTED_FILTER = "FROM c WHERE NOT IS_DEFINED(c.counted_date)"
+
+    def format_message(self, _log_entry_json):
+        _response = AutoGenMessage(
+            time="N/A",
+            session_id="session_id",
+            session_user="session_user",
+        )
+        # Same normalization as the stream (message_normalizer.py)
+        return normalize_message(_log_entry_json, _response)
+
+    def build_conversation_document(self, conversation: TaskResult, conversation_details: AutoGenMessage, conversation_dict: dict) -> dict:
+        _messsages = []
+        for message in conversation.messages:
+            _m = self.format_message(message)
+            _messsages.append(_m.to_json())
+        return {
+            "id": str(uuid.uuid4()),
+            "user_id": conversation_details.session_user,
+            "session_id": conversation_details.session_id,
+            "messages": _messsages, 
+            "agents": conversation_dict["agents"],
+            "run_mode_locally": False,
+            "timestamp": conversation_details.time,
+            # store_conversation counts the document as soon as it is created
+            "counted_date": conversation_details.time[:10],
+        }
+
+    @staticmethod
+    def build_conversation_header(user_id: str, session_id: str, agents, timestamp: str, run_mode_locally: bool = False) -> dict:
+        # The session id is the item id, so the header is addressed by point operations
+        return {
+            "id": session_id,
+            "doc_type": "session",
+            "user_id": user_id,
+            "session_id": session_id,
+            "message_count": 0,
+            "agents": agents,
+            "run_mode_locally": run_mode_locally,
+            "timestamp": timestamp,
+        }
+
+    @staticmethod
+    def build_message_item(user_id: str, session_id: str, seq: int, message: Dict) -> dict:
+        return {
+            "id": f"{session_id}:{seq:06d}",
+            "doc_type": "message",
+            "user_id": user_id,
+            "session_id": session_id,
+            "seq": seq,
+            "message": message,
+        }
+
+    @staticmethod
+    def message_range_query(session_id: str, start: int, end: int):
+        query = (
+            "SELECT c.seq, c.message FROM c "
+            "WHERE c.session_id = @sessionId AND c.doc_type = 'message' AND c.seq >= @start AND c.seq < @end "
+            "ORDER BY c.seq"
+        )
+        parameters = [
+            {"name": "@sessionId", "value": session_id},
+            {"name": "@start", "value": start},
+            {"name": "@end", "value": end},
+        ]
+        return query, parameters
+
+    @staticmethod
+    def count_query(user_id: Optional[str]):
+        if user_id is None:
+            return f"SELECT VALUE COUNT(1) FROM c WHERE {CosmosDBBase.SESSION_FILTER}", []
+        return f"SELECT VALUE COUNT(1) FROM c WHERE c.user_id = @userId AND {CosmosDBBase.SESSION_FILTER}", [{"name": "@userId", "value": user_id}]
+
+    @staticmethod
+    def page_query(user_id: Optional[str], skip: int, limit: int):
+        if user_id is None:
+            query = f"SELECT c.user_id, c.session_id, c.timestamp FROM c WHERE {CosmosDBBase.SESSION_FILTER} ORDER BY c.timestamp DESC OFFSET @skip LIMIT @limit"
+            parameters = [
+                {"name": "@skip", "value": skip},
+                {"name": "@limit", "value": limit}
+            ]
+        else:
+            query = f"SELECT c.user_id, c.session_id, c.timestamp FROM c WHERE c.user_id = @userId AND {CosmosDBBase.SESSION_FILTER} ORDER BY c.timestamp DESC OFFSET @skip LIMIT @limit"
+            parameters = [
+                {"name": "@userId", "value": user_id},
+                {"name": "@skip", "value": skip},
+                {"name": "@limit", "value": limit}
+            ]
+        return query, parameters
+
+    @staticmethod
+    def keyset_query(user_id: Optional[str], position: Optional[Dict], limit: int):
+        """Newest-first page that starts right after `position` (keyset pagination).
+
+        The position is the last timestamp returned plus the ids already returned
+        with that timestamp, so a page costs the same regardless of its depth.
+        """
+        conditions = [CosmosDBBase.SESSION_FILTER]
+        parameters = [{"name": "@limit", "value": limit}]
+        if user_id is not None:
+            conditions.append("c.user_id = @userId")
+            parameters.append({"name": "@userId", "value": user_id})
+        if position is not None:
+            conditions.append("c.timestamp <= @ts AND NOT ARRAY_CONTAINS(@seenIds, c.id)")
+            parameters.append({"name": "@ts", "value": position["ts"]})
+            parameters.append({"name": "@seenIds", "value": position["ids"]})
+        query = f"SELECT TOP @limit c.id, c.user_id, c.session_id, c.timestamp FROM c WHERE {' AND '.join(conditions)} ORDER BY c.timestamp DESC"
+        return query, parameters
+
+    @staticmethod
+    def conversation_query(user_id: str, session_id: str):
+        # Header (or legacy embedded document) only; message items are read by range
+        query = f"SELECT * FROM c WHERE c.user_id = @userId AND c.session_id = @sessionId AND {CosmosDBBase.SESSION_FILTER}"
+        parameters = [
+            {"name": "@userId", "value": user_id},
+            {"name": "@sessionId", "value": session_id},
+        ]
+        return query, parameters
+
+    @staticmethod
+    def stats_query(start_date: str, end_date: str):
+        # Full scan of ag_demo, only used to backfill the ag_stats counters.
+        # Fetch raw rows (no GROUP BY) and aggregate in Python to avoid cross-partition GROUP BY caveats.
+        # Same rule as the decrements: sessions with a counted_date, plus legacy embedded
+        # documents (no doc_type), which were always counted when they were stored.
+        query = (
+            "SELECT c.user_id, c.doc_type, c.timestamp, c.counted_date "
+            "FROM c "
+            f"WHERE {CosmosDBBase.SESSION_FILTER} "
+            "AND (IS_DEFINED(c.counted_date) OR NOT IS_DEFINED(c.doc_type))"
+        )
+        return query, []
+
+    @staticmethod
+    def counted_stats_rows(rows: List[Dict], start_date: str, end_date: str) -> List[Dict]:
+        """{"user_id", "date"} per counted session within the date range, for aggregate_stats."""
+        counted = []
+        for row in rows:
+            date = CosmosDBBase.counted_date(row)
+            if date is not None and start_date <= date <= end_date:
+                counted.append({"user_id": row.get("user_id"), "date": date})
+        return counted
+
+    @staticmethod
+    def stats_counter_document(user_id: str, date: str, count: int) -> Dict:
+        return {
+            "id": f"{date}_{user_id}",
+            "month": date[:7],
+            "date": date,
+            "user_id": user_id,
+            "count": count,
+        }
+
+    @staticmethod
+    def counted_date(item: Dict) -> Optional[str]:
+        """Date a session was counted on in ag_stats, or None if it never was (e.g. the run did not finish)."""
+        if item.get("counted_date"):
+            return item["counted_date"]
+        if item.get("doc_type") is None and isinstance(item.get("timestamp"), str):
+            return item["timestamp"][:10]  # legacy embedded document, counted when stored
+        return None
+
+    @staticmethod
+    def session_header_dates(items: List[Dict]) -> List[str]:
+        """Counted dates of the sessions among items about to be deleted, one per counted session."""
+        dates = []
+        for item in items:
+            if item.get("doc_type") not in (None, "session"):
+                continue
+            date = CosmosDBBase.counted_date(item)
+            if date is not None:
+                dates.append(date)
+        return dates
+
+    @staticmethod
+    def stats_months(start_date: str, end_date: str) -> List[str]:
+        year, month = int(start_date[:4]), int(start_date[5:7])
+        end_year, end_month = int(end_date[:4]), int(end_date[5:7])
+        months = []
+        while (year, month) <= (end_year, end_month):
+            months.append(f"{year:04d}-{month:02d}")
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return months
+
+    def stats_counter_query(self, start_date: str, end_date: str):
+        # Range read over the monthly partitions that cover the date range
+        months = self.stats_months(start_date, end_date)
+        month_params = [{"name": f"@m{i}", "value": m} for i, m in enumerate(months)]
+        query = (
+            "SELECT c.user_id, c.date, c.count FROM c "
+            f"WHERE c.month IN ({', '.join(p['name'] for p in month_params)}) "
+            "AND c.date >= @startDate AND c.date <= @endDate"
+        )
+        parameters = month_params + [
+            {"name": "@startDate", "value": start_date},
+            {"name": "@endDate", "value": end_date},
+        ]
+        return query, parameters
+
+    TEAM_QUERY = "SELECT * FROM c WHERE c.team_id = @teamId"
+    # Cheap change probe for the team list: any create/replace bumps MAX(_ts), deletes change COUNT.
+    # Separate single-aggregate queries: cross-partition queries can't combine aggregates in an object.
+    TEAMS_COUNT_QUERY = "SELECT VALUE COUNT(1) FROM c"
+    TEAMS_MAX_TS_QUERY = "SELECT VALUE MAX(c._ts) FROM c"
+
+    @staticmethod
+    def teams_version(counts: List, timestamps: List) -> tuple:
+        """(count, max _ts) of the team list, from the two probe queries."""
+        timestamps = [ts for ts in timestamps if ts is not None]
+        return (sum(counts), max(timestamps) if timestamps else None)
+
+    @staticmethod
+    def team_parameters(team_id: str) -> List[Dict]:
+        return [{"name": "@teamId", "value": team_id}]
+
+    @classmethod
+    def delete_batches(cls, ids: List[str]) -> List[List]:
+        return [[("delete", (item_id,)) for item_id in chunk] for chunk in cls.chunked(ids, cls.MAX_BATCH_OPERATIONS)]
+
+    @classmethod
+    def throttle_delay(cls, error: Exception, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying a request throttled with 429, or None to give up.
+
+        The SDK already retries throttled requests; this covers bulk operations
+        that still fail once its retry budget is exhausted.
+        """
+        if not isinstance(error, CosmosHttpResponseError) or error.status_code != 429 or attempt >= cls.THROTTLE_RETRIES:
+            return None
+        retry_after_ms = None
+        headers = getattr(error, "headers", None) or {}
+        try:
+            retry_after_ms = float(headers.get("x-ms-retry-after-ms"))
+        except (TypeError, ValueError):
+            pass
+        backoff = min(30.0, (2 ** attempt) * 0.1 + random.uniform(0, 0.1))
+        return max(backoff, retry_after_ms / 1000.0) if retry_after_ms else backoff
+
+class CosmosDB(CosmosDBBase):
     def __init__(self):
         load_dotenv("./.env", override=True)
         # Get Cosmos DB account details
@@ -24,155 +337,84 @@ class CosmosDB:
         self.database = self.client.create_database_if_not_exists(id=COSMOS_DB_DATABASE)
         self.containers = {}
         # Pre-initialize default containers
-        self.containers["ag_demo"] = self.database.create_container_if_not_exists(
-            id="ag_demo",
-            partition_key=PartitionKey(path="/user_id"),
-            offer_throughput=400
-        )
-        self.containers["agent_teams"] = self.database.create_container_if_not_exists(
-            id="agent_teams",
-            partition_key=PartitionKey(path="/team_id"),
-            offer_throughput=400
-        )
+        for container_name in self.CONTAINER_PARTITION_KEYS:
+            self.get_container(container_name)
     
     def get_container(self, container_name: str = "ag_demo"):
         if container_name in self.containers:
             return self.containers[container_name]
         container = self.database.create_container_if_not_exists(
             id=container_name,
-            partition_key=PartitionKey(path="/user_id"),
+            partition_key=PartitionKey(path=self.CONTAINER_PARTITION_KEYS.get(container_name, "/user_id")),
+            indexing_policy=self.INDEXING_POLICIES.get(container_name),
             offer_throughput=400
         )
         self.containers[container_name] = container
         return container
-    
-    def format_message(self, _log_entry_json):
-        _response = AutoGenMessage(
-            time="N/A",
-            session_id="session_id",
-            session_user="session_user",
-        )
-        # ...existing code...
-        if isinstance(_log_entry_json, TaskResult):
-            _response.type = "TaskResult"
-            _response.source = "TaskResult"
-            _response.content = _log_entry_json.messages[-1].content
-            _response.stop_reason = _log_entry_json.stop_reason
-        elif isinstance(_log_entry_json, MultiModalMessage):
-            _response.type = _log_entry_json.type
-            _response.source = _log_entry_json.source
-            _response.content = _log_entry_json.content[0]
-            _response.content_image = _log_entry_json.content[1].data_uri
-        elif isinstance(_log_entry_json, TextMessage):
-            _response.type = _log_entry_json.type
-            _response.source = _log_entry_json.source
-            _response.content = _log_entry_json.content
-            # Custom logic for Executor with base64 image
-            if _log_entry_json.source == "Executor":
-                import ast
-                import re
-                content = _log_entry_json.content
-                try:
-                    if isinstance(content, str) and "'type': 'image'" in content and "'base64_data':" in content:
-                        pattern = r"\{[^{}]*'type': 'image'[^{}]*'base64_data':[^{}]*\}"
-                        match = re.search(pattern, content)
-                        if match:
-                            img_dict_str = match.group(0)
-                            img_dict = ast.literal_eval(img_dict_str)
-                            if (
-                                isinstance(img_dict, dict)
-                                and img_dict.get('type') == 'image'
-                                and img_dict.get('format') == 'png'
-                                and 'base64_data' in img_dict
-                            ):
-                                _response.content_image = f"data:image/png;base64,{img_dict['base64_data']}"
-                                # Remove the dict substring from the content
-                                cleaned_content = content.replace(img_dict_str, "").strip()
-                                _response.content = cleaned_content
-                except Exception:
-                    pass
-        elif isinstance(_log_entry_json, ToolCallExecutionEvent):
-            _response.type = _log_entry_json.type
-            _response.source = _log_entry_json.source
-            _response.content = _log_entry_json.content[0].content
-        elif isinstance(_log_entry_json, ToolCallRequestEvent):
-            _response.type = _log_entry_json.type
-            _response.source = _log_entry_json.source
-            _response.content = _log_entry_json.content[0].arguments
-        elif isinstance(_log_entry_json, SelectSpeakerEvent):
-            _response.type = _log_entry_json.type
-            _response.source = _log_entry_json.source
-            _response.content = _log_entry_json.content[0]
-        elif isinstance(_log_entry_json, ToolCallSummaryMessage):
-            _response.type = _log_entry_json.type
-            _response.source = _log_entry_json.source
-            _response.content = _log_entry_json.content
-        else:
-            _response.type = "N/A"
-            _response.source = "N/A"
-            _response.content = "Agents mumbling."
-        return _response
+
+    def apply_indexing_policies(self):
+        """Migrate existing containers to the explicit indexing policies.
+
+        create_container_if_not_exists only applies a policy to new containers.
+        Cosmos DB re-indexes online after the replace; progress is visible in
+        the container's index transformation progress.
+        """
+        for container_name, policy in self.INDEXING_POLICIES.items():
+            self.database.replace_container(
+                container=container_name,
+                partition_key=PartitionKey(path=self.CONTAINER_PARTITION_KEYS[container_name]),
+                indexing_policy=policy
+            )
+            print(f"Applied indexing policy to {container_name}.")
 
     def store_conversation(self, conversation: TaskResult, conversation_details: AutoGenMessage, conversation_dict: dict):
-        _messsages = []
-        for message in conversation.messages:
-            _m = self.format_message(message)
-            _messsages.append(_m.to_json())
-        conversation_document_item = {
-            "id": str(uuid.uuid4()),
-            "user_id": conversation_details.session_user,
-            "session_id": conversation_details.session_id,
-            "messages": _messsages, 
-            "agents": conversation_dict["agents"],
-            "run_mode_locally": False,
-            "timestamp": conversation_details.time,
-        }
+        conversation_document_item = self.build_conversation_document(conversation, conversation_details, conversation_dict)
         container = self.get_container("ag_demo")
         response = container.create_item(body=conversation_document_item)
+        try:
+            self.increment_conversation_stats(conversation_details.session_user, conversation_details.time)
+        except Exception as e:
+            print(f"Warning: failed to update conversation stats: {e}")
         return response
 
+    def increment_conversation_stats(self, user_id: str, timestamp: str):
+        container = self.get_container("ag_stats")
+        counter = self.stats_counter_document(user_id, timestamp[:10], 1)
+        try:
+            return container.patch_item(item=counter["id"], partition_key=counter["month"], patch_operations=self.INCREMENT_COUNT)
+        except CosmosResourceNotFoundError:
+            try:
+                return container.create_item(body=counter)
+            except CosmosResourceExistsError:
+                # Created concurrently by another run
+                return container.patch_item(item=counter["id"], partition_key=counter["month"], patch_operations=self.INCREMENT_COUNT)
+
+    def backfill_conversation_stats(self, start_date: str = "0000-00-00", end_date: str = "9999-99-99") -> int:
+        """Rebuild the ag_stats counters from a full scan of the conversations."""
+        container = self.get_container("ag_demo")
+        query, parameters = self.stats_query(start_date, end_date)
+        rows = list(container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
+        stats_container = self.get_container("ag_stats")
+        buckets = self.aggregate_stats(self.counted_stats_rows(rows, start_date, end_date))
+        for bucket in buckets:
+            stats_container.upsert_item(body=self.stats_counter_document(bucket["user_id"], bucket["date"], bucket["count"]))
+        return len(buckets)
+
     def fetch_user_conversatons(self, user_id: Optional[str] = None, page: int = 1, page_size: int = 20) -> Dict:
         container = self.get_container("ag_demo")
         
         # First, get the total count
-        if user_id is None:
-            count_query = "SELECT VALUE COUNT(1) FROM c"
-            count_parameters = []
-        else:
-            count_query = "SELECT VALUE COUNT(1) FROM c WHERE c.user_id = @userId"
-            count_parameters = [{"name": "@userId", "value": user_id}]
-            
+        count_query, count_parameters = self.count_query(user_id)
         count_results = list(container.query_items(
             query=count_query, 
             parameters=count_parameters, 
             enable_cross_partition_query=True
         ))
         total_count = count_results[0] if count_results else 0
-        
-        # Calculate total pages
-        total_pages = (total_count + page_size - 1) // page_size if total_count > 0 else 1
-        
-        # Ensure page is within valid range
-        page = max(1, min(page, total_pages))
-        
-        # Calculate skip for pagination
-        skip = (page - 1) * page_size
+        page, total_pages, skip = self.page_bounds(total_count, page, page_size)
         
         # Get paginated results
-        if user_id is None:
-            query = "SELECT c.user_id, c.session_id, c.timestamp FROM c ORDER BY c.timestamp DESC OFFSET @skip LIMIT @limit"
-            parameters = [
-                {"name": "@skip", "value": skip},
-                {"name": "@limit", "value": page_size}
-            ]
-        else:
-            query = "SELECT c.user_id, c.session_id, c.timestamp FROM c WHERE c.user_id = @userId ORDER BY c.timestamp DESC OFFSET @skip LIMIT @limit"
-            parameters = [
-                {"name": "@userId", "value": user_id},
-                {"name": "@skip", "value": skip},
-                {"name": "@limit", "value": page_size}
-            ]
-            
+        query, parameters = self.page_query(user_id, skip, page_size)
         items = list(container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
         
         return {
@@ -182,57 +424,104 @@ class CosmosDB:
             "total_pages": total_pages
         }
 
+    def fetch_conversations_page(self, user_id: Optional[str] = None, cursor: Optional[str] = None, page_size: int = 20, include_count: bool = False) -> Dict:
+        container = self.get_container("ag_demo")
+        position = self.decode_cursor(cursor) if cursor else None
+        query, parameters = self.keyset_query(user_id, position, page_size)
+        items = list(container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
+        result = {
+            "conversations": items,
+            "next_cursor": self.next_cursor(items, position, page_size),
+        }
+        if include_count:
+            count_query, count_parameters = self.count_query(user_id)
+            count_results = list(container.query_items(query=count_query, parameters=count_parameters, enable_cross_partition_query=True))
+            result["total_count"] = count_results[0] if count_results else 0
+        return result
+
     def fetch_user_conversation(self, user_id: str, session_id: str):
         container = self.get_container("ag_demo")
-        query = "SELECT * FROM c WHERE c.user_id = @userId AND c.session_id = @sessionId"
-        parameters = [
-            {"name": "@userId", "value": user_id},
-            {"name": "@sessionId", "value": session_id},
-        ]
+        query, parameters = self.conversation_query(user_id, session_id)
         items = list(container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
-        return items
+        conversations = []
+        for header in items:
+            if header.get("doc_type") != "session":
+                conversations.append(header)  # legacy document with embedded messages
+                continue
+            range_query, range_parameters = self.message_range_query(session_id, 0, header.get("message_count", 0))
+            rows = list(container.query_items(query=range_query, parameters=range_parameters, partition_key=header["user_id"]))
+            conversations.append(self.assemble_conversation(header, rows))
+        return conversations
 
     def delete_user_conversation(self, user_id: str, session_id: str):
         container = self.get_container("ag_demo")
-        query = "SELECT * FROM c WHERE c.user_id = @userId AND c.session_id = @sessionId"
+        # Header and message items of the session
+        query = self.DELETE_ITEMS_QUERY + " AND c.session_id = @sessionId"
         parameters = [
             {"name": "@userId", "value": user_id},
             {"name": "@sessionId", "value": session_id},
         ]
-        items = list(container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
+        items = list(container.query_items(query=query, parameters=parameters, partition_key=user_id))
         if not items:
             return {"error": f"No conversation found with user_id {user_id} and session_id {session_id}."}
-        conversation = items[0]
-        response = container.delete_item(item=conversation["id"], partition_key=conversation["user_id"])
-        return response
+        self.delete_partition_items(container, user_id, [item["id"] for item in items])
+        self.decrement_conversation_stats(user_id, self.session_header_dates(items))
+        return True
 
     def delete_user_all_conversations(self, user_id: str):
         container = self.get_container("ag_demo")
-        query = "SELECT * FROM c WHERE c.user_id = @userId"
         parameters = [{"name": "@userId", "value": user_id}]
-        items = list(container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
+        items = list(container.query_items(query=self.DELETE_ITEMS_QUERY, parameters=parameters, partition_key=user_id))
         if not items:
             return {"error": f"No conversation found with user_id {user_id}."}
-        for item in items:
-            container.delete_item(item=item["id"], partition_key=item["user_id"])
+        self.delete_partition_items(container, user_id, [item["id"] for item in items])
+        self.decrement_conversation_stats(user_id, self.session_header_dates(items))
         return True
 
+    def decrement_conversation_stats(self, user_id: str, dates: List[str]):
+        """Take deleted sessions off the ag_stats counters (one decrement per counted session, on its counted_date)."""
+        container = self.get_container("ag_stats")
+        for date in dates:
+            counter = self.stats_counter_document(user_id, date, 0)
+            try:
+                container.patch_item(item=counter["id"], partition_key=counter["month"], patch_operations=self.DECREMENT_COUNT)
+            except CosmosResourceNotFoundError:
+                pass  # never counted
+            except Exception as e:
+                print(f"Warning: failed to update conversation stats: {e}")
+
+    def _retry_throttled(self, operation):
+        attempt = 0
+        while True:
+            try:
+                return operation()
+            except CosmosHttpResponseError as e:
+                delay = self.throttle_delay(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    def delete_partition_items(self, container, partition_key: str, ids: List[str]):
+        """Delete items of one partition with transactional batches of up to 100 operations."""
+        for operations in self.delete_batches(ids):
+            try:
+                self._retry_throttled(lambda: container.execute_item_batch(batch_operations=operations, partition_key=partition_key))
+            except CosmosBatchOperationError:
+                # A batch is all-or-nothing; fall back to single deletes (e.g. an item was already gone)
+                for _, (item_id,) in operations:
+                    try:
+                        self._retry_throttled(lambda: container.delete_item(item=item_id, partition_key=partition_key))
+                    except CosmosResourceNotFoundError:
+                        pass
+
     def fetch_conversation_stats(self, start_date: str, end_date: str):
         """
         Returns daily counts of conversations for the given date range grouped by date (YYYY-MM-DD) and user.
         Expects documents to have string timestamp in format 'YYYY-MM-DD HH:MM:SS'.
         """
-        container = self.get_container("ag_demo")
-        # Fetch raw rows (no GROUP BY) and aggregate in Python to avoid cross-partition GROUP BY caveats
-        query = (
-            "SELECT c.user_id, SUBSTRING(c.timestamp, 0, 10) AS date "
-            "FROM c "
-            "WHERE SUBSTRING(c.timestamp, 0, 10) >= @startDate AND SUBSTRING(c.timestamp, 0, 10) <= @endDate"
-        )
-        parameters = [
-            {"name": "@startDate", "value": start_date},
-            {"name": "@endDate", "value": end_date},
-        ]
+        container = self.get_container("ag_stats")
+        query, parameters = self.stats_counter_query(start_date, end_date)
         rows = list(
             container.query_items(
                 query=query,
@@ -240,37 +529,11 @@ class CosmosDB:
                 enable_cross_partition_query=True,
             )
         )
-        # Aggregate in Python: {(user_id, date): count}
-        counts = {}
-        for r in rows:
-            user_id = r.get("user_id")
-            date = r.get("date")
-            if not user_id or not date:
-                continue
-            key = (user_id, date)
-            counts[key] = counts.get(key, 0) + 1
-
-        # Convert to list of dicts like: {"user_id": ..., "date": "YYYY-MM-DD", "count": N}
-        items = [
-            {"user_id": k[0], "date": k[1], "count": v}
-            for k, v in counts.items()
-        ]
-        # Optional: sort by date then user for stable ordering
-        items.sort(key=lambda d: (d["date"], d["user_id"]))
-        return items
+        return self.sort_stats(rows)
 
     def create_team(self, team: dict):
         container = self.get_container("agent_teams")
-        team_document = {
-            "id": team["id"],
-            "team_id": team["team_id"],
-            "name": team["name"],
-            "agents": team["agents"],
-            "description": team.get("description"),
-            "logo": team["logo"],
-            "plan": team["plan"],
-            "starting_tasks": team["starting_tasks"],
-        }
+        team_document = self.build_team_document(team)
         response = container.create_item(body=team_document)
         return response
 
@@ -280,56 +543,408 @@ class CosmosDB:
         items = list(container.query_items(query=query, enable_cross_partition_query=True))
         return items
 
-    def get_team(self, team_id: str):
+    def upsert_teams(self, teams: List[Dict]) -> List[Dict]:
+        """Create or replace teams concurrently (COSMOS_DB_BULK_CONCURRENCY at a time)."""
         container = self.get_container("agent_teams")
-        query = "SELECT * FROM c WHERE c.team_id = @teamId"
-        parameters = [{"name": "@teamId", "value": team_id}]
-        items = list(container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
-        return items[0] if items else None
+        documents = [self.build_team_document(team) for team in teams]
+        with ThreadPoolExecutor(max_workers=self.BULK_CONCURRENCY) as executor:
+            return list(executor.map(
+                lambda doc: self._retry_throttled(lambda: container.upsert_item(body=doc)),
+                documents
+            ))
 
-    def update_team(self, team_id: str, team: dict):
-        container = self.get_container("agent_teams")
-        existing_team = self.get_team(team_id)
-        if not existing_team:
-            return {"error": "Team not found"}
-        updated_team = {**existing_team, **team}
-        response = container.replace_item(item=existing_team["id"], body=updated_team)
+    def initialize_teams(self):
+        teams = self.load_team_definitions()
+        self.upsert_teams(teams)
+        print(f"Upserted {len(teams)}/{len(teams)} items in the database.")
+        return f"Successfully created {len(teams)} teams."
+
+
+class AsyncCosmosDB(CosmosDBBase, Storage):
+    """Non-blocking variant of CosmosDB built on azure.cosmos.aio; the default
+    storage backend (STORAGE_BACKEND=cosmos, see storage.py).
+
+    Create it once with `await AsyncCosmosDB.create()` (see main.lifespan) and
+    `await close()` on shutdown. All requests share one aiohttp connection
+    pool, sized with COSMOS_DB_CONNECTION_LIMIT.
+    """
+
+    def __init__(self, client: AsyncCosmosClient, database, credential: AsyncDefaultAzureCredential, session: aiohttp.ClientSession):
+        self.client = client
+        self.database = database
+        self.credential = credential
+        self.session = session
+        self.containers = {}
+        self.team_cache = TeamCache()
+
+    @classmethod
+    async def create(cls) -> "AsyncCosmosDB":
+        load_dotenv("./.env", override=True)
+        # Get Cosmos DB account details
+        COSMOS_DB_URI = os.getenv("COSMOS_DB_URI", "https://YOURDB.documents.azure.com:443/")
+        COSMOS_DB_DATABASE = os.getenv("COSMOS_DB_DATABASE", "ag_demo")
+        connection_limit = int(os.getenv("COSMOS_DB_CONNECTION_LIMIT", "100"))
+        credential = AsyncDefaultAzureCredential()
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=connection_limit))
+        transport = AioHttpTransport(session=session, session_owner=False)
+        client = AsyncCosmosClient(COSMOS_DB_URI, credential=credential, transport=transport)
+        database = await client.create_database_if_not_exists(id=COSMOS_DB_DATABASE)
+        db = cls(client, database, credential, session)
+        # Pre-initialize default containers
+        for container_name in cls.CONTAINER_PARTITION_KEYS:
+            await db.get_container(container_name)
+        return db
+
+    async def close(self):
+        await self.client.close()
+        await self.credential.close()
+        await self.session.close()
+
+    def metrics(self) -> Dict:
+        return {"team_cache": self.team_cache.metrics()}
+
+    async def get_container(self, container_name: str = "ag_demo"):
+        if container_name in self.containers:
+            return self.containers[container_name]
+        container = await self.database.create_container_if_not_exists(
+            id=container_name,
+            partition_key=PartitionKey(path=self.CONTAINER_PARTITION_KEYS.get(container_name, "/user_id")),
+            indexing_policy=self.INDEXING_POLICIES.get(container_name),
+            offer_throughput=400
+        )
+        self.containers[container_name] = container
+        return container
+
+    @staticmethod
+    def _partition(value) -> Dict:
+        # Scope a query to one logical partition when the key is known (None would mean the null partition)
+        return {"partition_key": value} if value is not None else {}
+
+    @staticmethod
+    async def _query(container, query: str, parameters: Optional[List[Dict]] = None, **kwargs) -> List[Dict]:
+        return [item async for item in container.query_items(query=query, parameters=parameters, **kwargs)]
+
+    async def store_conversation(self, conversation: TaskResult, conversation_details: AutoGenMessage, conversation_dict: dict):
+        conversation_document_item = self.build_conversation_document(conversation, conversation_details, conversation_dict)
+        container = await self.get_container("ag_demo")
+        response = await container.create_item(body=conversation_document_item)
+        try:
+            await self.increment_conversation_stats(conversation_details.session_user, conversation_details.time)
+        except Exception as e:
+            print(f"Warning: failed to update conversation stats: {e}")
         return response
 
-    def delete_team(self, team_id: str):
-        container = self.get_container("agent_teams")
-        existing_team = self.get_team(team_id)
+    async def start_conversation(self, user_id: str, session_id: str, agents, timestamp: str, run_mode_locally: bool = False):
+        """Create the (empty) conversation document that streamed messages are appended to."""
+        container = await self.get_container("ag_demo")
+        header = self.build_conversation_header(user_id, session_id, agents, timestamp, run_mode_locally)
+        return await container.upsert_item(body=header)
+
+    async def append_conversation_messages(self, user_id: str, session_id: str, messages: List[Dict], timestamp: str = None):
+        """ConversationWriter sink: store already formatted messages as message items.
+
+        Sequence numbers are reserved by atomically incrementing the header's
+        message_count, then the items are written concurrently.
+        """
+        container = await self.get_container("ag_demo")
+        reserve = [{"op": "incr", "path": self.MESSAGE_COUNT_PATH, "value": len(messages)}]
+        try:
+            header = await container.patch_item(item=session_id, partition_key=user_id, patch_operations=reserve)
+        except CosmosResourceNotFoundError:
+            # start_conversation did not run (or failed): create the header first
+            await container.create_item(body=self.build_conversation_header(user_id, session_id, None, timestamp))
+            header = await container.patch_item(item=session_id, partition_key=user_id, patch_operations=reserve)
+        first_seq = header["message_count"] - len(messages)
+        await asyncio.gather(*(
+            self._retry_throttled(lambda item=self.build_message_item(user_id, session_id, first_seq + i, m): container.upsert_item(body=item))
+            for i, m in enumerate(messages)
+        ))
+
+    async def finish_conversation(self, user_id: str, session_id: str, timestamp: str):
+        """Called once the run produced its TaskResult (messages are already stored).
+
+        The header's counted_date is set first, only if it is not set yet, so a
+        session is counted once and deleting it takes it off the right day.
+        """
+        container = await self.get_container("ag_demo")
+        counted_date = timestamp[:10]
+        mark = [{"op": "add", "path": self.COUNTED_DATE_PATH, "value": counted_date}]
+        try:
+            await container.patch_item(item=session_id, partition_key=user_id, patch_operations=mark, filter_predicate=self.NOT_COUNTED_FILTER)
+        except CosmosResourceNotFoundError:
+            return  # deleted while it was running: nothing to count
+        except CosmosAccessConditionFailedError:
+            return  # already counted
+        await self.increment_conversation_stats(user_id, counted_date)
+
+    async def increment_conversation_stats(self, user_id: str, timestamp: str):
+        container = await self.get_container("ag_stats")
+        counter = self.stats_counter_document(user_id, timestamp[:10], 1)
+        try:
+            return await container.patch_item(item=counter["id"], partition_key=counter["month"], patch_operations=self.INCREMENT_COUNT)
+        except CosmosResourceNotFoundError:
+            try:
+                return await container.create_item(body=counter)
+            except CosmosResourceExistsError:
+                # Created concurrently by another run
+                return await container.patch_item(item=counter["id"], partition_key=counter["month"], patch_operations=self.INCREMENT_COUNT)
+
+    async def backfill_conversation_stats(self, start_date: str = "0000-00-00", end_date: str = "9999-99-99") -> int:
+        """Rebuild the ag_stats counters from a full scan of the conversations."""
+        container = await self.get_container("ag_demo")
+        query, parameters = self.stats_query(start_date, end_date)
+        rows = await self._query(container, query, parameters)
+        stats_container = await self.get_container("ag_stats")
+        buckets = self.aggregate_stats(self.counted_stats_rows(rows, start_date, end_date))
+        for bucket in buckets:
+            await stats_container.upsert_item(body=self.stats_counter_document(bucket["user_id"], bucket["date"], bucket["count"]))
+        return len(buckets)
+
+    async def fetch_user_conversatons(self, user_id: Optional[str] = None, page: int = 1, page_size: int = 20) -> Dict:
+        container = await self.get_container("ag_demo")
+        count_query, count_parameters = self.count_query(user_id)
+        count_results = await self._query(container, count_query, count_parameters)
+        total_count = count_results[0] if count_results else 0
+        page, total_pages, skip = self.page_bounds(total_count, page, page_size)
+        query, parameters = self.page_query(user_id, skip, page_size)
+        items = await self._query(container, query, parameters)
+        return {
+            "conversations": items,
+            "total_count": total_count,
+            "page": page,
+            "total_pages": total_pages
+        }
+
+    async def fetch_conversations_page(self, user_id: Optional[str] = None, cursor: Optional[str] = None, page_size: int = 20, include_count: bool = False) -> Dict:
+        container = await self.get_container("ag_demo")
+        position = self.decode_cursor(cursor) if cursor else None
+        query, parameters = self.keyset_query(user_id, position, page_size)
+        items = await self._query(container, query, parameters, **self._partition(user_id))
+        result = {
+            "conversations": items,
+            "next_cursor": self.next_cursor(items, position, page_size),
+        }
+        if include_count:
+            count_query, count_parameters = self.count_query(user_id)
+            count_results = await self._query(container, count_query, count_parameters, **self._partition(user_id))
+            result["total_count"] = count_results[0] if count_results else 0
+        return result
+
+    async def fetch_user_conversation(self, user_id: str, session_id: str, start: int = 0, limit: Optional[int] = None):
+        """Return the conversation with its messages assembled from message items.
+
+        `start`/`limit` select a range of messages so large sessions can be read page by page.
+        """
+        container = await self.get_container("ag_demo")
+        query, parameters = self.conversation_query(user_id, session_id)
+        items = await self._query(container, query, parameters, **self._partition(user_id))
+        conversations = []
+        for header in items:
+            if header.get("doc_type") != "session":
+                conversations.append(header)  # legacy document with embedded messages
+                continue
+            end = header.get("message_count", 0)
+            if limit is not None:
+                end = min(end, start + limit)
+            range_query, range_parameters = self.message_range_query(session_id, start, end)
+            rows = await self._query(container, range_query, range_parameters, partition_key=header["user_id"])
+            conversations.append(self.assemble_conversation(header, rows, start))
+        return conversations
+
+    async def delete_user_conversation(self, user_id: str, session_id: str):
+        container = await self.get_container("ag_demo")
+        # Header and message items of the session
+        query = self.DELETE_ITEMS_QUERY + " AND c.session_id = @sessionId"
+        parameters = [
+            {"name": "@userId", "value": user_id},
+            {"name": "@sessionId", "value": session_id},
+        ]
+        items = await self._query(container, query, parameters, **self._partition(user_id))
+        if not items:
+            return {"error": f"No conversation found with user_id {user_id} and session_id {session_id}."}
+        await self.delete_partition_items(container, user_id, [item["id"] for item in items])
+        await self.decrement_conversation_stats(user_id, self.session_header_dates(items))
+        return True
+
+    async def delete_user_all_conversations(self, user_id: str):
+        container = await self.get_container("ag_demo")
+        parameters = [{"name": "@userId", "value": user_id}]
+        items = await self._query(container, self.DELETE_ITEMS_QUERY, parameters, partition_key=user_id)
+        if not items:
+            return {"error": f"No conversation found with user_id {user_id}."}
+        await self.delete_partition_items(container, user_id, [item["id"] for item in items])
+        await self.decrement_conversation_stats(user_id, self.session_header_dates(items))
+        return True
+
+    async def decrement_conversation_stats(self, user_id: str, dates: List[str]):
+        """Take deleted sessions off the ag_stats counters (one decrement per counted session, on its counted_date)."""
+        container = await self.get_container("ag_stats")
+        for date in dates:
+            counter = self.stats_counter_document(user_id, date, 0)
+            try:
+                await container.patch_item(item=counter["id"], partition_key=counter["month"], patch_operations=self.DECREMENT_COUNT)
+            except CosmosResourceNotFoundError:
+                pass  # never counted
+            except Exception as e:
+                print(f"Warning: failed to update conversation stats: {e}")
+
+    async def _retry_throttled(self, operation):
+        attempt = 0
+        while True:
+            try:
+                return await operation()
+            except CosmosHttpResponseError as e:
+                delay = self.throttle_delay(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def delete_partition_items(self, container, partition_key: str, ids: List[str]):
+        """Delete items of one partition with transactional batches of up to 100 operations."""
+        for operations in self.delete_batches(ids):
+            try:
+                await self._retry_throttled(lambda: container.execute_item_batch(batch_operations=operations, partition_key=partition_key))
+            except CosmosBatchOperationError:
+                # A batch is all-or-nothing; fall back to single deletes (e.g. an item was already gone)
+                for _, (item_id,) in operations:
+                    try:
+                        await self._retry_throttled(lambda: container.delete_item(item=item_id, partition_key=partition_key))
+                    except CosmosResourceNotFoundError:
+                        pass
+
+    async def fetch_conversation_stats(self, start_date: str, end_date: str):
+        """
+        Returns daily counts of conversations for the given date range grouped by date (YYYY-MM-DD) and user.
+        Expects documents to have string timestamp in format 'YYYY-MM-DD HH:MM:SS'.
+        """
+        container = await self.get_container("ag_stats")
+        query, parameters = self.stats_counter_query(start_date, end_date)
+        rows = await self._query(container, query, parameters)
+        return self.sort_stats(rows)
+
+    async def create_team(self, team: dict):
+        container = await self.get_container("agent_teams")
+        response = await container.create_item(body=self.build_team_document(team))
+        self.team_cache.invalidate_list()
+        return self.team_cache.put(response)
+
+    async def get_teams(self):
+        if self.team_cache.list_is_fresh():
+            return self.team_cache.get_list()
+        container = await self.get_container("agent_teams")
+        counts, timestamps = await asyncio.gather(
+            self._query(container, self.TEAMS_COUNT_QUERY),
+            self._query(container, self.TEAMS_MAX_TS_QUERY),
+        )
+        version = self.teams_version(counts, timestamps)
+        cached = self.team_cache.get_list()
+        if cached is not None and version == self.team_cache.list_version:
+            self.team_cache.touch_list()
+            return cached
+        items = await self._query(container, "SELECT * FROM c")
+        return self.team_cache.put_list(items, version)
+
+    async def _read_team(self, container, team_id: str) -> Optional[Dict]:
+        item_id = self.team_cache.item_id(team_id)
+        if item_id is not None:
+            # Point read by id + partition key (1 RU)
+            try:
+                return await container.read_item(item=item_id, partition_key=team_id)
+            except CosmosResourceNotFoundError:
+                pass
+        items = await self._query(container, self.TEAM_QUERY, self.team_parameters(team_id), partition_key=team_id)
+        return items[0] if items else None
+
+    async def get_team(self, team_id: str, use_cache: bool = True):
+        entry = self.team_cache.get(team_id)
+        if use_cache and self.team_cache.is_fresh(entry):
+            return entry.doc
+        container = await self.get_container("agent_teams")
+        if entry is not None and entry.etag:
+            # Revalidate: Cosmos answers 304 Not Modified when the ETag still matches
+            try:
+                doc = await container.read_item(
+                    item=entry.doc["id"], partition_key=team_id,
+                    etag=entry.etag, match_condition=MatchConditions.IfModified
+                )
+            except CosmosResourceNotFoundError:
+                self.team_cache.invalidate(team_id)
+                return None
+            except CosmosHttpResponseError as e:
+                if e.status_code != 304:
+                    raise
+                doc = None
+            if not doc:
+                self.team_cache.touch(team_id)
+                return entry.doc
+            return self.team_cache.put(doc)
+        doc = await self._read_team(container, team_id)
+        if doc is None:
+            self.team_cache.invalidate(team_id)
+            return None
+        return self.team_cache.put(doc)
+
+    async def update_team(self, team_id: str, team: dict):
+        container = await self.get_container("agent_teams")
+        for attempt in range(2):
+            existing_team = await self.get_team(team_id, use_cache=attempt == 0)
+            if not existing_team:
+                return {"error": "Team not found"}
+            updated_team = {**existing_team, **team}
+            try:
+                # Optimistic concurrency: fails if the cached copy is stale
+                response = await container.replace_item(
+                    item=existing_team["id"], body=updated_team,
+                    etag=existing_team.get("_etag"), match_condition=MatchConditions.IfNotModified
+                )
+            except CosmosAccessConditionFailedError:
+                self.team_cache.invalidate(team_id)
+                if attempt == 1:
+                    raise
+                continue
+            self.team_cache.invalidate_list()
+            return self.team_cache.put(response)
+
+    async def delete_team(self, team_id: str):
+        container = await self.get_container("agent_teams")
+        existing_team = await self.get_team(team_id)
         if not existing_team:
             return {"error": "Team not found"}
-        response = container.delete_item(item=existing_team["id"], partition_key=existing_team["team_id"])
-        return response
+        try:
+            return await container.delete_item(item=existing_team["id"], partition_key=existing_team["team_id"])
+        finally:
+            self.team_cache.invalidate(team_id)
+
+    async def upsert_teams(self, teams: List[Dict]) -> List[Dict]:
+        """Create or replace teams concurrently (COSMOS_DB_BULK_CONCURRENCY at a time)."""
+        container = await self.get_container("agent_teams")
+        semaphore = asyncio.Semaphore(self.BULK_CONCURRENCY)
+
+        async def upsert(doc: Dict):
+            async with semaphore:
+                return await self._retry_throttled(lambda: container.upsert_item(body=doc))
+
+        responses = await asyncio.gather(*(upsert(self.build_team_document(team)) for team in teams))
+        self.team_cache.invalidate_list()
+        for response in responses:
+            self.team_cache.put(response)
+        return responses
+
+    async def initialize_teams(self):
+        teams = self.load_team_definitions()
+        await self.upsert_teams(teams)
+        print(f"Upserted {len(teams)}/{len(teams)} items in the database.")
+        return f"Successfully created {len(teams)} teams."
 
-    def initialize_teams(self):
-        teams_folder = os.path.join(os.path.dirname(__file__), "./data/teams-definitions")
-        json_files = glob.glob(os.path.join(teams_folder, "*.json"))
-        json_files.sort()
-        print(f"Found {len(json_files)} JSON files in {teams_folder}.")
-        created_items = 0
-        for file_path in json_files:
-            with open(file_path, "r") as f:
-                team = json.load(f)
-            response = self.create_team(team)
-            print(f"Created team from {os.path.basename(file_path)}")
-            created_items += 1
-        print(f"Created {created_items}/{len(json_files)} items in the database.")
-        return f"Successfully created {created_items} teams."
 if __name__ == "__main__":
+    import sys
     db = CosmosDB()
-    teams_folder = os.path.join(os.path.dirname(__file__), "./data/teams-definitions")
-    json_files = glob.glob(os.path.join(teams_folder, "*.json"))
-    json_files.sort()
-    print(f"Found {len(json_files)} JSON files in {teams_folder}.")
-    created_items = 0
-    for file_path in json_files:
-        with open(file_path, "r") as f:
-            team = json.load(f)
-        response = db.create_team(team)
-        print(f"Created team from {os.path.basename(file_path)}")
-        created_items += 1
-    print(f"Created {created_items}/{len(json_files)} items in the database.")
-    pass
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill-stats":
+        # python database.py backfill-stats -> rebuild ag_stats from ag_demo
+        print(f"Backfilled {db.backfill_conversation_stats()} daily counters.")
+    elif len(sys.argv) > 1 and sys.argv[1] == "apply-indexing":
+        # python database.py apply-indexing -> replace indexing policies of existing containers
+        db.apply_indexing_policies()
+    else:
+        db.initialize_teams()
@@ -0,0 +1,148 @@
+"""
+Per-subscriber stage between a Run and the /chat-stream HTTP response.
+
+A pump task copies the run's frames into a bounded buffer
+(SSE_SUBSCRIBER_BUFFER frames) and the response drains it, so a slow client
+only ever holds up its own buffer, never the team or the other subscribers.
+
+When the buffer is full:
+- non-essential frames (SelectSpeaker, formatter deltas, queue positions) are
+  dropped; the final replace event and later positions supersede them;
+- screenshots are kept but sent without an inline (data URI) image;
+- an essential frame first evicts a queued non-essential one, otherwise the
+  pump waits. A client that drains nothing for SSE_SLOW_CLIENT_TIMEOUT_SECONDS
+  is treated as dead: the stream is closed and its resources released.
+
+Queue-position frames are always coalesced to the latest one. When there is
+nothing to send for SSE_HEARTBEAT_SECONDS a comment heartbeat is sent, which
+keeps proxies from timing out the connection and surfaces dead sockets.
+"""
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+from typing import AsyncIterator, Deque, Tuple
+
+from run_manager import Run
+
+logger = logging.getLogger("event_stream")
+
+ESSENTIAL = "essential"
+SCREENSHOT = "screenshot"
+DROPPABLE = {"select_speaker", "delta", "queue"}
+
+HEARTBEAT_FRAME = ": heartbeat\n\n"
+
+
+def strip_image(frame: str) -> str:
+    """Return the frame without its content_image (flagged with content_image_dropped)."""
+    lines = frame.rstrip("\n").split("\n")
+    for i, line in enumerate(lines):
+        if line.startswith("data: "):
+            try:
+                data = json.loads(line[len("data: "):])
+            except json.JSONDecodeError:
+                return frame
+            if not str(data.get("content_image") or "").startswith("data:"):
+                return frame  # no image, or already a small /media reference
+            data["content_image"] = None
+            data["content_image_dropped"] = True
+            lines[i] = f"data: {json.dumps(data)}"
+            return "\n".join(lines) + "\n\n"
+    return frame
+
+
+class SubscriberStream:
+    def __init__(self, run: Run, after_id: int = 0, buffer_size: int = None, heartbeat: float = None, slow_timeout: float = None):
+        self.run = run
+        self.after_id = after_id
+        self.buffer_size = buffer_size or int(os.getenv("SSE_SUBSCRIBER_BUFFER", "100"))
+        self.heartbeat = heartbeat or float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+        self.slow_timeout = slow_timeout or float(os.getenv("SSE_SLOW_CLIENT_TIMEOUT_SECONDS", "60"))
+        self.queue: Deque[Tuple[int, str, str]] = deque()
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self.finished = False
+        self.dead = False
+        self.dropped = 0
+        self.stripped = 0
+
+    # ---------------- producer side ----------------
+    async def _pump(self) -> None:
+        follower = self.run.follow(self.after_id)
+        try:
+            async for entry in follower:
+                if not await self._offer(entry):
+                    break
+        finally:
+            await follower.aclose()
+            self.finished = True
+            self._ready.set()
+
+    def _evict_droppable(self) -> bool:
+        for queued in self.queue:
+            if queued[2] in DROPPABLE:
+                self.queue.remove(queued)
+                self.dropped += 1
+                return True
+        return False
+
+    async def _offer(self, entry: Tuple[int, str, str]) -> bool:
+        event_id, frame, kind = entry
+        if kind == "queue":
+            # Only the latest queue position matters
+            for queued in [q for q in self.queue if q[2] == "queue"]:
+                self.queue.remove(queued)
+        if len(self.queue) >= self.buffer_size:
+            if kind in DROPPABLE:
+                self.dropped += 1
+                return True
+            if kind == SCREENSHOT:
+                stripped = strip_image(frame)
+                if stripped is not frame:
+                    self.stripped += 1
+                frame = stripped
+            if not self._evict_droppable():
+                try:
+                    await asyncio.wait_for(self._wait_for_space(), self.slow_timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Closing stream of run {self.run.session_id}: client drained nothing for {self.slow_timeout:.0f}s")
+                    self.dead = True
+                    self.queue.clear()
+                    return False
+        self.queue.append((event_id, frame, kind))
+        self._ready.set()
+        return True
+
+    async def _wait_for_space(self) -> None:
+        while len(self.queue) >= self.buffer_size:
+            self._space.clear()
+            await self._space.wait()
+
+    # ---------------- consumer side ----------------
+    async def frames(self) -> AsyncIterator[str]:
+        pump = asyncio.create_task(self._pump())
+        try:
+            while True:
+                if self.queue:
+                    _, frame, _ = self.queue.popleft()
+                    self._space.set()
+                    yield frame
+                    continue
+                if self.finished or self.dead:
+                    break
+                self._ready.clear()
+                try:
+                    await asyncio.wait_for(self._ready.wait(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield HEARTBEAT_FRAME
+        finally:
+            # Client left (or the run ended): stop following the run
+            pump.cancel()
+            try:
+                await pump
+            except asyncio.CancelledError:
+                pass
+            if self.dropped or self.stripped:
+                logger.info(f"Stream of run {self.run.session_id}: dropped {self.dropped}, images stripped {self.stripped}")
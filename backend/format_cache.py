@@ -0,0 +1,141 @@
+"""
+Content-addressed cache for formatter results (main.formatMessage).
+
+Keys are a SHA-256 of (model, system_prompt, raw_text), so repeated ledgers,
+plans and page summaries are formatted once. The in-process tier is an LRU
+with a TTL (FORMAT_CACHE_SIZE entries, FORMAT_CACHE_TTL_SECONDS). Setting
+FORMAT_CACHE_PATH adds a persistent SQLite tier shared by all uvicorn workers
+on the host; a hit there is copied into the in-process tier.
+"""
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS format_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class _PersistentTier:
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        self.purge()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        row = self._connection().execute(
+            "SELECT value, expires FROM format_cache WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def put(self, key: str, value: str, expires: float) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO format_cache (key, value, expires) VALUES (?, ?, ?)", (key, value, expires)
+            )
+
+    def purge(self) -> int:
+        conn = self._connection()
+        with conn:
+            return conn.execute("DELETE FROM format_cache WHERE expires <= ?", (time.time(),)).rowcount
+
+
+class FormatCache:
+    def __init__(self, max_entries: int = None, ttl: float = None, path: str = None):
+        self.max_entries = max_entries or int(os.getenv("FORMAT_CACHE_SIZE", "1024"))
+        self.ttl = ttl if ttl is not None else float(os.getenv("FORMAT_CACHE_TTL_SECONDS", "86400"))
+        path = path if path is not None else os.getenv("FORMAT_CACHE_PATH", "")
+        self.persistent = _PersistentTier(path) if path else None
+        # key -> (value, expires as wall-clock time, so it means the same in both tiers)
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.persistent_errors = 0
+
+    @staticmethod
+    def key(model: str, system_prompt: str, raw_text: str) -> str:
+        digest = hashlib.sha256()
+        for part in (model, system_prompt, raw_text):
+            data = part.encode("utf-8")
+            # Length prefix keeps ("ab", "c") and ("a", "bc") apart
+            digest.update(len(data).to_bytes(8, "big"))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def _put_local(self, key: str, value: str, expires: float) -> None:
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            del self._entries[key]
+        if self.persistent is not None:
+            try:
+                entry = await asyncio.to_thread(self.persistent.get, key)
+            except sqlite3.Error:
+                self.persistent_errors += 1
+                entry = None
+            if entry is not None:
+                self._put_local(key, *entry)
+                self.persistent_hits += 1
+                return entry[0]
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, value: str) -> None:
+        expires = time.time() + self.ttl
+        self._put_local(key, value, expires)
+        if self.persistent is not None:
+            try:
+                await asyncio.to_thread(self.persistent.put, key, value, expires)
+            except sqlite3.Error:
+                self.persistent_errors += 1
+
+    def metrics(self) -> Dict:
+        lookups = self.hits + self.persistent_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.persistent_hits) / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "persistent": self.persistent.path if self.persistent is not None else None,
+            "persistent_errors": self.persistent_errors,
+        }
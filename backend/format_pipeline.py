@@ -0,0 +1,143 @@
+"""
+Pipelined formatting of orchestrator and WebSurfer messages.
+
+With ORCHESTRATOR_FORMAT_MODE=pipelined, /chat-stream sends the raw event right
+away and the formatter (a chat completion, see main.formatMessage) runs in the
+background. When it finishes, a `replace` event carrying the original
+`event_id` and the formatted content is sent on the same stream.
+
+ORCHESTRATOR_FORMAT_MODE=streaming additionally uses the streaming completions
+API (main.formatMessageStream): every chunk is sent as a `delta` event for the
+same `event_id` as soon as it arrives, and the final `replace` event carries the
+complete text. `offset` is the length of the formatted text before the chunk,
+so a client replaces the raw content on offset 0 and appends after that.
+
+Guarantees:
+- a replace event is always sent after the event it replaces;
+- replace events are sent in the order of the original events;
+- messages are persisted in stream order, formatted ones with their formatted content;
+- at most ORCHESTRATOR_FORMAT_CONCURRENCY formatter calls run at once per session.
+
+When the run is cancelled, cancel() drops the pending formatter calls instead of
+waiting for them; the queued messages are still persisted, with raw content.
+"""
+import asyncio
+import logging
+import os
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+from schemas import AutoGenMessage
+
+logger = logging.getLogger("format_pipeline")
+
+# formatter(raw_content, system_prompt) -> formatted content
+Formatter = Callable[[str, str], Awaitable[str]]
+# stream_formatter(raw_content, system_prompt) -> chunks of formatted content
+StreamFormatter = Callable[[str, str], AsyncIterator[str]]
+
+
+def orchestrator_format_mode() -> str:
+    """inline (default): format before the event is sent; pipelined: send raw, replace later;
+    streaming: like pipelined, with delta events while the completion streams."""
+    return os.getenv("ORCHESTRATOR_FORMAT_MODE", "inline").lower()
+
+
+def replace_event(message: AutoGenMessage) -> dict:
+    return {
+        "type": "replace",
+        "event_id": message.event_id,
+        "session_id": message.session_id,
+        "content": message.content,
+    }
+
+
+def delta_event(message: AutoGenMessage, offset: int, chunk: str) -> dict:
+    return {
+        "type": "delta",
+        "event_id": message.event_id,
+        "session_id": message.session_id,
+        "offset": offset,
+        "content": chunk,
+    }
+
+
+class FormatPipeline:
+    def __init__(
+        self,
+        formatter: Formatter,
+        emit: Callable[[dict], Awaitable[None]],
+        persist: Callable[[AutoGenMessage], Awaitable[None]],
+        concurrency: int = None,
+        stream_formatter: StreamFormatter = None,
+    ) -> None:
+        self.formatter = formatter
+        self.stream_formatter = stream_formatter
+        self.emit = emit
+        self.persist = persist
+        self.concurrency = concurrency or int(os.getenv("ORCHESTRATOR_FORMAT_CONCURRENCY", "2"))
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        # Last step of the ordered chain; every new step waits for it
+        self._tail: Optional[asyncio.Task] = None
+        self._format_tasks: List[asyncio.Task] = []
+
+    def add(self, message: AutoGenMessage, system_prompt: Optional[str] = None) -> None:
+        """Queue a message in stream order; with a system prompt it is also formatted."""
+        format_task = None
+        if system_prompt is not None:
+            format_task = asyncio.create_task(self._format(message, system_prompt))
+            self._format_tasks.append(format_task)
+        self._tail = asyncio.create_task(self._step(self._tail, message, format_task))
+
+    async def _format(self, message: AutoGenMessage, system_prompt: str) -> str:
+        raw_content = message.content
+        async with self._semaphore:
+            if self.stream_formatter is None:
+                return await self.formatter(raw_content, system_prompt)
+            parts = []
+            offset = 0
+            try:
+                async for chunk in self.stream_formatter(raw_content, system_prompt):
+                    if not chunk:
+                        continue
+                    await self.emit(delta_event(message, offset, chunk))
+                    parts.append(chunk)
+                    offset += len(chunk)
+            except Exception as e:
+                # Deltas may already be on the client; the replace event restores the raw content
+                logger.warning(f"Streaming format of event {message.event_id} failed: {e}")
+                return raw_content
+            return "".join(parts) or raw_content
+
+    async def _step(self, previous: Optional[asyncio.Task], message: AutoGenMessage, format_task: Optional[asyncio.Task]) -> None:
+        if previous is not None:
+            await previous
+        try:
+            if format_task is not None:
+                try:
+                    message.content = await format_task
+                except asyncio.CancelledError:
+                    if not format_task.cancelled():
+                        raise  # this step itself was cancelled
+                    # Run cancelled: keep the raw content; undo any deltas the client already has
+                    if self.stream_formatter is not None:
+                        await self.emit(replace_event(message))
+                except Exception as e:
+                    # Fail open: the raw event the client already has stays as is
+                    logger.warning(f"Formatting event {message.event_id} failed: {e}")
+                else:
+                    await self.emit(replace_event(message))
+            await self.persist(message)
+        except Exception as e:
+            logger.error(f"Pipeline step for event {message.event_id} failed: {e}")
+
+    async def join(self) -> None:
+        """Wait until every queued message is formatted, emitted and persisted."""
+        if self._tail is not None:
+            await self._tail
+        self._format_tasks = [t for t in self._format_tasks if not t.done()]
+
+    async def cancel(self) -> None:
+        """Drop pending formatter calls and persist the queued messages as they are (run cancelled)."""
+        for task in self._format_tasks:
+            task.cancel()
+        await self.join()
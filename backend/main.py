@@ -1,19 +1,30 @@
 # File: main.py
-from fastapi import FastAPI, Depends, UploadFile, HTTPException, Query, File, Form
+from fastapi import FastAPI, Depends, UploadFile, HTTPException, Query, File, Form, Header, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2AuthorizationCodeBearer
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 from azure.storage.blob import BlobServiceClient
 # from sqlalchemy.orm import Session
 import schemas, crud
-from database import CosmosDB
+from storage import create_storage
+from conversation_writer import ConversationWriter, crud_sink
+from format_pipeline import FormatPipeline, orchestrator_format_mode
+from format_cache import FormatCache
+from run_manager import CrudEventSpill, Run, RunManager
+from event_stream import SubscriberStream
+from ws_stream import WebSocketStream
+from media_store import DIGEST_PATTERN, create_media_store
+from screenshot_pipeline import Screenshot, ScreenshotProcessor
+from session_registry import SessionRegistry
+from admission import AdmissionController, agent_resources
+from message_normalizer import normalize_message
 import os
 import uuid
 from contextlib import asynccontextmanager
 from fastapi.responses import StreamingResponse, Response
 import json, asyncio
 from magentic_one_helper import MagenticOneHelper
-from autogen_agentchat.messages import MultiModalMessage, TextMessage, ToolCallExecutionEvent, ToolCallRequestEvent, SelectSpeakerEvent, ToolCallSummaryMessage
+from autogen_agentchat.messages import MultiModalMessage, TextMessage, ToolCallSummaryMessage
 from autogen_agentchat.base import TaskResult
 from magentic_one_helper import generate_session_name
 import aisearch
@@ -21,7 +32,7 @@ import logging
 
 from datetime import datetime, timedelta 
 from schemas import AutoGenMessage
-from typing import List
+from typing import List, Optional
 import time
 
 print("Starting the server...")
@@ -29,7 +40,6 @@ print("Starting the server...")
 #print(f'COSMOS_DB_URI:{os.getenv("COSMOS_DB_URI")}')
 #print(f'AZURE_SEARCH_SERVICE_ENDPOINT:{os.getenv("AZURE_SEARCH_SERVICE_ENDPOINT")}')
 
-session_data = {}
 MAGENTIC_ONE_DEFAULT_AGENTS = [
             {
             "input_key":"0001",
@@ -85,15 +95,31 @@ DEFAULT_SYS_PROMPT_MESSAGE_DECORATOR_WEBSURFER = (
         "Rules:\n"
         "1. Summarize the content in a concise manner keep it brief.\n"
     )
+
+FORMATTER_MODEL = "gpt-4o-mini"
 # Lifespan handler for startup/shutdown events
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup code: initialize database and configure logging
     # app.state.db = None
-    app.state.db = CosmosDB()
+    # STORAGE_BACKEND=cosmos|local|memory (see storage.py)
+    app.state.db = await create_storage()
     logging.basicConfig(level=logging.WARNING,
                         format='%(levelname)s: %(asctime)s - %(message)s')
-    print("Database initialized.")
+    print(f"Database initialized ({app.state.db.name}).")
+    # Streamed messages go to the local log and are appended to the storage backend as the run progresses
+    app.state.conversation_writer = ConversationWriter(sinks=[crud_sink, app.state.db.append_conversation_messages])
+    # Agent runs, independent of the SSE connections that follow them
+    # The registry lets /stop on any worker reach the worker that owns the run
+    app.state.session_registry = SessionRegistry()
+    await asyncio.to_thread(app.state.session_registry.abandon_stale)
+    app.state.run_manager = RunManager(spill=CrudEventSpill(), registry=app.state.session_registry)
+    # Caps concurrent runs per worker, user and agent; the rest wait in a fair queue
+    app.state.admission = AdmissionController()
+    # Screenshots and executor images, stored once by content hash
+    app.state.media_store = create_media_store()
+    # Formatter results keyed by (model, prompt, content)
+    app.state.format_cache = FormatCache()
     # Initialize and cache OpenAI client (best-effort)
     app.state.openai_client = None
     try:
@@ -103,7 +129,13 @@ async def lifespan(app: FastAPI):
         print(f"Warning: Failed to initialize OpenAI client at startup: {e}")
     yield
     # Shutdown code (optional)
+    # Stop running teams, then persist any buffered conversation messages
+    await app.state.run_manager.shutdown()
+    await app.state.conversation_writer.close()
+    if app.state.media_store is not None:
+        await app.state.media_store.close()
     # Cleanup database connection
+    await app.state.db.close()
     app.state.db = None
     app.state.openai_client = None
 
@@ -232,6 +264,16 @@ async def formatMessage(raw_content: str, system_prompt: str) -> str:
             logger.debug("Formatter disabled via feature flag", extra={"event": "flag_disabled"})
             return raw_text
 
+        # Identical content was formatted before (this run, an earlier run or another worker)
+        cache = getattr(app.state, "format_cache", None)
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.key(FORMATTER_MODEL, system_prompt, raw_text)
+            cached = await cache.get(cache_key)
+            if cached is not None:
+                logger.debug("Formatter cache hit", extra={"event": "cache_hit"})
+                return cached
+
         # Reuse cached client if available else create on-demand
         client = getattr(app.state, "openai_client", None)
         if client is None:
@@ -249,7 +291,7 @@ async def formatMessage(raw_content: str, system_prompt: str) -> str:
         })
         try:
             chat_response = await client.chat.completions.create(
-                model="gpt-4o-mini",
+                model=FORMATTER_MODEL,
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": raw_text},
@@ -292,6 +334,8 @@ async def formatMessage(raw_content: str, system_prompt: str) -> str:
             "api": "chat.completions.create",
             "output_chars": len(formatted)
         })
+        if cache is not None:
+            await cache.put(cache_key, formatted)
         return formatted
     except Exception as e:
         logging.getLogger("formatter.orchestrator").error("Formatter exception", extra={
@@ -301,6 +345,72 @@ async def formatMessage(raw_content: str, system_prompt: str) -> str:
         return f"{raw_content if isinstance(raw_content, str) else str(raw_content)}\n\n[Formatting error: {e}]"
 
 
+async def formatMessageStream(raw_content: str, system_prompt: str):
+    """Streaming variant of formatMessage: yields the formatted content chunk by chunk.
+
+    Cache hits and the fallbacks of formatMessage (flag off, no client, empty
+    output) are yielded as a single chunk. An error after the first chunk is
+    raised so the caller can restore the raw content.
+    """
+    logger = logging.getLogger("formatter.orchestrator")
+    raw_text = "" if raw_content is None else (raw_content if isinstance(raw_content, str) else str(raw_content))
+    client = getattr(app.state, "openai_client", None)
+    if not raw_text or not orchestrator_formatting_enabled() or client is None:
+        # Nothing to stream; formatMessage handles these cases (and logs them)
+        yield await formatMessage(raw_content, system_prompt)
+        return
+
+    cache = getattr(app.state, "format_cache", None)
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(FORMATTER_MODEL, system_prompt, raw_text)
+        cached = await cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    try:
+        chat_stream = await client.chat.completions.create(
+            model=FORMATTER_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": raw_text},
+            ],
+            max_tokens=1200,
+            temperature=0.2,
+            stream=True,
+        )
+    except Exception as api_err:
+        logger.error("Chat completion API exception", extra={
+            "event": "api_call_error",
+            "api": "chat.completions.create",
+            "error": str(api_err)
+        })
+        yield raw_text  # Fail open – return original content
+        return
+
+    parts = []
+    async for chunk in chat_stream:
+        # Azure sends chunks without choices (e.g. content filter results)
+        if not getattr(chunk, "choices", None):
+            continue
+        delta = getattr(chunk.choices[0], "delta", None)
+        text = getattr(delta, "content", None) if delta is not None else None
+        if text:
+            parts.append(text)
+            yield text
+
+    formatted = "".join(parts).strip()
+    if not formatted:
+        logger.info("Chat completion returned empty content; using raw text.", extra={
+            "event": "empty_output"
+        })
+        yield raw_text
+        return
+    if cache is not None:
+        await cache.put(cache_key, formatted)
+
+
 # ----------------------------- CSV helpers -----------------------------
 def _markdown_table_from_csv_rows(
     rows: list[list[str]],
@@ -463,106 +573,80 @@ def _decorate_content(content: str) -> str:
     return transformed
 
 
-async def display_log_message(log_entry, logs_dir, session_id, user_id, conversation=None):
+async def persist_message(message: AutoGenMessage):
+    # Persisted in the background by the write-behind buffer
+    await app.state.conversation_writer.enqueue(
+            user_id=message.session_user,
+            session_id=message.session_id,
+            message=message.to_json(),
+            timestamp=message.time
+        )
+
+async def display_log_message(log_entry, logs_dir, session_id, user_id, conversation=None, event_id=None, pipeline: FormatPipeline = None, screenshot: Screenshot = None):
     _log_entry_json = log_entry
     _user_id = user_id
+    # With a pipeline, formatting runs after the raw event is sent (see format_pipeline.py)
+    _format_prompt = None
     
     _response = AutoGenMessage(
         time=get_current_time(),
         session_id=session_id,
-        session_user=_user_id
+        session_user=_user_id,
+        event_id=event_id
         )
 
-    # Check if the message is a TaskResult class
-    if isinstance(_log_entry_json, TaskResult):
-        _response.type = "TaskResult"
-        _response.source = "TaskResult"
-        _response.content = _log_entry_json.messages[-1].content
-        _response.stop_reason = _log_entry_json.stop_reason
-        app.state.db.store_conversation(_log_entry_json, _response, conversation)
-
-    elif isinstance(_log_entry_json, MultiModalMessage):
-        _response.type = _log_entry_json.type
-        _response.source = _log_entry_json.source
-        if _log_entry_json.source == "WebSurfer" and orchestrator_formatting_enabled():
+    # Fields shared with the storage path; stream-only formatting is applied below
+    normalize_message(_log_entry_json, _response, include_image=screenshot is None)
+
+    if isinstance(_log_entry_json, MultiModalMessage):
+        if _log_entry_json.source == "WebSurfer" and orchestrator_formatting_enabled() and pipeline is not None:
+            _format_prompt = DEFAULT_SYS_PROMPT_MESSAGE_DECORATOR_WEBSURFER
+        elif _log_entry_json.source == "WebSurfer" and orchestrator_formatting_enabled():
             _response.content = await formatMessage(_log_entry_json.content[0], DEFAULT_SYS_PROMPT_MESSAGE_DECORATOR_WEBSURFER)
-        else:
-            _response.content = _log_entry_json.content[0] # text without image
-        _response.content_image = _log_entry_json.content[1].data_uri # TODO: base64 encoded image -> text / serialize
+        if screenshot is not None:
+            # Downscaled/recompressed by the screenshot pipeline
+            _response.content_image = screenshot.data_uri
+            _response.content_thumbnail = screenshot.thumbnail_uri
 
     elif isinstance(_log_entry_json, TextMessage):
-        _response.type = _log_entry_json.type
-        _response.source = _log_entry_json.source
-        # Base content assignment (may be overridden below for specific sources)
-        _response.content = _log_entry_json.content
         # Special formatting for orchestrator messages
-        if _log_entry_json.source == "MagenticOneOrchestrator" and orchestrator_formatting_enabled():
+        if _log_entry_json.source == "MagenticOneOrchestrator" and orchestrator_formatting_enabled() and pipeline is not None:
+            _format_prompt = DEFAULT_SYS_PROMPT_MESSAGE_DECORATOR_ORCHESTRATOR
+        elif _log_entry_json.source == "MagenticOneOrchestrator" and orchestrator_formatting_enabled():
             _response.content = await formatMessage(_log_entry_json.content, DEFAULT_SYS_PROMPT_MESSAGE_DECORATOR_ORCHESTRATOR)
-        # Custom logic for Executor with base64 image
-        if _log_entry_json.source == "Executor":
-            import ast
-            import re
-            content = _log_entry_json.content
-            try:
-                if isinstance(content, str) and "'type': 'image'" in content and "'base64_data':" in content:
-                    pattern = r"\{[^{}]*'type': 'image'[^{}]*'base64_data':[^{}]*\}"
-                    match = re.search(pattern, content)
-                    if match:
-                        img_dict_str = match.group(0)
-                        img_dict = ast.literal_eval(img_dict_str)
-                        if (
-                            isinstance(img_dict, dict)
-                            and img_dict.get('type') == 'image'
-                            and img_dict.get('format') == 'png'
-                            and 'base64_data' in img_dict
-                        ):
-                            _response.content_image = f"data:image/png;base64,{img_dict['base64_data']}"
-                            # Remove the dict substring from the content
-                            cleaned_content = content.replace(img_dict_str, "").strip()
-                            _response.content = cleaned_content
-            except Exception:
-                pass
-
-    elif isinstance(_log_entry_json, ToolCallExecutionEvent):
-        _response.type = _log_entry_json.type
-        _response.source = _log_entry_json.source
-        _response.content = _log_entry_json.content[0].content # tool execution
-
-    elif isinstance(_log_entry_json, ToolCallRequestEvent):
-        # _models_usage = _log_entry_json.models_usage
-        _response.type = _log_entry_json.type
-        _response.source = _log_entry_json.source
-        _response.content = _log_entry_json.content[0].arguments # tool execution
-
-    elif isinstance(_log_entry_json, SelectSpeakerEvent):
-        _response.type = _log_entry_json.type
-        _response.source = _log_entry_json.source
-        _response.content = _log_entry_json.content[0]
 
     elif isinstance(_log_entry_json, ToolCallSummaryMessage):
-        _response.type = _log_entry_json.type
-        _response.source = _log_entry_json.source
-
         # Special handling for data_provider tool to decorate content -> convert CSV to Markdown table
         if (_log_entry_json.tool_calls[0].name == "data_provider"):
             _response.content = _decorate_content(_log_entry_json.content)
-        else:
-            _response.content = _log_entry_json.content
 
-    else:
-        _response.type = "N/A"
-        _response.source = "N/A"
-        _response.content = "Agents mumbling."
+    # Images go to the media store; the message keeps a /media/<sha256> reference
+    media_store = getattr(app.state, "media_store", None)
+    if screenshot is not None and screenshot.duplicate and media_store is None:
+        # Page unchanged since the last screenshot: don't send the same image inline again
+        _response.content_image = None
+        _response.content_thumbnail = None
+    if _response.content_image and media_store is not None:
+        try:
+            _response.content_image = await media_store.externalize(_response.content_image)
+            _response.content_thumbnail = await media_store.externalize(_response.content_thumbnail)
+        except Exception as e:
+            logging.getLogger("media_store").warning(f"Keeping image inline for session {session_id}: {e}")
 
-    _ = crud.save_message(
-            id=None, # it is auto-generated
-            user_id=_user_id,
-            session_id=session_id,
-            message=_response.to_json(),
-            agents=None,
-            run_mode_locally=None,
-            timestamp=_response.time
-        )
+    if pipeline is not None:
+        # Persisted (and formatted) in stream order by the pipeline
+        pipeline.add(_response, _format_prompt)
+    else:
+        await persist_message(_response)
+    if isinstance(_log_entry_json, TaskResult):
+        # Run finished: make sure the whole conversation is stored, then count the run
+        if pipeline is not None:
+            await pipeline.join()
+        await app.state.conversation_writer.close_session(_user_id, session_id)
+        try:
+            await app.state.db.finish_conversation(_user_id, session_id, _response.time)
+        except Exception as e:
+            print(f"Warning: failed to finish conversation {session_id}: {e}")
 
     return _response
 
@@ -646,27 +730,18 @@ async def chat_endpoint(
     return db_message
 
 
-# Streaming Chat Endpoint
-@app.get("/chat-stream")
-async def chat_stream(
-    session_id: str = Query(...),
-    user_id: str = Query(...),
-    # db: Session = Depends(get_db),
-    user: dict = Depends(validate_token)
-):
-    
-   
-    logger = logging.getLogger("chat_stream")
-    logger.setLevel(logging.WARNING)
-    logger.info(f"Chat stream started for session_id: {session_id} and user_id: {user_id}")
-    # create folder for logs if not exists
-    logs_dir="./logs"
-    if not os.path.exists(logs_dir):    
-        os.makedirs(logs_dir)
-
-    # get the conversation from the database using user and session id
-    conversation = crud.get_conversation(user_id, session_id)
-    logger.info(f"Conversation retrieved: {conversation}")
+def event_kind(message: AutoGenMessage) -> str:
+    # What a slow subscriber may drop or coalesce (see event_stream.py)
+    if message.type == "SelectSpeakerEvent":
+        return "select_speaker"
+    if message.content_image:
+        return "screenshot"
+    return "essential"
+
+
+async def execute_run(run: Run, conversation: dict, logs_dir: str):
+    """Run the team for one session and publish its events on `run` (see run_manager.py)."""
+    session_id, user_id = run.session_id, run.user_id
     # get first message from the conversation
     first_message = conversation["messages"][0]
     # get the task from the first message as content
@@ -676,6 +751,20 @@ async def chat_stream(
     _run_locally = conversation["run_mode_locally"]
     _agents = conversation["agents"]
 
+    # Wait for a slot before starting browsers, executors and model clients
+    admission = app.state.admission
+    ticket = admission.submit(user_id, agent_resources(_agents))
+    try:
+        async for position in admission.wait(ticket):
+            run.publish(json.dumps({"type": "queue", "session_id": session_id, "position": position}), event="queue", kind="queue")
+        await run_team(run, conversation, logs_dir, task, _run_locally, _agents)
+    finally:
+        admission.release(ticket)
+
+
+async def run_team(run: Run, conversation: dict, logs_dir: str, task: str, _run_locally, _agents):
+    logger = logging.getLogger("chat_stream")
+    session_id, user_id = run.session_id, run.user_id
 
     #  Initialize the MagenticOne system with user_id
     magentic_one = MagenticOneHelper(logs_dir=logs_dir, save_screenshots=False, run_locally=_run_locally, user_id=user_id)
@@ -684,32 +773,198 @@ async def chat_stream(
     logger.info(f"Initialized MagenticOne with agents: {len(_agents)} and session_id: {session_id} and user_id: {user_id}")
 
     stream, cancellation_token = magentic_one.main(task = task)
+    run.cancellation_token = cancellation_token
     logger.info(f"Stream and cancellation token created for task: {task}")
 
+    # Messages are appended to this document incrementally by the conversation writer
+    try:
+        await app.state.db.start_conversation(
+            user_id=user_id,
+            session_id=session_id,
+            agents=_agents,
+            timestamp=conversation["timestamp"],
+            run_mode_locally=_run_locally
+        )
+    except Exception as e:
+        logger.warning(f"Failed to create conversation document for session {session_id}: {e}")
+
+    pipeline = None
+    if orchestrator_format_mode() in ("pipelined", "streaming") and orchestrator_formatting_enabled():
+        async def emit_format_event(event: dict):
+            # "replace" or "delta"
+            run.publish(json.dumps(event), event=event["type"], kind="delta" if event["type"] == "delta" else "essential")
+
+        pipeline = FormatPipeline(
+            formatter=formatMessage,
+            emit=emit_format_event,
+            persist=persist_message,
+            stream_formatter=formatMessageStream if orchestrator_format_mode() == "streaming" else None,
+        )
 
-    async def event_generator(stream, conversation):
-
+    screenshots = ScreenshotProcessor()
+    try:
+        event_id = 0
         async for log_entry in stream:
-            json_response = await display_log_message(log_entry=log_entry, logs_dir=logs_dir, session_id=magentic_one.session_id, conversation=conversation, user_id=user_id)    
-            yield f"data: {json.dumps(json_response.to_json())}\n\n"
+            screenshot = await screenshots.process(log_entry)
+            json_response = await display_log_message(log_entry=log_entry, logs_dir=logs_dir, session_id=magentic_one.session_id, conversation=conversation, user_id=user_id, event_id=str(event_id), pipeline=pipeline, screenshot=screenshot)
+            event_id += 1
+            # Published before any replace/delta of the same event (publish never waits);
+            # the encoding is cached and reused when the message is persisted
+            run.publish(json_response.encode(), kind=event_kind(json_response))
+    finally:
+        # Run ended, failed or was cancelled: finish pending formatting (or, after /stop,
+        # drop it and keep the raw content), then persist the buffer
+        if pipeline is not None:
+            try:
+                if run.cancel_requested:
+                    await pipeline.cancel()
+                else:
+                    await pipeline.join()
+            except asyncio.CancelledError:
+                pass
+        await app.state.conversation_writer.close_session(user_id, magentic_one.session_id)
+        if screenshots.processed:
+            logger.info(f"Screenshots for session {session_id}: {screenshots.metrics()}")
 
 
-    return StreamingResponse(event_generator(stream, conversation), media_type="text/event-stream")
+# Streaming Chat Endpoint
+async def attach_run(session_id: str, user_id: str, after_id: int) -> Optional[Run]:
+    """The session's run in this worker, starting it if needed; None when a reconnect finds no run."""
+    logger = logging.getLogger("chat_stream")
 
-@app.get("/stop")
-async def stop(session_id: str = Query(...)):
+    # A reconnect attaches to the run that is already going instead of starting a new one
+    run = app.state.run_manager.get(session_id)
+    if run is None:
+        owner = await asyncio.to_thread(app.state.session_registry.active_owner, session_id)
+        if owner is not None and owner != app.state.session_registry.owner:
+            # Another worker is running this session: starting it here would run the team twice,
+            # and answering "ended" would stop a reconnecting client for good. The client retries
+            # until it reaches the owner (immediately with sticky sessions in front of the workers).
+            raise HTTPException(
+                status_code=409,
+                detail=f"Session {session_id} is running on worker {owner}",
+                headers={"Retry-After": "1"},
+            )
+        if after_id:
+            # Reconnect and nobody is running the session any more: the run has ended
+            return None
+        if app.state.admission.queue_full():
+            raise HTTPException(status_code=503, detail="Too many runs waiting; try again later", headers={"Retry-After": "30"})
+        # create folder for logs if not exists
+        logs_dir="./logs"
+        if not os.path.exists(logs_dir):    
+            os.makedirs(logs_dir)
+
+        # get the conversation from the database using user and session id
+        conversation = crud.get_conversation(user_id, session_id)
+        logger.info(f"Conversation retrieved: {conversation}")
+        if not conversation or not conversation.get("messages"):
+            raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+        # Claim the session atomically: the check above can race with another worker starting it
+        registry = app.state.session_registry
+        owner = await asyncio.to_thread(registry.claim, session_id, user_id)
+        if owner is not None:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Session {session_id} is running on worker {owner}",
+                headers={"Retry-After": "1"},
+            )
+        try:
+            run = app.state.run_manager.start(
+                session_id, user_id, lambda run: execute_run(run, conversation, logs_dir)
+            )
+        except Exception:
+            await asyncio.to_thread(registry.finish, session_id, "failed")
+            raise
+    return run
+
+async def stop_session(session_id: str) -> dict:
     try:
         print("Stopping session:", session_id)
-        cancellation_token = session_data[session_id].get("cancellation_token")
-        if (cancellation_token):
-            cancellation_token.cancel()
+        if app.state.run_manager.cancel(session_id):
             return {"status": "success", "message": f"Session {session_id} cancelled successfully."}
+        # Not running in this worker: ask the owner through the registry
+        owner = await asyncio.to_thread(app.state.session_registry.request_stop, session_id)
+        if owner is not None:
+            return {"status": "success", "message": f"Stop requested for session {session_id} on worker {owner}."}
         else:
-            return {"status": "error", "message": "Cancellation token not found."}
+            return {"status": "error", "message": "No active run found for this session."}
     except Exception as e:
         print(f"Error stopping session {session_id}: {str(e)}")
         return {"status": "error", "message": f"Error stopping session: {str(e)}"}
 
+@app.get("/chat-stream")
+async def chat_stream(
+    session_id: str = Query(...),
+    user_id: str = Query(...),
+    # db: Session = Depends(get_db),
+    user: dict = Depends(validate_token),
+    last_event_id: Optional[str] = Header(None),
+    # Same as the header, for a new EventSource opened by the client after a 409 (see attach_run)
+    resume_from: Optional[str] = Query(None, alias="last_event_id")
+):
+    
+   
+    logger = logging.getLogger("chat_stream")
+    logger.setLevel(logging.WARNING)
+    logger.info(f"Chat stream started for session_id: {session_id} and user_id: {user_id}")
+
+    # EventSource sends the id of the last frame it received when it reconnects
+    try:
+        after_id = int(last_event_id or resume_from or 0)
+    except ValueError:
+        after_id = 0
+
+    run = await attach_run(session_id, user_id, after_id)
+    if run is None:
+        # Reconnect after the run ended: 204 tells EventSource to stop retrying
+        return Response(status_code=204)
+
+    # Bounded per-client buffer with heartbeats, so a slow client only delays itself
+    return StreamingResponse(SubscriberStream(run, after_id).frames(), media_type="text/event-stream")
+
+@app.websocket("/ws/chat-stream")
+async def chat_stream_ws(
+    websocket: WebSocket,
+    session_id: str = Query(...),
+    user_id: str = Query(...),
+    last_event_id: int = Query(0),
+    user: dict = Depends(validate_token),
+):
+    """The /chat-stream events plus stop/pause/ack/resume control messages on one connection (see ws_stream.py)."""
+    await websocket.accept()
+    try:
+        run = await attach_run(session_id, user_id, last_event_id)
+    except HTTPException as e:
+        # Same statuses as /chat-stream, as application close codes (4404, 4409, 4503);
+        # on 4409 the client reconnects until it reaches the worker that owns the run
+        await websocket.send_json({"type": "error", "status": e.status_code, "detail": e.detail})
+        await websocket.close(code=4000 + e.status_code)
+        return
+    if run is None:
+        await websocket.send_json({"type": "end"})
+        await websocket.close()
+        return
+    await WebSocketStream(websocket, run, last_event_id, lambda: stop_session(session_id)).serve()
+
+@app.get("/stop")
+async def stop(session_id: str = Query(...)):
+    return await stop_session(session_id)
+
+@app.get("/session")
+async def session_status(session_id: str = Query(...)):
+    # Owner worker, state, start time and last event of a run (from the shared registry)
+    session = await asyncio.to_thread(app.state.session_registry.get, session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+    # Running on a live worker: a client whose stream failed should reconnect
+    active = await asyncio.to_thread(app.state.session_registry.active_owner, session_id) is not None
+    return {**session, "active": active}
+
+@app.get("/metrics/runs")
+async def run_metrics():
+    return {**app.state.run_manager.metrics(), "admission": app.state.admission.metrics()}
+
 # New endpoint to retrieve all conversations with pagination.
 @app.post("/conversations")
 async def list_all_conversations(
@@ -717,25 +972,43 @@ async def list_all_conversations(
     user: dict = Depends(validate_token)
     ):
     try:
-        user_id = request_data.get("user_id")
-        page = request_data.get("page", 1)
+        # Scoped to the user's partition; without a user_id all users are listed (cross-partition)
+        user_id = request_data.get("user_id") or None
         page_size = request_data.get("page_size", 20)
-        conversations = app.state.db.fetch_user_conversatons(
-            user_id=None, 
-            page=page, 
-            page_size=page_size
+        if "page" in request_data and "cursor" not in request_data:
+            # Legacy OFFSET paging (cost grows with page depth)
+            conversations = await app.state.db.fetch_user_conversatons(
+                user_id=user_id, 
+                page=request_data["page"], 
+                page_size=page_size
+            )
+            return conversations
+        # Keyset paging: pass back "next_cursor" to get the following page
+        conversations = await app.state.db.fetch_conversations_page(
+            user_id=user_id,
+            cursor=request_data.get("cursor"),
+            page_size=page_size,
+            include_count=bool(request_data.get("include_count", False))
         )
         return conversations
     except Exception as e:
         print(f"Error retrieving conversations: {str(e)}")
-        return {"conversations": [], "total_count": 0, "page": 1, "total_pages": 1}
+        return {"conversations": [], "total_count": 0, "page": 1, "total_pages": 1, "next_cursor": None}
 
 # New endpoint to retrieve conversations for the authenticated user.
 @app.post("/conversations/user")
 async def list_user_conversation(request_data: dict = None, user: dict = Depends(validate_token)):
     session_id = request_data.get("session_id") if request_data else None
     user_id = request_data.get("user_id") if request_data else None
-    conversations = app.state.db.fetch_user_conversation(user_id, session_id=session_id)
+    # Optional message range ("start", "limit") for reading large sessions in pages
+    start = int(request_data.get("start", 0)) if request_data else 0
+    limit = request_data.get("limit") if request_data else None
+    conversations = await app.state.db.fetch_user_conversation(
+        user_id,
+        session_id=session_id,
+        start=start,
+        limit=int(limit) if limit is not None else None
+    )
     return conversations
 
 @app.post("/conversations/delete")
@@ -745,7 +1018,7 @@ async def delete_conversation(session_id: str = Query(...), user_id: str = Query
     logger.info(f"Deleting conversation with session_id: {session_id} for user_id: {user_id}")
     try:
         # result = crud.delete_conversation(user["sub"], session_id)
-        result = app.state.db.delete_user_conversation(user_id=user_id, session_id=session_id)
+        result = await app.state.db.delete_user_conversation(user_id=user_id, session_id=session_id)
         if result:
             logger.info(f"Conversation {session_id} deleted successfully.")
             return {"status": "success", "message": f"Conversation {session_id} deleted successfully."}
@@ -756,6 +1029,41 @@ async def delete_conversation(session_id: str = Query(...), user_id: str = Query
         logger.error(f"Error deleting conversation {session_id}: {str(e)}")
         return {"status": "error", "message": f"Error deleting conversation: {str(e)}"}
     
+@app.get("/metrics/conversation-writer")
+async def conversation_writer_metrics():
+    # Queue depth and flush latency of the conversation write-behind buffer
+    return app.state.conversation_writer.metrics()
+
+@app.get("/media/{digest}")
+async def get_media(digest: str, if_none_match: Optional[str] = Header(None)):
+    # Content-addressed: the digest is a strong ETag and the bytes never change
+    if not DIGEST_PATTERN.match(digest) or app.state.media_store is None:
+        raise HTTPException(status_code=404, detail="Media not found")
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    media = await app.state.media_store.get(digest)
+    if media is None:
+        raise HTTPException(status_code=404, detail="Media not found")
+    data, content_type = media
+    return Response(content=data, media_type=content_type, headers=headers)
+
+@app.get("/metrics/media")
+async def media_metrics():
+    if app.state.media_store is None:
+        return {"backend": "inline"}
+    return app.state.media_store.metrics()
+
+@app.get("/metrics/format-cache")
+async def format_cache_metrics():
+    return app.state.format_cache.metrics()
+
+@app.get("/metrics/storage")
+async def storage_metrics():
+    # Backend name plus backend-specific counters (e.g. the Cosmos DB team cache); in a thread, as SQLite counts rows
+    return {"backend": app.state.db.name, **await asyncio.to_thread(app.state.db.metrics)}
+
 @app.get("/health")
 async def health_check():
     logger = logging.getLogger("health_check")
@@ -787,7 +1095,7 @@ from team_export import convert_team_for_download
 @app.get("/teams")
 async def get_teams_api():
     try:
-        teams = app.state.db.get_teams()
+        teams = await app.state.db.get_teams()
         # teams= []
         return teams
     except Exception as e:
@@ -796,7 +1104,7 @@ async def get_teams_api():
 @app.get("/teams/{team_id}")
 async def get_team_api(team_id: str):
     try:
-        team = app.state.db.get_team(team_id)
+        team = await app.state.db.get_team(team_id)
         if not team:
             raise HTTPException(status_code=404, detail="Team not found")
         return team
@@ -809,7 +1117,7 @@ async def download_team_api(team_id: str):
     Returns the team object from the DB. The frontend will handle saving it as a file.
     """
     try:
-        team = app.state.db.get_team(team_id)
+        team = await app.state.db.get_team(team_id)
         if not team:
             raise HTTPException(status_code=404, detail="Team not found")
         # Shape/filter the team representation for download
@@ -821,7 +1129,7 @@ async def download_team_api(team_id: str):
 async def create_team_api(team: dict):
     try:
         team["agents"] = MAGENTIC_ONE_DEFAULT_AGENTS
-        response = app.state.db.create_team(team)
+        response = await app.state.db.create_team(team)
         return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating team: {str(e)}")
@@ -831,7 +1139,7 @@ async def update_team_api(team_id: str, team: dict):
     logger = logging.getLogger("update_team_api")
     logger.info(f"Updating team with ID: {team_id} and data: {team}")
     try:
-        response = app.state.db.update_team(team_id, team)
+        response = await app.state.db.update_team(team_id, team)
         if "error" in response:
             logger.error(f"Error updating team: {response['error']}")
             raise HTTPException(status_code=404, detail=response["error"])
@@ -843,7 +1151,7 @@ async def update_team_api(team_id: str, team: dict):
 @app.delete("/teams/{team_id}")
 async def delete_team_api(team_id: str):
     try:
-        response = app.state.db.delete_team(team_id)
+        response = await app.state.db.delete_team(team_id)
         if "error" in response:
             raise HTTPException(status_code=404, detail=response["error"])
         return response
@@ -855,7 +1163,7 @@ async def delete_team_api(team_id: str):
 async def initialize_teams_api():
     try:
         # Initialize the teams in the database
-        msg = app.state.db.initialize_teams()
+        msg = await app.state.db.initialize_teams()
         msg = "DUMMY: Teams initialized successfully."
         return {"status": "success", "message": msg}
     except Exception as e:
@@ -871,7 +1179,7 @@ async def conversation_stats():
         start_date = start_dt.strftime("%Y-%m-%d")
         end_date = end_dt.strftime("%Y-%m-%d")
 
-        rows = app.state.db.fetch_conversation_stats(start_date=start_date, end_date=end_date)
+        rows = await app.state.db.fetch_conversation_stats(start_date=start_date, end_date=end_date)
 
         # Build summary
         total_runs = sum(r.get("count", 0) for r in rows)
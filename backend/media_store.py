@@ -0,0 +1,198 @@
+"""
+Content-addressed store for screenshots and executor images.
+
+Messages used to carry full base64 data URIs in `content_image`, which went
+inline over SSE and into every stored conversation document. Now the bytes are
+stored once under their SHA-256 and the message carries a short reference,
+`/media/<sha256>`, served by GET /media/{digest} with a strong ETag.
+
+MEDIA_STORE selects the backend:
+- inline (default): keep the data URIs in the messages (previous behaviour)
+- local: files under MEDIA_DIR (./data/media), for a single replica
+- blob: an Azure Blob Storage container (MEDIA_BLOB_ACCOUNT_URL, MEDIA_BLOB_CONTAINER),
+  shared by all replicas
+
+Decoding and hashing multi-MB images runs in a worker thread, off the event loop.
+"""
+import asyncio
+import base64
+import binascii
+import hashlib
+import os
+import re
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Tuple
+
+MEDIA_URL_PREFIX = "/media/"
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+DATA_URI_PATTERN = re.compile(r"^data:(?P<type>[\w.+-]+/[\w.+-]+);base64,(?P<data>.*)$", re.DOTALL)
+EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp", "image/gif": ".gif"}
+
+
+class MediaStore(ABC):
+    name = "media"
+
+    def __init__(self):
+        self.puts = 0
+        self.deduplicated = 0
+        self.bytes_stored = 0
+        self.bytes_inline_saved = 0
+
+    @abstractmethod
+    async def _exists(self, digest: str) -> bool: ...
+
+    @abstractmethod
+    async def _write(self, digest: str, data: bytes, content_type: str) -> None: ...
+
+    @abstractmethod
+    async def get(self, digest: str) -> Optional[Tuple[bytes, str]]:
+        """(bytes, content type) or None."""
+
+    async def put(self, data: bytes, content_type: str) -> str:
+        """Store the bytes (once per content) and return their SHA-256."""
+        digest = await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest())
+        return await self._store(digest, data, content_type)
+
+    async def _store(self, digest: str, data: bytes, content_type: str) -> str:
+        self.puts += 1
+        if await self._exists(digest):
+            self.deduplicated += 1
+        else:
+            await self._write(digest, data, content_type)
+            self.bytes_stored += len(data)
+        return digest
+
+    @staticmethod
+    def _decode(value: str) -> Optional[Tuple[bytes, str, str]]:
+        """(bytes, content type, SHA-256) of a base64 data URI, or None if it isn't one."""
+        match = DATA_URI_PATTERN.match(value)
+        if match is None:
+            return None
+        try:
+            data = base64.b64decode(match.group("data"), validate=False)
+        except (binascii.Error, ValueError):
+            return None
+        return data, match.group("type"), hashlib.sha256(data).hexdigest()
+
+    async def externalize(self, value: Optional[str]) -> Optional[str]:
+        """Replace a base64 data URI with a /media/<sha256> reference; anything else is returned as is."""
+        if not value or not value.startswith("data:"):
+            return value
+        decoded = await asyncio.to_thread(self._decode, value)
+        if decoded is None:
+            return value
+        data, content_type, digest = decoded
+        await self._store(digest, data, content_type)
+        reference = MEDIA_URL_PREFIX + digest
+        self.bytes_inline_saved += len(value) - len(reference)
+        return reference
+
+    async def close(self) -> None:
+        pass
+
+    def metrics(self) -> Dict:
+        return {
+            "backend": self.name,
+            "puts": self.puts,
+            "deduplicated": self.deduplicated,
+            "bytes_stored": self.bytes_stored,
+            "bytes_inline_saved": self.bytes_inline_saved,
+        }
+
+
+class LocalMediaStore(MediaStore):
+    name = "local"
+
+    def __init__(self, root: str = None):
+        super().__init__()
+        self.root = root or os.getenv("MEDIA_DIR", "./data/media")
+
+    def _path(self, digest: str, content_type: str) -> str:
+        # Fan out by the first two hex digits to keep directories small
+        return os.path.join(self.root, digest[:2], digest + EXTENSIONS.get(content_type, ".bin"))
+
+    def _find(self, digest: str) -> Optional[Tuple[str, str]]:
+        for content_type in list(EXTENSIONS) + ["application/octet-stream"]:
+            path = self._path(digest, content_type)
+            if os.path.exists(path):
+                return path, content_type
+        return None
+
+    async def _exists(self, digest: str) -> bool:
+        return await asyncio.to_thread(self._find, digest) is not None
+
+    def _write_file(self, digest: str, data: bytes, content_type: str) -> None:
+        path = self._path(digest, content_type)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    async def _write(self, digest: str, data: bytes, content_type: str) -> None:
+        await asyncio.to_thread(self._write_file, digest, data, content_type)
+
+    def _read_file(self, digest: str) -> Optional[Tuple[bytes, str]]:
+        found = self._find(digest)
+        if found is None:
+            return None
+        path, content_type = found
+        with open(path, "rb") as f:
+            return f.read(), content_type
+
+    async def get(self, digest: str) -> Optional[Tuple[bytes, str]]:
+        return await asyncio.to_thread(self._read_file, digest)
+
+
+class BlobMediaStore(MediaStore):
+    name = "blob"
+
+    def __init__(self, account_url: str = None, container: str = None):
+        from azure.identity.aio import DefaultAzureCredential
+        from azure.storage.blob.aio import BlobServiceClient
+
+        super().__init__()
+        self.credential = DefaultAzureCredential()
+        self.service = BlobServiceClient(account_url or os.getenv("MEDIA_BLOB_ACCOUNT_URL"), credential=self.credential)
+        self.container = self.service.get_container_client(container or os.getenv("MEDIA_BLOB_CONTAINER", "media"))
+
+    async def _exists(self, digest: str) -> bool:
+        return await self.container.get_blob_client(digest).exists()
+
+    async def _write(self, digest: str, data: bytes, content_type: str) -> None:
+        from azure.core.exceptions import ResourceExistsError
+        from azure.storage.blob import ContentSettings
+
+        try:
+            await self.container.upload_blob(
+                digest, data, overwrite=False,
+                content_settings=ContentSettings(content_type=content_type, cache_control="public, max-age=31536000, immutable"),
+            )
+        except ResourceExistsError:
+            pass  # another worker stored the same content first
+
+    async def get(self, digest: str) -> Optional[Tuple[bytes, str]]:
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            downloader = await self.container.download_blob(digest)
+        except ResourceNotFoundError:
+            return None
+        data = await downloader.readall()
+        return data, downloader.properties.content_settings.content_type or "application/octet-stream"
+
+    async def close(self) -> None:
+        await self.service.close()
+        await self.credential.close()
+
+
+def create_media_store() -> Optional[MediaStore]:
+    """The store selected by MEDIA_STORE, or None to keep images inline."""
+    backend = os.getenv("MEDIA_STORE", "inline").lower()
+    if backend == "inline":
+        return None
+    if backend == "blob":
+        return BlobMediaStore()
+    if backend == "local":
+        return LocalMediaStore()
+    raise ValueError(f"Unknown MEDIA_STORE: {backend}")
@@ -0,0 +1,152 @@
+"""
+Turns autogen messages into AutoGenMessage fields, for both the stream
+(main.display_log_message) and storage (CosmosDBBase.format_message).
+
+Handlers are looked up by the message's type in HANDLERS (subclasses resolve
+to their nearest registered base, once per type), so adding a message type is
+one function and one table entry. Stream-only behaviour (formatting,
+screenshots, CSV tables) stays in main.py and is applied on top.
+
+Executor output may contain the repr of an image dict,
+{'type': 'image', 'format': 'png', 'base64_data': '<several MB>'}. It is found
+with a few precompiled searches and string slicing: the base64 payload is cut
+out in one pass and never parsed with ast.literal_eval.
+"""
+import re
+from typing import Callable, Dict, Optional, Tuple
+
+from autogen_agentchat.base import TaskResult
+from autogen_agentchat.messages import (
+    MultiModalMessage,
+    SelectSpeakerEvent,
+    TextMessage,
+    ToolCallExecutionEvent,
+    ToolCallRequestEvent,
+    ToolCallSummaryMessage,
+)
+
+from autogen_message import AutoGenMessage
+
+BASE64_KEY = re.compile(r"'base64_data':\s*'")
+IMAGE_TYPE = re.compile(r"'type':\s*'image'")
+PNG_FORMAT = re.compile(r"'format':\s*'png'")
+
+
+def extract_executor_image(content: str) -> Tuple[str, Optional[str]]:
+    """(content without the image dict, PNG data URI), or (content, None) when there is no image."""
+    if not isinstance(content, str):
+        return content, None
+    position = 0
+    while True:
+        key = BASE64_KEY.search(content, position)
+        if key is None:
+            return content, None
+        data_start = key.end()
+        # base64 never contains a quote, so the next one closes the payload
+        data_end = content.find("'", data_start)
+        if data_end < 0:
+            return content, None
+        position = data_end + 1
+        start = content.rfind("{", 0, key.start())
+        end = content.find("}", data_end)
+        if start < 0 or end < 0:
+            continue
+        # The keys around the payload are short; a brace in between means another dict
+        head = content[start:key.start()]
+        tail = content[data_end + 1:end]
+        if "}" in head or "{" in tail:
+            continue
+        if IMAGE_TYPE.search(head) is None or PNG_FORMAT.search(head + tail) is None:
+            continue
+        cleaned = (content[:start] + content[end + 1:]).strip()
+        return cleaned, f"data:image/png;base64,{content[data_start:data_end]}"
+
+
+# ---------------- handlers ----------------
+def _task_result(entry: TaskResult, message: AutoGenMessage, include_image: bool) -> None:
+    message.type = "TaskResult"
+    message.source = "TaskResult"
+    message.content = entry.messages[-1].content
+    message.stop_reason = entry.stop_reason
+
+
+def _multimodal(entry: MultiModalMessage, message: AutoGenMessage, include_image: bool) -> None:
+    message.type = entry.type
+    message.source = entry.source
+    message.content = entry.content[0]  # text without image
+    if include_image:
+        message.content_image = entry.content[1].data_uri
+
+
+def _text(entry: TextMessage, message: AutoGenMessage, include_image: bool) -> None:
+    message.type = entry.type
+    message.source = entry.source
+    message.content = entry.content
+    if entry.source == "Executor":
+        content, image = extract_executor_image(entry.content)
+        if image is not None:
+            message.content = content
+            message.content_image = image
+
+
+def _tool_execution(entry: ToolCallExecutionEvent, message: AutoGenMessage, include_image: bool) -> None:
+    message.type = entry.type
+    message.source = entry.source
+    message.content = entry.content[0].content
+
+
+def _tool_request(entry: ToolCallRequestEvent, message: AutoGenMessage, include_image: bool) -> None:
+    message.type = entry.type
+    message.source = entry.source
+    message.content = entry.content[0].arguments
+
+
+def _select_speaker(entry: SelectSpeakerEvent, message: AutoGenMessage, include_image: bool) -> None:
+    message.type = entry.type
+    message.source = entry.source
+    message.content = entry.content[0]
+
+
+def _tool_summary(entry: ToolCallSummaryMessage, message: AutoGenMessage, include_image: bool) -> None:
+    message.type = entry.type
+    message.source = entry.source
+    message.content = entry.content
+
+
+def _unknown(entry, message: AutoGenMessage, include_image: bool) -> None:
+    message.type = "N/A"
+    message.source = "N/A"
+    message.content = "Agents mumbling."
+
+
+Handler = Callable[[object, AutoGenMessage, bool], None]
+
+HANDLERS: Dict[type, Handler] = {
+    TaskResult: _task_result,
+    MultiModalMessage: _multimodal,
+    TextMessage: _text,
+    ToolCallExecutionEvent: _tool_execution,
+    ToolCallRequestEvent: _tool_request,
+    SelectSpeakerEvent: _select_speaker,
+    ToolCallSummaryMessage: _tool_summary,
+}
+
+_resolved: Dict[type, Handler] = {}
+
+
+def handler_for(cls: type) -> Handler:
+    handler = _resolved.get(cls)
+    if handler is None:
+        handler = next((HANDLERS[base] for base in cls.__mro__ if base in HANDLERS), _unknown)
+        _resolved[cls] = handler
+    return handler
+
+
+def normalize_message(entry, message: AutoGenMessage, include_image: bool = True) -> AutoGenMessage:
+    """Fill type, source, content (and image, stop reason) of `message` from an autogen message.
+
+    include_image=False skips encoding a MultiModalMessage's image, for callers
+    that already have a processed screenshot.
+    """
+    handler_for(type(entry))(entry, message, include_image)
+    return message
@@ -0,0 +1,285 @@
+"""
+Agent runs that live independently of the SSE connection.
+
+/chat-stream used to build the team and call run_stream inside the request,
+so every EventSource reconnect started the whole run again. Now the first
+request for a session starts the run once as a background task; its events are
+buffered on the Run and any number of subscribers can attach, detach and
+reattach (each one replays the buffer, then follows live events through its
+own SubscriberStream, see event_stream.py).
+
+A run ends when the team finishes, on /stop (cancellation token) or when it
+has had no subscriber for RUN_IDLE_TIMEOUT_SECONDS. Finished runs are kept for
+RUN_RETENTION_SECONDS so a late reconnect still gets the full stream.
+
+Every frame gets a monotonically increasing SSE `id:`. The newest
+RUN_EVENT_BUFFER_SIZE frames stay in memory; older ones are spilled to the
+conversation store (crud), so a client reconnecting with Last-Event-ID gets
+exactly the frames it missed, from memory or from the spill.
+
+With a SessionRegistry (session_registry.py) each run is also recorded for
+the other workers: the caller claims the session (SessionRegistry.claim)
+before start(), and stop requests that arrive on another worker are picked up
+by polling the registry.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import crud
+from session_registry import SessionRegistry
+
+logger = logging.getLogger("run_manager")
+
+
+class CrudEventSpill:
+    """Stores frames evicted from a run's ring buffer in the conversation store."""
+
+    async def save(self, user_id: str, session_id: str, events: List[Tuple[int, str]]) -> None:
+        await asyncio.to_thread(crud.save_stream_events, user_id, session_id, events)
+
+    async def read(self, user_id: str, session_id: str, after_id: int) -> List[Tuple[int, str]]:
+        return await asyncio.to_thread(crud.get_stream_events, user_id, session_id, after_id)
+
+    async def delete(self, user_id: str, session_id: str) -> None:
+        await asyncio.to_thread(crud.delete_stream_events, user_id, session_id)
+
+
+class Run:
+    def __init__(self, session_id: str, user_id: str, buffer_size: int = 500, spill: CrudEventSpill = None):
+        self.session_id = session_id
+        self.user_id = user_id
+        # (id, SSE frame, kind) in publish order; the oldest are spilled once the buffer is full
+        self.buffer: Deque[Tuple[int, str, str]] = deque()
+        self.buffer_size = buffer_size
+        self.last_id = 0
+        self.spill = spill
+        self.spilled = 0
+        self.lost = 0
+        self._spill_pending: List[Tuple[int, str]] = []
+        self._spill_task: Optional[asyncio.Task] = None
+        self.done = False
+        self.cancel_requested = False
+        self.error: Optional[str] = None
+        self.cancellation_token = None  # set by the runner once the team is started
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+        self.started_at = time.monotonic()
+        self.idle_since: Optional[float] = self.started_at
+        self.finished_at: Optional[float] = None
+        self._changed = asyncio.Event()
+
+    def publish(self, data: str, event: str = None, kind: str = "essential") -> int:
+        """Append an SSE frame with the next id and wake the subscribers (never waits).
+
+        `kind` tells slow subscribers what may be dropped or coalesced (see event_stream.py).
+        """
+        self.last_id += 1
+        frame = f"id: {self.last_id}\n" + (f"event: {event}\n" if event else "") + f"data: {data}\n\n"
+        self.buffer.append((self.last_id, frame, kind))
+        if len(self.buffer) > self.buffer_size:
+            event_id, frame, _ = self.buffer.popleft()
+            if self.spill is not None:
+                self._spill_pending.append((event_id, frame))
+                if self._spill_task is None or self._spill_task.done():
+                    self._spill_task = asyncio.create_task(self._flush_spill())
+        self._notify()
+        return self.last_id
+
+    async def _flush_spill(self) -> None:
+        while self._spill_pending:
+            batch, self._spill_pending = self._spill_pending, []
+            try:
+                await self.spill.save(self.user_id, self.session_id, batch)
+                self.spilled += len(batch)
+            except Exception as e:
+                self.lost += len(batch)
+                logger.error(f"Failed to spill {len(batch)} event(s) of run {self.session_id}: {e}")
+
+    async def _read_spill(self, after_id: int) -> List[Tuple[int, str]]:
+        if self.spill is None:
+            return []
+        if self._spill_task is not None:
+            await self._spill_task
+        # Evicted frames not yet picked up by a flush task
+        pending = [e for e in self._spill_pending if e[0] > after_id]
+        try:
+            stored = await self.spill.read(self.user_id, self.session_id, after_id)
+        except Exception as e:
+            logger.error(f"Failed to read spilled events of run {self.session_id}: {e}")
+            stored = []
+        return stored + pending
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _finish(self, task: asyncio.Task) -> None:
+        self.done = True
+        self.finished_at = time.monotonic()
+        if not task.cancelled() and task.exception() is not None:
+            self.error = str(task.exception())
+            logger.error(f"Run {self.session_id} failed: {self.error}")
+        self._notify()
+
+    def cancel(self) -> bool:
+        if self.done:
+            return False
+        self.cancel_requested = True
+        if self.cancellation_token is not None:
+            self.cancellation_token.cancel()
+        if self.task is not None:
+            self.task.cancel()
+        return True
+
+    async def follow(self, after_id: int = 0) -> AsyncIterator[Tuple[int, str, str]]:
+        """Yield (id, frame, kind) after `after_id` (the client's Last-Event-ID), then follow
+        the run until it ends or the subscriber leaves."""
+        self.subscribers += 1
+        self.idle_since = None
+        position = after_id
+        try:
+            while True:
+                changed = self._changed
+                if self.buffer and position < self.buffer[-1][0]:
+                    first = self.buffer[0][0]
+                    if position + 1 < first:
+                        # The client is behind the ring buffer: catch up from the spill
+                        missed = [e for e in await self._read_spill(position) if e[0] > position]
+                        if not missed and self._spill_task is not None and not self._spill_task.done():
+                            continue  # evicted while we were reading; wait for that flush
+                        if not missed:
+                            logger.warning(f"Events {position + 1}-{first - 1} of run {self.session_id} are no longer available")
+                            position = first - 1
+                        for event_id, frame in missed:
+                            yield event_id, frame, "essential"
+                            position = event_id
+                        continue
+                    entry = self.buffer[position + 1 - first]
+                    yield entry
+                    position = entry[0]
+                    continue
+                if self.done:
+                    break
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0:
+                self.idle_since = time.monotonic()
+
+
+class RunManager:
+    def __init__(self, idle_timeout: float = None, retention: float = None, buffer_size: int = None, spill: CrudEventSpill = None, registry: SessionRegistry = None):
+        self.idle_timeout = idle_timeout if idle_timeout is not None else float(os.getenv("RUN_IDLE_TIMEOUT_SECONDS", "60"))
+        self.retention = retention if retention is not None else float(os.getenv("RUN_RETENTION_SECONDS", "60"))
+        self.buffer_size = buffer_size or int(os.getenv("RUN_EVENT_BUFFER_SIZE", "500"))
+        self.spill = spill
+        self.registry = registry
+        self.runs: Dict[str, Run] = {}
+        self._reaper: Optional[asyncio.Task] = None
+        self._watcher: Optional[asyncio.Task] = None
+        self.started = 0
+        self.idle_cancelled = 0
+
+    def get(self, session_id: str) -> Optional[Run]:
+        return self.runs.get(session_id)
+
+    def start(self, session_id: str, user_id: str, runner: Callable[[Run], Awaitable[None]]) -> Run:
+        """Return the session's run, starting it with `runner(run)` if there is none."""
+        run = self.runs.get(session_id)
+        if run is not None:
+            return run
+        run = Run(session_id, user_id, self.buffer_size, self.spill)
+        run.task = asyncio.create_task(self._execute(run, runner))
+        run.task.add_done_callback(run._finish)
+        self.runs[session_id] = run
+        self.started += 1
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap())
+        if self.registry is not None and (self._watcher is None or self._watcher.done()):
+            self._watcher = asyncio.create_task(self._watch())
+        return run
+
+    async def _execute(self, run: Run, runner: Callable[[Run], Awaitable[None]]) -> None:
+        state = "failed"
+        try:
+            await runner(run)
+            state = "cancelled" if run.cancel_requested else "finished"
+        except asyncio.CancelledError:
+            state = "cancelled"
+            raise
+        finally:
+            if self.registry is not None:
+                try:
+                    await asyncio.to_thread(self.registry.finish, run.session_id, state)
+                except Exception as e:
+                    logger.warning(f"Failed to record the end of run {run.session_id}: {e}")
+
+    async def _watch(self) -> None:
+        """Publish progress to the registry and apply stop requests made on other workers."""
+        touched: Dict[str, int] = {}
+        while any(not run.done for run in self.runs.values()):
+            await asyncio.sleep(self.registry.poll_interval)
+            try:
+                for session_id in await asyncio.to_thread(self.registry.pending_stops):
+                    if self.cancel(session_id):
+                        logger.warning(f"Cancelled run {session_id} on request from another worker")
+                for session_id, run in list(self.runs.items()):
+                    if not run.done and touched.get(session_id) != run.last_id:
+                        await asyncio.to_thread(self.registry.touch, session_id, run.last_id, time.time())
+                        touched[session_id] = run.last_id
+            except Exception as e:
+                logger.warning(f"Session registry poll failed: {e}")
+
+    def cancel(self, session_id: str) -> bool:
+        run = self.runs.get(session_id)
+        return run.cancel() if run is not None else False
+
+    async def _reap(self) -> None:
+        interval = max(1.0, min(self.idle_timeout, self.retention) / 4)
+        while self.runs:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for session_id, run in list(self.runs.items()):
+                if run.done:
+                    if now - run.finished_at > self.retention:
+                        del self.runs[session_id]
+                        if run.spill is not None and (run.spilled or run._spill_task is not None):
+                            try:
+                                await run.spill.delete(run.user_id, session_id)
+                            except Exception as e:
+                                logger.warning(f"Failed to delete spilled events of run {session_id}: {e}")
+                elif run.idle_since is not None and now - run.idle_since > self.idle_timeout:
+                    logger.warning(f"Cancelling run {session_id}: no subscriber for {self.idle_timeout:.0f}s")
+                    self.idle_cancelled += 1
+                    run.cancel()
+
+    async def shutdown(self) -> None:
+        for run in self.runs.values():
+            run.cancel()
+        tasks = [run.task for run in self.runs.values() if run.task is not None]
+        for background in (self._reaper, self._watcher):
+            if background is not None:
+                background.cancel()
+                tasks.append(background)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.runs.clear()
+
+    def metrics(self) -> Dict:
+        active = [run for run in self.runs.values() if not run.done]
+        return {
+            "active_runs": len(active),
+            "finished_runs_retained": len(self.runs) - len(active),
+            "subscribers": sum(run.subscribers for run in self.runs.values()),
+            "buffered_events": sum(len(run.buffer) for run in self.runs.values()),
+            "spilled_events": sum(run.spilled for run in self.runs.values()),
+            "lost_events": sum(run.lost for run in self.runs.values()),
+            "event_buffer_size": self.buffer_size,
+            "runs_started": self.started,
+            "idle_cancelled": self.idle_cancelled,
+            "idle_timeout_seconds": self.idle_timeout,
+            "retention_seconds": self.retention,
+        }
@@ -51,28 +51,5 @@ class UserResponse(UserBase):
     class Config:
         orm_mode = True
 from autogen_core import CancellationToken
-class AutoGenMessage(BaseModel):
-    time: str
-    type: Optional[str] = None
-    source:  Optional[str] = None
-    content:  Optional[str] = None
-    stop_reason:  Optional[str] = None
-    models_usage:  Optional[str] = None
-    content_image:  Optional[str] = None
-    session_id:  Optional[str] = None
-    session_user:  Optional[str] = None
-    # cancellation_token: Optional[CancellationToken] = None
-
-    def to_json(self):
-        return {
-            "time" : self.time,
-            "type" : self.type,
-            "source": self.source,
-            "content": self.content,
-            "stop_reason": self.stop_reason,
-            "models_usage": self.models_usage,
-            "content_image": self.content_image,
-            "session_id": self.session_id,
-            "session_user": self.session_user
-        }
-    
+# Streamed event message: a slotted class with a cached encoding (see autogen_message.py)
+from autogen_message import AutoGenMessage
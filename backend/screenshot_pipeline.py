@@ -0,0 +1,124 @@
+"""
+Screenshot processing between team.run_stream and display_log_message.
+
+MultimodalWebSurfer attaches a full-resolution PNG to almost every turn. For
+each run a ScreenshotProcessor:
+- downscales to SCREENSHOT_MAX_WIDTH and re-encodes as SCREENSHOT_FORMAT
+  (webp by default) at SCREENSHOT_QUALITY;
+- makes a SCREENSHOT_THUMBNAIL_WIDTH thumbnail;
+- compares a 64-bit difference hash with the previous screenshot. Within
+  SCREENSHOT_DEDUPE_DISTANCE bits the page is considered unchanged, and the
+  previous image is reused (the media store then stores nothing new).
+
+The autogen message itself is never modified, since the team keeps it in
+its history; the processed images are returned next to it. Set
+SCREENSHOT_PIPELINE=false to send the original PNGs. Needs Pillow (installed
+with autogen-core); without it the stage is a no-op.
+"""
+import asyncio
+import base64
+import io
+import logging
+import os
+from typing import Dict, Optional
+
+from autogen_agentchat.messages import MultiModalMessage
+from autogen_core import Image
+
+try:
+    from PIL import Image as PILImage
+except ImportError:  # pragma: no cover - Pillow comes with autogen-core
+    PILImage = None
+
+logger = logging.getLogger("screenshot_pipeline")
+
+MIME_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+
+
+class Screenshot:
+    __slots__ = ("data_uri", "thumbnail_uri", "duplicate")
+
+    def __init__(self, data_uri: str, thumbnail_uri: Optional[str], duplicate: bool = False):
+        self.data_uri = data_uri
+        self.thumbnail_uri = thumbnail_uri
+        self.duplicate = duplicate
+
+
+def dhash(image, size: int = 8) -> int:
+    """Difference hash: one bit per horizontally adjacent pixel pair of a (size+1)x(size) grayscale."""
+    pixels = list(image.convert("L").resize((size + 1, size)).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class ScreenshotProcessor:
+    def __init__(self):
+        self.enabled = PILImage is not None and os.getenv("SCREENSHOT_PIPELINE", "true").lower() in ("1", "true", "yes", "on")
+        self.max_width = int(os.getenv("SCREENSHOT_MAX_WIDTH", "1280"))
+        self.thumbnail_width = int(os.getenv("SCREENSHOT_THUMBNAIL_WIDTH", "320"))
+        self.format = os.getenv("SCREENSHOT_FORMAT", "webp").lower()
+        if self.format not in MIME_TYPES:
+            self.format = "webp"
+        self.quality = int(os.getenv("SCREENSHOT_QUALITY", "70"))
+        self.dedupe_distance = int(os.getenv("SCREENSHOT_DEDUPE_DISTANCE", "4"))
+        self._last_hash: Optional[int] = None
+        self._last: Optional[Screenshot] = None
+        self.processed = 0
+        self.duplicates = 0
+        self.bytes_out = 0
+
+    def _encode(self, image, width: int) -> str:
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), PILImage.LANCZOS)
+        if self.format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        options = {"optimize": True} if self.format == "png" else {"quality": self.quality}
+        image.save(buffer, format=self.format.upper(), **options)
+        data = buffer.getvalue()
+        self.bytes_out += len(data)
+        return f"data:{MIME_TYPES[self.format]};base64,{base64.b64encode(data).decode('ascii')}"
+
+    def _process_image(self, image) -> Screenshot:
+        fingerprint = dhash(image)
+        if (
+            self._last is not None
+            and self.dedupe_distance > 0
+            and hamming(fingerprint, self._last_hash) <= self.dedupe_distance
+        ):
+            self.duplicates += 1
+            return Screenshot(self._last.data_uri, self._last.thumbnail_uri, duplicate=True)
+        screenshot = Screenshot(self._encode(image, self.max_width), self._encode(image, self.thumbnail_width))
+        self._last_hash, self._last = fingerprint, screenshot
+        return screenshot
+
+    async def process(self, log_entry) -> Optional[Screenshot]:
+        """Processed screenshot of a multimodal message, or None to keep the message's own image."""
+        if not self.enabled or not isinstance(log_entry, MultiModalMessage):
+            return None
+        image = next((item for item in log_entry.content if isinstance(item, Image)), None)
+        if image is None:
+            return None
+        try:
+            screenshot = await asyncio.to_thread(self._process_image, image.image)
+        except Exception as e:
+            logger.warning(f"Screenshot processing failed, sending the original: {e}")
+            return None
+        self.processed += 1
+        return screenshot
+
+    def metrics(self) -> Dict:
+        return {
+            "processed": self.processed,
+            "duplicates": self.duplicates,
+            "bytes_out": self.bytes_out,
+        }
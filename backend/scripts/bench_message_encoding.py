@@ -0,0 +1,133 @@
+"""
+Per-event CPU cost of building and encoding a streamed message.
+
+before: the pydantic AutoGenMessage, to_json(), then json.dumps for the SSE
+        frame, the local conversation log and the SQLite store.
+after:  the slotted AutoGenMessage, encoded once and reused by all three.
+
+Run from the backend directory:
+
+    python scripts/bench_message_encoding.py [--events 20000]
+
+The "before" model needs pydantic (installed with the backend); without it
+"before" uses the new class with the old three json.dumps calls, which
+measures the encoding cost only.
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from autogen_message import AutoGenMessage, encode_message  # noqa: E402
+
+try:
+    from pydantic import BaseModel
+except ImportError:
+    BaseModel = None
+
+
+if BaseModel is not None:
+    class LegacyAutoGenMessage(BaseModel):
+        time: str
+        type: Optional[str] = None
+        source: Optional[str] = None
+        content: Optional[str] = None
+        stop_reason: Optional[str] = None
+        models_usage: Optional[str] = None
+        content_image: Optional[str] = None
+        content_thumbnail: Optional[str] = None
+        session_id: Optional[str] = None
+        session_user: Optional[str] = None
+        event_id: Optional[str] = None
+
+        def to_json(self):
+            return {
+                "time": self.time,
+                "type": self.type,
+                "source": self.source,
+                "content": self.content,
+                "stop_reason": self.stop_reason,
+                "models_usage": self.models_usage,
+                "content_image": self.content_image,
+                "content_thumbnail": self.content_thumbnail,
+                "session_id": self.session_id,
+                "session_user": self.session_user,
+                "event_id": self.event_id,
+            }
+
+
+def sample_events():
+    """A mix resembling a MagenticOne run: orchestrator text, tool calls, screenshots."""
+    plan = "## Plan\n" + "\n".join(f"- Step {i}: look up the data and summarise the findings" for i in range(20))
+    screenshot = "data:image/webp;base64," + base64.b64encode(os.urandom(60_000)).decode("ascii")
+    return [
+        ("TextMessage", "MagenticOneOrchestrator", plan, None),
+        ("ToolCallRequestEvent", "Coder", '{"code": "print(1 + 1)"}', None),
+        ("ToolCallExecutionEvent", "Executor", "2\n" * 50, None),
+        ("MultiModalMessage", "WebSurfer", "I typed 'weather' into the search box.", "/media/" + "a" * 64),
+        ("MultiModalMessage", "WebSurfer", "I clicked 'Next page'.", screenshot),
+        ("SelectSpeakerEvent", "MagenticOneOrchestrator", "WebSurfer", None),
+    ]
+
+
+def build(cls, event_id, kind, source, content, image):
+    message = cls(time="2025-01-01 12:00:00", session_id="0f8fad5b-d9cb-469f-a165-70867728950e", session_user="user@example.com", event_id=str(event_id))
+    message.type = kind
+    message.source = source
+    message.content = content
+    message.content_image = image
+    return message
+
+
+def run_before(events, count):
+    cls = LegacyAutoGenMessage if BaseModel is not None else AutoGenMessage
+    for i in range(count):
+        message = build(cls, i, *events[i % len(events)])
+        frame = json.dumps(dict(message.to_json()))                   # SSE
+        stored = dict(message.to_json())                               # persist_message
+        line = json.dumps(stored, separators=(",", ":")) + "\n"        # crud log
+        row = json.dumps(stored)                                       # SQLite store
+    return frame, line, row
+
+
+def run_after(events, count):
+    for i in range(count):
+        message = build(AutoGenMessage, i, *events[i % len(events)])
+        frame = message.encode()                                       # SSE
+        stored = message.to_json()                                     # persist_message
+        line = encode_message(stored) + "\n"                           # crud log
+        row = encode_message(stored)                                   # SQLite store
+    return frame, line, row
+
+
+def measure(fn, events, count):
+    fn(events, min(count, 500))  # warm up
+    started = time.process_time()
+    fn(events, count)
+    return (time.process_time() - started) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=20000)
+    args = parser.parse_args()
+
+    events = sample_events()
+    if BaseModel is None:
+        print("pydantic not installed: 'before' measures the repeated encoding only")
+    results = {
+        "before": measure(run_before, events, args.events),
+        "after": measure(run_after, events, args.events),
+    }
+    for name, per_event in results.items():
+        print(f"{name:>6}: {per_event:8.1f} us CPU per event ({args.events} events)")
+    print(f"speedup: {results['before'] / results['after']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
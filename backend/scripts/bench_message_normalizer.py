@@ -0,0 +1,80 @@
+"""
+Executor image extraction and message normalization on large outputs.
+
+before: the regex + ast.literal_eval search that main.display_log_message and
+        CosmosDB.format_message each used to run.
+after:  message_normalizer.extract_executor_image / normalize_message.
+
+The Executor outputs are stdout followed by the repr of a PNG image dict,
+with payloads from 256 KB to 8 MB. Run from the backend directory:
+
+    python scripts/bench_message_normalizer.py [--repeat 5]
+"""
+import argparse
+import ast
+import base64
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from autogen_agentchat.messages import TextMessage  # noqa: E402
+
+from autogen_message import AutoGenMessage  # noqa: E402
+from message_normalizer import extract_executor_image, normalize_message  # noqa: E402
+
+SIZES = [256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 8 * 1024 * 1024]
+
+
+def legacy_extract(content):
+    if isinstance(content, str) and "'type': 'image'" in content and "'base64_data':" in content:
+        pattern = r"\{[^{}]*'type': 'image'[^{}]*'base64_data':[^{}]*\}"
+        match = re.search(pattern, content)
+        if match:
+            img_dict_str = match.group(0)
+            img_dict = ast.literal_eval(img_dict_str)
+            if (
+                isinstance(img_dict, dict)
+                and img_dict.get('type') == 'image'
+                and img_dict.get('format') == 'png'
+                and 'base64_data' in img_dict
+            ):
+                return content.replace(img_dict_str, "").strip(), f"data:image/png;base64,{img_dict['base64_data']}"
+    return content, None
+
+
+def executor_output(payload_size: int) -> str:
+    stdout = "\n".join(f"epoch {i}: loss={1 / (i + 1):.4f}" for i in range(200))
+    data = base64.b64encode(os.urandom(payload_size * 3 // 4)).decode("ascii")
+    return f"{stdout}\n{{'type': 'image', 'format': 'png', 'base64_data': '{data}'}}\nSaved plot to chart.png"
+
+
+def best_of(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'payload':>8} {'before ms':>10} {'after ms':>9} {'normalize ms':>13} {'speedup':>8}")
+    for size in SIZES:
+        content = executor_output(size)
+        assert extract_executor_image(content) == legacy_extract(content)
+        entry = TextMessage(source="Executor", content=content)
+        before = best_of(lambda: legacy_extract(content), args.repeat)
+        after = best_of(lambda: extract_executor_image(content), args.repeat)
+        normalize = best_of(lambda: normalize_message(entry, AutoGenMessage(time="N/A")), args.repeat)
+        print(f"{size // 1024:>6}KB {before:10.2f} {after:9.2f} {normalize:13.2f} {before / after:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
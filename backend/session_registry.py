@@ -0,0 +1,151 @@
+"""
+Session registry shared by the uvicorn workers of one host.
+
+The Dockerfile runs several workers, and a run lives in the worker that
+started it (run_manager.py). The registry is a SQLite file
+(SESSION_REGISTRY_PATH) that records, per session, the owner worker, state,
+start time and last event. /stop on any worker sets `stop_requested`; the
+owner polls for that every SESSION_STOP_POLL_SECONDS and cancels the run.
+
+Owners are "<hostname>:<pid>". A running session whose owner process on this
+host is gone is treated as abandoned.
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    user_id TEXT,
+    owner TEXT NOT NULL,
+    state TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    last_event_at REAL,
+    last_event_id INTEGER,
+    stop_requested INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_sessions_owner_stop ON sessions (owner, stop_requested);
+"""
+
+RUNNING = "running"
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SessionRegistry:
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv("SESSION_REGISTRY_PATH", "./data/sessions.db")
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.owner = worker_id()
+        self.poll_interval = float(os.getenv("SESSION_STOP_POLL_SECONDS", "0.5"))
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _owner_alive(self, owner: str) -> bool:
+        host, _, pid = owner.rpartition(":")
+        if host != socket.gethostname():
+            return True  # can't tell for another host
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except (PermissionError, ValueError):
+            pass
+        return True
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        row = self._connection().execute("SELECT * FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return dict(row) if row else None
+
+    def active_owner(self, session_id: str) -> Optional[str]:
+        """Owner of a running session, or None if nobody is running it."""
+        session = self.get(session_id)
+        if session is None or session["state"] != RUNNING or not self._owner_alive(session["owner"]):
+            return None
+        return session["owner"]
+
+    def claim(self, session_id: str, user_id: str) -> Optional[str]:
+        """Record this worker as the owner of a new run of the session.
+
+        The check and the write happen in one write transaction (BEGIN
+        IMMEDIATE), so two workers can't both claim the session. Returns None
+        when claimed, or the live owner that is already running it.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT owner, state FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is not None and row["state"] == RUNNING and row["owner"] != self.owner and self._owner_alive(row["owner"]):
+                conn.rollback()
+                return row["owner"]
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, user_id, owner, state, started_at, stop_requested) "
+                "VALUES (?, ?, ?, ?, ?, 0)",
+                (session_id, user_id, self.owner, RUNNING, time.time()),
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return None
+
+    def touch(self, session_id: str, last_event_id: int, last_event_at: float) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "UPDATE sessions SET last_event_id = ?, last_event_at = ? WHERE session_id = ? AND owner = ?",
+                (last_event_id, last_event_at, session_id, self.owner),
+            )
+
+    def finish(self, session_id: str, state: str) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "UPDATE sessions SET state = ? WHERE session_id = ? AND owner = ?", (state, session_id, self.owner)
+            )
+
+    def request_stop(self, session_id: str) -> Optional[str]:
+        """Flag a running session for its owner to cancel; returns the owner, or None."""
+        owner = self.active_owner(session_id)
+        if owner is None:
+            return None
+        conn = self._connection()
+        with conn:
+            conn.execute("UPDATE sessions SET stop_requested = 1 WHERE session_id = ?", (session_id,))
+        return owner
+
+    def pending_stops(self) -> List[str]:
+        rows = self._connection().execute(
+            "SELECT session_id FROM sessions WHERE owner = ? AND stop_requested = 1 AND state = ?",
+            (self.owner, RUNNING),
+        ).fetchall()
+        return [row["session_id"] for row in rows]
+
+    def abandon_stale(self) -> int:
+        """Mark running sessions of dead workers on this host as abandoned."""
+        rows = self._connection().execute("SELECT session_id, owner FROM sessions WHERE state = ?", (RUNNING,)).fetchall()
+        stale = [row["session_id"] for row in rows if not self._owner_alive(row["owner"])]
+        if stale:
+            conn = self._connection()
+            with conn:
+                conn.executemany("UPDATE sessions SET state = 'abandoned' WHERE session_id = ?", [(s,) for s in stale])
+        return len(stale)
@@ -0,0 +1,424 @@
+"""
+SQLite-backed local conversation store.
+
+Drop-in alternative to the file-per-session logs in crud.py, enabled with
+CONVERSATION_STORE=sqlite. Conversation headers live in `conversations` with
+indexes on (user_id, session_id) and (user_id, timestamp); messages live in
+`messages` keyed by (conversation_pk, seq), so listing and lookups are index
+seeks instead of parsing every file in data/conversations.
+
+The database runs in WAL mode so readers do not block the writer. Each thread
+gets its own connection (crud is called from asyncio.to_thread workers) and
+writes are serialized with a lock.
+
+SQLiteStorage wraps the same database as a full storage backend (conversations,
+run statistics and teams) for STORAGE_BACKEND=local.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from autogen_message import encode_message
+from storage import Storage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    pk INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    agents TEXT,
+    run_mode_locally TEXT,
+    timestamp TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_conversations_user_session ON conversations (user_id, session_id);
+CREATE INDEX IF NOT EXISTS ix_conversations_user_timestamp ON conversations (user_id, timestamp);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_pk INTEGER NOT NULL REFERENCES conversations (pk) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (conversation_pk, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS stream_events (
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    frame TEXT NOT NULL,
+    PRIMARY KEY (user_id, session_id, id)
+) WITHOUT ROWID;
+"""
+
+
+class SQLiteConversationStore:
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _header_from_row(row: sqlite3.Row) -> dict:
+        return {
+            "id": row["id"],
+            "user_id": row["user_id"],
+            "session_id": row["session_id"],
+            "agents": json.loads(row["agents"]) if row["agents"] is not None else None,
+            "run_mode_locally": json.loads(row["run_mode_locally"]) if row["run_mode_locally"] is not None else None,
+            "timestamp": row["timestamp"],
+        }
+
+    def _load(self, conn: sqlite3.Connection, row: sqlite3.Row, start: int = 0, limit: Optional[int] = None) -> dict:
+        conversation = self._header_from_row(row)
+        bodies = conn.execute(
+            "SELECT body FROM messages WHERE conversation_pk = ? AND seq >= ? ORDER BY seq LIMIT ?",
+            (row["pk"], start, -1 if limit is None else limit),
+        )
+        conversation["messages"] = [json.loads(b["body"]) for b in bodies]
+        return conversation
+
+    def save_messages(self, id, user_id: str, session_id: str, messages: Iterable[dict], agents, run_mode_locally, timestamp: str) -> Optional[dict]:
+        conn = self._connection()
+        header = None
+        with self._write_lock, conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO conversations (id, user_id, session_id, agents, run_mode_locally, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (str(id), user_id, session_id, json.dumps(agents), json.dumps(run_mode_locally), timestamp),
+            )
+            row = conn.execute(
+                "SELECT * FROM conversations WHERE user_id = ? AND session_id = ?", (user_id, session_id)
+            ).fetchone()
+            if cursor.rowcount:
+                header = self._header_from_row(row)
+            next_seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE conversation_pk = ?", (row["pk"],)
+            ).fetchone()[0]
+            conn.executemany(
+                "INSERT INTO messages (conversation_pk, seq, body) VALUES (?, ?, ?)",
+                [(row["pk"], next_seq + i, encode_message(m)) for i, m in enumerate(messages)],
+            )
+        return header
+
+    def get_header(self, user_id: str, session_id: str) -> Optional[dict]:
+        row = self._connection().execute(
+            "SELECT * FROM conversations WHERE user_id = ? AND session_id = ?", (user_id, session_id)
+        ).fetchone()
+        return self._header_from_row(row) if row else None
+
+    def get_conversation(self, user_id: str, session_id: str, start: int = 0, limit: Optional[int] = None) -> Optional[dict]:
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT * FROM conversations WHERE user_id = ? AND session_id = ?", (user_id, session_id)
+        ).fetchone()
+        return self._load(conn, row, start, limit) if row else None
+
+    def count_conversations(self, user_id: Optional[str] = None) -> int:
+        conn = self._connection()
+        if user_id is None:
+            return conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+        return conn.execute("SELECT COUNT(*) FROM conversations WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+    def list_headers(self, user_id: Optional[str], limit: int, skip: int = 0, after: Optional[Tuple[str, int]] = None) -> List[dict]:
+        """Headers newest first, without messages. `after` is the (timestamp, pk) of the last row of the previous page."""
+        clauses, parameters = [], []
+        if user_id is not None:
+            clauses.append("user_id = ?")
+            parameters.append(user_id)
+        if after is not None:
+            ts, pk = after
+            if pk is None:
+                clauses.append("timestamp < ?")
+                parameters.append(ts)
+            else:
+                clauses.append("(timestamp < ? OR (timestamp = ? AND pk < ?))")
+                parameters.extend([ts, ts, pk])
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+        rows = self._connection().execute(
+            f"SELECT * FROM conversations {where}ORDER BY timestamp DESC, pk DESC LIMIT ? OFFSET ?",
+            (*parameters, limit, skip),
+        ).fetchall()
+        return [{**self._header_from_row(row), "pk": row["pk"]} for row in rows]
+
+    def get_all_conversations(self) -> List[dict]:
+        conn = self._connection()
+        rows = conn.execute("SELECT * FROM conversations ORDER BY timestamp DESC").fetchall()
+        return [self._load(conn, row) for row in rows]
+
+    def get_user_conversations(self, user_id: str) -> List[dict]:
+        conn = self._connection()
+        rows = conn.execute(
+            "SELECT * FROM conversations WHERE user_id = ? ORDER BY timestamp DESC", (user_id,)
+        ).fetchall()
+        return [self._load(conn, row) for row in rows]
+
+    def delete_conversation(self, user_id: str, session_id: str) -> bool:
+        conn = self._connection()
+        with self._write_lock, conn:
+            cursor = conn.execute(
+                "DELETE FROM conversations WHERE user_id = ? AND session_id = ?", (user_id, session_id)
+            )
+        return cursor.rowcount > 0
+
+    def delete_user_conversations(self, user_id: str) -> int:
+        conn = self._connection()
+        with self._write_lock, conn:
+            cursor = conn.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+        return cursor.rowcount
+
+    def save_stream_events(self, user_id: str, session_id: str, events: List[Tuple[int, str]]) -> None:
+        conn = self._connection()
+        with self._write_lock, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO stream_events (user_id, session_id, id, frame) VALUES (?, ?, ?, ?)",
+                [(user_id, session_id, event_id, frame) for event_id, frame in events],
+            )
+
+    def get_stream_events(self, user_id: str, session_id: str, after_id: int) -> List[Tuple[int, str]]:
+        rows = self._connection().execute(
+            "SELECT id, frame FROM stream_events WHERE user_id = ? AND session_id = ? AND id > ? ORDER BY id",
+            (user_id, session_id, after_id),
+        ).fetchall()
+        return [(row["id"], row["frame"]) for row in rows]
+
+    def delete_stream_events(self, user_id: str, session_id: str) -> None:
+        conn = self._connection()
+        with self._write_lock, conn:
+            conn.execute("DELETE FROM stream_events WHERE user_id = ? AND session_id = ?", (user_id, session_id))
+
+    def import_conversation(self, conversation: dict) -> bool:
+        """Insert a complete conversation document unless the session already exists."""
+        if self.get_conversation(conversation["user_id"], conversation["session_id"]) is not None:
+            return False
+        self.save_messages(
+            conversation.get("id"),
+            conversation["user_id"],
+            conversation["session_id"],
+            conversation.get("messages") or [],
+            conversation.get("agents"),
+            conversation.get("run_mode_locally"),
+            conversation.get("timestamp"),
+        )
+        return True
+
+
+STORAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversation_stats (
+    date TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (date, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS teams (
+    team_id TEXT PRIMARY KEY,
+    body TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class SQLiteStorage(Storage):
+    """Storage backend on a local SQLite file (STORAGE_BACKEND=local).
+
+    Conversations use SQLiteConversationStore; run statistics and teams get
+    their own tables in the same database. Every call runs in a worker thread.
+    """
+
+    name = "local"
+
+    def __init__(self, path: str):
+        self.store = SQLiteConversationStore(path)
+        conn = self.store._connection()
+        conn.executescript(STORAGE_SCHEMA)
+        # Date the conversation was counted in conversation_stats (NULL: never counted)
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(conversations)")}
+        if "counted_date" not in columns:
+            conn.execute("ALTER TABLE conversations ADD COLUMN counted_date TEXT")
+
+    # ---------------- conversations ----------------
+    def _start_conversation(self, user_id, session_id, agents, timestamp, run_mode_locally):
+        conn = self.store._connection()
+        with self.store._write_lock, conn:
+            conn.execute(
+                "INSERT INTO conversations (id, user_id, session_id, agents, run_mode_locally, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id, session_id) DO UPDATE SET agents = excluded.agents, "
+                "run_mode_locally = excluded.run_mode_locally, timestamp = excluded.timestamp",
+                (session_id, user_id, session_id, json.dumps(agents), json.dumps(run_mode_locally), timestamp),
+            )
+        return self.store.get_header(user_id, session_id)
+
+    async def start_conversation(self, user_id: str, session_id: str, agents, timestamp: str, run_mode_locally: bool = False):
+        return await asyncio.to_thread(self._start_conversation, user_id, session_id, agents, timestamp, run_mode_locally)
+
+    async def append_conversation_messages(self, user_id: str, session_id: str, messages: List[Dict], timestamp: str = None):
+        await asyncio.to_thread(self.store.save_messages, session_id, user_id, session_id, messages, None, None, timestamp)
+
+    def _finish_conversation(self, user_id: str, session_id: str, timestamp: str):
+        conn = self.store._connection()
+        with self.store._write_lock, conn:
+            cursor = conn.execute(
+                "UPDATE conversations SET counted_date = ? WHERE user_id = ? AND session_id = ? AND counted_date IS NULL",
+                (timestamp[:10], user_id, session_id),
+            )
+            if not cursor.rowcount:
+                return  # already counted, or deleted while it was running
+            conn.execute(
+                "INSERT INTO conversation_stats (date, user_id, count) VALUES (?, ?, 1) "
+                "ON CONFLICT (date, user_id) DO UPDATE SET count = count + 1",
+                (timestamp[:10], user_id),
+            )
+
+    async def finish_conversation(self, user_id: str, session_id: str, timestamp: str):
+        await asyncio.to_thread(self._finish_conversation, user_id, session_id, timestamp)
+
+    async def fetch_user_conversatons(self, user_id: Optional[str] = None, page: int = 1, page_size: int = 20) -> Dict:
+        total_count = await asyncio.to_thread(self.store.count_conversations, user_id)
+        page, total_pages, skip = self.page_bounds(total_count, page, page_size)
+        items = await asyncio.to_thread(self.store.list_headers, user_id, page_size, skip=skip)
+        return {
+            "conversations": [self._summary(item) for item in items],
+            "total_count": total_count,
+            "page": page,
+            "total_pages": total_pages
+        }
+
+    async def fetch_conversations_page(self, user_id: Optional[str] = None, cursor: Optional[str] = None, page_size: int = 20, include_count: bool = False) -> Dict:
+        position = self.decode_cursor(cursor) if cursor else None
+        after = (position["ts"], position.get("pk")) if position else None
+        items = await asyncio.to_thread(self.store.list_headers, user_id, page_size, after=after)
+        next_cursor = None
+        if len(items) == page_size:
+            last = items[-1]
+            next_cursor = self.encode_cursor({"ts": last["timestamp"], "pk": last["pk"]})
+        result = {"conversations": [self._summary(item) for item in items], "next_cursor": next_cursor}
+        if include_count:
+            result["total_count"] = await asyncio.to_thread(self.store.count_conversations, user_id)
+        return result
+
+    async def fetch_user_conversation(self, user_id: str, session_id: str, start: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        conversation = await asyncio.to_thread(self.store.get_conversation, user_id, session_id, start, limit)
+        if conversation is None:
+            return []
+        conversation["messages_start"] = start
+        return [conversation]
+
+    def _delete_conversations(self, user_id: str, session_id: Optional[str] = None) -> int:
+        # Delete the conversations and take them off the daily counters in one transaction
+        where, parameters = ("user_id = ?", (user_id,)) if session_id is None else ("user_id = ? AND session_id = ?", (user_id, session_id))
+        conn = self.store._connection()
+        with self.store._write_lock, conn:
+            dates = [row[0] for row in conn.execute(f"SELECT counted_date FROM conversations WHERE {where} AND counted_date IS NOT NULL", parameters)]
+            cursor = conn.execute(f"DELETE FROM conversations WHERE {where}", parameters)
+            conn.executemany(
+                "UPDATE conversation_stats SET count = MAX(count - 1, 0) WHERE date = ? AND user_id = ?",
+                [(date, user_id) for date in dates],
+            )
+        return cursor.rowcount
+
+    async def delete_user_conversation(self, user_id: str, session_id: str):
+        if not await asyncio.to_thread(self._delete_conversations, user_id, session_id):
+            return {"error": f"No conversation found with user_id {user_id} and session_id {session_id}."}
+        return True
+
+    async def delete_user_all_conversations(self, user_id: str):
+        if not await asyncio.to_thread(self._delete_conversations, user_id):
+            return {"error": f"No conversation found with user_id {user_id}."}
+        return True
+
+    @staticmethod
+    def _summary(header: Dict) -> Dict:
+        return {k: header[k] for k in ("id", "user_id", "session_id", "timestamp")}
+
+    # ---------------- stats ----------------
+    def _fetch_conversation_stats(self, start_date: str, end_date: str) -> List[Dict]:
+        rows = self.store._connection().execute(
+            "SELECT user_id, date, count FROM conversation_stats WHERE date BETWEEN ? AND ?",
+            (start_date, end_date),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    async def fetch_conversation_stats(self, start_date: str, end_date: str) -> List[Dict]:
+        rows = await asyncio.to_thread(self._fetch_conversation_stats, start_date, end_date)
+        return self.sort_stats(rows)
+
+    # ---------------- teams ----------------
+    def _write_teams(self, documents: List[Dict], replace: bool = True) -> None:
+        conn = self.store._connection()
+        verb = "INSERT OR REPLACE" if replace else "INSERT"
+        with self.store._write_lock, conn:
+            conn.executemany(
+                f"{verb} INTO teams (team_id, body) VALUES (?, ?)",
+                [(doc["team_id"], json.dumps(doc)) for doc in documents],
+            )
+
+    def _read_teams(self, team_id: Optional[str] = None) -> List[Dict]:
+        conn = self.store._connection()
+        if team_id is None:
+            rows = conn.execute("SELECT body FROM teams ORDER BY team_id").fetchall()
+        else:
+            rows = conn.execute("SELECT body FROM teams WHERE team_id = ?", (team_id,)).fetchall()
+        return [json.loads(row["body"]) for row in rows]
+
+    def _delete_team(self, team_id: str) -> bool:
+        conn = self.store._connection()
+        with self.store._write_lock, conn:
+            cursor = conn.execute("DELETE FROM teams WHERE team_id = ?", (team_id,))
+        return cursor.rowcount > 0
+
+    async def create_team(self, team: dict):
+        document = self.build_team_document(team)
+        try:
+            await asyncio.to_thread(self._write_teams, [document], False)
+        except sqlite3.IntegrityError:
+            raise ValueError(f"Team {document['team_id']} already exists")
+        return document
+
+    async def get_teams(self) -> List[Dict]:
+        return await asyncio.to_thread(self._read_teams)
+
+    async def get_team(self, team_id: str) -> Optional[Dict]:
+        teams = await asyncio.to_thread(self._read_teams, team_id)
+        return teams[0] if teams else None
+
+    async def update_team(self, team_id: str, team: dict):
+        existing_team = await self.get_team(team_id)
+        if not existing_team:
+            return {"error": "Team not found"}
+        document = {**existing_team, **team, "team_id": team_id}
+        await asyncio.to_thread(self._write_teams, [document])
+        return document
+
+    async def delete_team(self, team_id: str):
+        if not await asyncio.to_thread(self._delete_team, team_id):
+            return {"error": "Team not found"}
+        return {"status": "deleted", "team_id": team_id}
+
+    async def upsert_teams(self, teams: List[Dict]) -> List[Dict]:
+        documents = [self.build_team_document(team) for team in teams]
+        await asyncio.to_thread(self._write_teams, documents)
+        return documents
+
+    def metrics(self) -> Dict:
+        conn = self.store._connection()
+        return {
+            "path": self.store.path,
+            "conversations": conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0],
+            "teams": conn.execute("SELECT COUNT(*) FROM teams").fetchone()[0],
+        }
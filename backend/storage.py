@@ -0,0 +1,361 @@
+"""
+Storage backends for conversations, run statistics and agent teams.
+
+The API (main.py) talks to `app.state.db`, which is any `Storage`. The backend
+is selected with STORAGE_BACKEND:
+
+- cosmos (default): AsyncCosmosDB (database.py), Azure Cosmos DB
+- local: SQLiteStorage (sqlite_store.py), an embedded SQLite file at STORAGE_SQLITE_PATH
+- memory: MemoryStorage, process memory only, for load tests and local benchmarks
+"""
+import base64
+import glob
+import json
+import os
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+
+class StorageBase:
+    """Backend-independent helpers shared by all storage implementations."""
+
+    @staticmethod
+    def assemble_conversation(header: Dict, message_rows: List[Dict], start: int = 0) -> Dict:
+        conversation = {k: v for k, v in header.items() if not k.startswith("_")}
+        conversation["messages"] = [row["message"] for row in message_rows]
+        conversation["messages_start"] = start
+        return conversation
+
+    @staticmethod
+    def build_team_document(team: dict) -> dict:
+        return {
+            "id": team["id"],
+            "team_id": team["team_id"],
+            "name": team["name"],
+            "agents": team["agents"],
+            "description": team.get("description"),
+            "logo": team["logo"],
+            "plan": team["plan"],
+            "starting_tasks": team["starting_tasks"],
+        }
+
+    @staticmethod
+    def page_bounds(total_count: int, page: int, page_size: int):
+        # Calculate total pages
+        total_pages = (total_count + page_size - 1) // page_size if total_count > 0 else 1
+        # Ensure page is within valid range
+        page = max(1, min(page, total_pages))
+        # Calculate skip for pagination
+        skip = (page - 1) * page_size
+        return page, total_pages, skip
+
+    @staticmethod
+    def encode_cursor(position: Dict) -> str:
+        raw = json.dumps(position, separators=(",", ":")).encode("utf-8")
+        return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Dict:
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            position = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        except Exception:
+            raise ValueError("Invalid conversation cursor")
+        if not isinstance(position, dict) or "ts" not in position:
+            raise ValueError("Invalid conversation cursor")
+        position.setdefault("ids", [])
+        return position
+
+    def next_cursor(self, items: List[Dict], position: Optional[Dict], limit: int) -> Optional[str]:
+        """Cursor after the last item: its timestamp plus the ids already returned with that timestamp."""
+        if len(items) < limit:
+            return None
+        last_ts = items[-1]["timestamp"]
+        ids = [i["id"] for i in items if i["timestamp"] == last_ts]
+        if position is not None and position["ts"] == last_ts:
+            ids = position["ids"] + ids
+        return self.encode_cursor({"ts": last_ts, "ids": ids})
+
+    @staticmethod
+    def aggregate_stats(rows) -> List[Dict]:
+        # Aggregate in Python: {(user_id, date): count}
+        counts = {}
+        for r in rows:
+            user_id = r.get("user_id")
+            date = r.get("date")
+            if not user_id or not date:
+                continue
+            key = (user_id, date)
+            counts[key] = counts.get(key, 0) + 1
+
+        # Convert to list of dicts like: {"user_id": ..., "date": "YYYY-MM-DD", "count": N}
+        items = [
+            {"user_id": k[0], "date": k[1], "count": v}
+            for k, v in counts.items()
+        ]
+        # Optional: sort by date then user for stable ordering
+        items.sort(key=lambda d: (d["date"], d["user_id"]))
+        return items
+
+    @staticmethod
+    def sort_stats(items: List[Dict]) -> List[Dict]:
+        items = [{"user_id": i["user_id"], "date": i["date"], "count": i["count"]} for i in items]
+        items.sort(key=lambda d: (d["date"], d["user_id"]))
+        return items
+
+    @staticmethod
+    def chunked(items: List, size: int) -> List[List]:
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    @staticmethod
+    def load_team_definitions() -> List[Dict]:
+        teams_folder = os.path.join(os.path.dirname(__file__), "./data/teams-definitions")
+        json_files = glob.glob(os.path.join(teams_folder, "*.json"))
+        json_files.sort()
+        print(f"Found {len(json_files)} JSON files in {teams_folder}.")
+        teams = []
+        for file_path in json_files:
+            with open(file_path, "r") as f:
+                team = json.load(f)
+            if "id" not in team or "team_id" not in team:
+                # e.g. MACAE-team-template.json is a JSON schema, not a team
+                print(f"Skipping {os.path.basename(file_path)}: not a team definition.")
+                continue
+            teams.append(team)
+        return teams
+
+
+class Storage(StorageBase, ABC):
+    """Async storage interface used by the API endpoints."""
+
+    name = "storage"
+
+    # ---------------- conversations ----------------
+    @abstractmethod
+    async def start_conversation(self, user_id: str, session_id: str, agents, timestamp: str, run_mode_locally: bool = False): ...
+
+    @abstractmethod
+    async def append_conversation_messages(self, user_id: str, session_id: str, messages: List[Dict], timestamp: str = None): ...
+
+    @abstractmethod
+    async def finish_conversation(self, user_id: str, session_id: str, timestamp: str):
+        """Count the finished run in the daily stats, once, and record the counted date on its header.
+
+        Deleting a conversation decrements only headers with a counted date, on
+        that date, so runs that never finished are not taken off the counters.
+        """
+
+    @abstractmethod
+    async def fetch_user_conversatons(self, user_id: Optional[str] = None, page: int = 1, page_size: int = 20) -> Dict: ...
+
+    @abstractmethod
+    async def fetch_conversations_page(self, user_id: Optional[str] = None, cursor: Optional[str] = None, page_size: int = 20, include_count: bool = False) -> Dict: ...
+
+    @abstractmethod
+    async def fetch_user_conversation(self, user_id: str, session_id: str, start: int = 0, limit: Optional[int] = None) -> List[Dict]: ...
+
+    @abstractmethod
+    async def delete_user_conversation(self, user_id: str, session_id: str): ...
+
+    @abstractmethod
+    async def delete_user_all_conversations(self, user_id: str): ...
+
+    # ---------------- stats ----------------
+    @abstractmethod
+    async def fetch_conversation_stats(self, start_date: str, end_date: str) -> List[Dict]: ...
+
+    # ---------------- teams ----------------
+    @abstractmethod
+    async def create_team(self, team: dict): ...
+
+    @abstractmethod
+    async def get_teams(self) -> List[Dict]: ...
+
+    @abstractmethod
+    async def get_team(self, team_id: str) -> Optional[Dict]: ...
+
+    @abstractmethod
+    async def update_team(self, team_id: str, team: dict): ...
+
+    @abstractmethod
+    async def delete_team(self, team_id: str): ...
+
+    @abstractmethod
+    async def upsert_teams(self, teams: List[Dict]) -> List[Dict]: ...
+
+    async def initialize_teams(self):
+        teams = self.load_team_definitions()
+        await self.upsert_teams(teams)
+        print(f"Upserted {len(teams)}/{len(teams)} items in the database.")
+        return f"Successfully created {len(teams)} teams."
+
+    # ---------------- lifecycle ----------------
+    async def close(self):
+        pass
+
+    def metrics(self) -> Dict:
+        return {}
+
+
+class MemoryStorage(Storage):
+    """Keeps everything in process memory. Data is lost on restart and not shared between workers."""
+
+    name = "memory"
+
+    def __init__(self):
+        self.headers: Dict[Tuple[str, str], Dict] = {}
+        self.messages: Dict[Tuple[str, str], List[Dict]] = {}
+        self.stats: Dict[Tuple[str, str], int] = {}
+        self.teams: Dict[str, Dict] = {}
+
+    @staticmethod
+    def _summary(header: Dict) -> Dict:
+        return {k: header[k] for k in ("id", "user_id", "session_id", "timestamp")}
+
+    def _sorted_headers(self, user_id: Optional[str]) -> List[Dict]:
+        headers = [h for h in self.headers.values() if user_id is None or h["user_id"] == user_id]
+        headers.sort(key=lambda h: h["timestamp"] or "", reverse=True)
+        return headers
+
+    async def start_conversation(self, user_id: str, session_id: str, agents, timestamp: str, run_mode_locally: bool = False):
+        header = {
+            "id": session_id,
+            "user_id": user_id,
+            "session_id": session_id,
+            "agents": agents,
+            "run_mode_locally": run_mode_locally,
+            "timestamp": timestamp,
+        }
+        self.headers[(user_id, session_id)] = header
+        self.messages[(user_id, session_id)] = []
+        return header
+
+    async def append_conversation_messages(self, user_id: str, session_id: str, messages: List[Dict], timestamp: str = None):
+        if (user_id, session_id) not in self.headers:
+            await self.start_conversation(user_id, session_id, None, timestamp)
+        self.messages[(user_id, session_id)].extend(messages)
+
+    async def finish_conversation(self, user_id: str, session_id: str, timestamp: str):
+        header = self.headers.get((user_id, session_id))
+        if header is None or header.get("counted_date"):
+            return
+        header["counted_date"] = timestamp[:10]
+        key = (header["counted_date"], user_id)
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+    async def fetch_user_conversatons(self, user_id: Optional[str] = None, page: int = 1, page_size: int = 20) -> Dict:
+        headers = self._sorted_headers(user_id)
+        page, total_pages, skip = self.page_bounds(len(headers), page, page_size)
+        return {
+            "conversations": [self._summary(h) for h in headers[skip:skip + page_size]],
+            "total_count": len(headers),
+            "page": page,
+            "total_pages": total_pages
+        }
+
+    async def fetch_conversations_page(self, user_id: Optional[str] = None, cursor: Optional[str] = None, page_size: int = 20, include_count: bool = False) -> Dict:
+        position = self.decode_cursor(cursor) if cursor else None
+        headers = self._sorted_headers(user_id)
+        if position is not None:
+            seen = set(position["ids"])
+            headers = [h for h in headers if h["timestamp"] <= position["ts"] and h["id"] not in seen]
+        items = [self._summary(h) for h in headers[:page_size]]
+        result = {"conversations": items, "next_cursor": self.next_cursor(items, position, page_size)}
+        if include_count:
+            result["total_count"] = len(self._sorted_headers(user_id))
+        return result
+
+    async def fetch_user_conversation(self, user_id: str, session_id: str, start: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        header = self.headers.get((user_id, session_id))
+        if header is None:
+            return []
+        messages = self.messages[(user_id, session_id)]
+        end = len(messages) if limit is None else start + limit
+        rows = [{"message": m} for m in messages[start:end]]
+        return [self.assemble_conversation(header, rows, start)]
+
+    def _delete(self, key: Tuple[str, str]) -> None:
+        header = self.headers.pop(key)
+        self.messages.pop(key, None)
+        # Keep the daily counters in line with the stored conversations
+        if header.get("counted_date"):
+            stats_key = (header["counted_date"], key[0])
+            if self.stats.get(stats_key):
+                self.stats[stats_key] -= 1
+
+    async def delete_user_conversation(self, user_id: str, session_id: str):
+        if (user_id, session_id) not in self.headers:
+            return {"error": f"No conversation found with user_id {user_id} and session_id {session_id}."}
+        self._delete((user_id, session_id))
+        return True
+
+    async def delete_user_all_conversations(self, user_id: str):
+        keys = [key for key in self.headers if key[0] == user_id]
+        if not keys:
+            return {"error": f"No conversation found with user_id {user_id}."}
+        for key in keys:
+            self._delete(key)
+        return True
+
+    async def fetch_conversation_stats(self, start_date: str, end_date: str) -> List[Dict]:
+        items = [
+            {"user_id": user_id, "date": date, "count": count}
+            for (date, user_id), count in self.stats.items()
+            if start_date <= date <= end_date
+        ]
+        return self.sort_stats(items)
+
+    async def create_team(self, team: dict):
+        document = self.build_team_document(team)
+        if document["team_id"] in self.teams:
+            raise ValueError(f"Team {document['team_id']} already exists")
+        self.teams[document["team_id"]] = document
+        return document
+
+    async def get_teams(self) -> List[Dict]:
+        return list(self.teams.values())
+
+    async def get_team(self, team_id: str) -> Optional[Dict]:
+        return self.teams.get(team_id)
+
+    async def update_team(self, team_id: str, team: dict):
+        existing_team = self.teams.get(team_id)
+        if not existing_team:
+            return {"error": "Team not found"}
+        self.teams[team_id] = {**existing_team, **team}
+        return self.teams[team_id]
+
+    async def delete_team(self, team_id: str):
+        if self.teams.pop(team_id, None) is None:
+            return {"error": "Team not found"}
+        return {"status": "deleted", "team_id": team_id}
+
+    async def upsert_teams(self, teams: List[Dict]) -> List[Dict]:
+        documents = [self.build_team_document(team) for team in teams]
+        for document in documents:
+            self.teams[document["team_id"]] = document
+        return documents
+
+    def metrics(self) -> Dict:
+        return {
+            "conversations": len(self.headers),
+            "messages": sum(len(m) for m in self.messages.values()),
+            "teams": len(self.teams),
+        }
+
+
+async def create_storage() -> Storage:
+    """Create the storage backend selected by STORAGE_BACKEND (cosmos, local or memory)."""
+    backend = os.getenv("STORAGE_BACKEND", "cosmos").lower()
+    if backend == "memory":
+        storage = MemoryStorage()
+        if os.getenv("STORAGE_SEED_TEAMS", "true").lower() in ("1", "true", "yes", "on"):
+            await storage.upsert_teams(storage.load_team_definitions())
+        return storage
+    if backend == "local":
+        from sqlite_store import SQLiteStorage
+        return SQLiteStorage(os.getenv("STORAGE_SQLITE_PATH", "./data/storage.db"))
+    if backend == "cosmos":
+        from database import AsyncCosmosDB
+        return await AsyncCosmosDB.create()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
@@ -0,0 +1,122 @@
+"""
+In-process cache for agent team documents.
+
+Used by AsyncCosmosDB so that /teams, /teams/{id}, team download and update do
+not hit Cosmos DB on every request. Entries are fresh for `ttl` seconds; after
+that the caller revalidates them (ETag for single teams, a count/_ts probe for
+the list) and calls `touch*` when nothing changed, which is much cheaper than
+re-reading the documents.
+"""
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+
+class _Entry:
+    __slots__ = ("doc", "etag", "expires")
+
+    def __init__(self, doc: Dict, expires: float):
+        self.doc = doc
+        self.etag = doc.get("_etag")
+        self.expires = expires
+
+
+class TeamCache:
+    def __init__(self, ttl: float = None):
+        # The cache is per worker process: a team changed through another worker (or
+        # replica) can be served stale here for up to TEAM_CACHE_TTL_SECONDS.
+        self.ttl = ttl if ttl is not None else float(os.getenv("TEAM_CACHE_TTL_SECONDS", "30"))
+        self._teams: Dict[str, _Entry] = {}
+        self._list_ids: Optional[List[str]] = None
+        self._list_version: Any = None
+        self._list_expires = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def _now(self) -> float:
+        return time.monotonic()
+
+    # ---------------- single team ----------------
+    def get(self, team_id: str) -> Optional[_Entry]:
+        return self._teams.get(team_id)
+
+    def is_fresh(self, entry: Optional[_Entry]) -> bool:
+        fresh = entry is not None and entry.expires > self._now()
+        if fresh:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return fresh
+
+    def item_id(self, team_id: str) -> Optional[str]:
+        entry = self._teams.get(team_id)
+        return entry.doc.get("id") if entry else None
+
+    def put(self, doc: Dict) -> Dict:
+        self._teams[doc["team_id"]] = _Entry(doc, self._now() + self.ttl)
+        return doc
+
+    def touch(self, team_id: str) -> None:
+        entry = self._teams.get(team_id)
+        if entry is not None:
+            self.revalidations += 1
+            entry.expires = self._now() + self.ttl
+
+    def invalidate(self, team_id: str) -> None:
+        self._teams.pop(team_id, None)
+        self.invalidate_list()
+
+    # ---------------- team list ----------------
+    def get_list(self) -> Optional[List[Dict]]:
+        if self._list_ids is None:
+            return None
+        docs = []
+        for team_id in self._list_ids:
+            entry = self._teams.get(team_id)
+            if entry is None:
+                return None
+            docs.append(entry.doc)
+        return docs
+
+    def list_is_fresh(self) -> bool:
+        fresh = self._list_ids is not None and self._list_expires > self._now()
+        if fresh:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return fresh
+
+    @property
+    def list_version(self) -> Any:
+        return self._list_version
+
+    def put_list(self, docs: List[Dict], version: Any) -> List[Dict]:
+        for doc in docs:
+            self.put(doc)
+        self._list_ids = [doc["team_id"] for doc in docs]
+        self._list_version = version
+        self._list_expires = self._now() + self.ttl
+        return docs
+
+    def touch_list(self) -> None:
+        self.revalidations += 1
+        self._list_expires = self._now() + self.ttl
+        for team_id in self._list_ids or []:
+            entry = self._teams.get(team_id)
+            if entry is not None:
+                entry.expires = self._list_expires
+
+    def invalidate_list(self) -> None:
+        self._list_ids = None
+        self._list_version = None
+        self._list_expires = 0.0
+
+    def metrics(self) -> Dict:
+        return {
+            "teams": len(self._teams),
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "ttl_seconds": self.ttl,
+        }
@@ -0,0 +1,49 @@
+"""Daily run counters stay in line with the conversations when they are deleted."""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlite_store import SQLiteStorage  # noqa: E402
+from storage import MemoryStorage  # noqa: E402
+
+DAY = "2025-01-01"
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStorage()
+    return SQLiteStorage(str(tmp_path / "storage.db"))
+
+
+def count(storage) -> int:
+    rows = asyncio.run(storage.fetch_conversation_stats(DAY, DAY))
+    return sum(row["count"] for row in rows)
+
+
+def start(storage, session_id, timestamp=f"{DAY} 10:00:00"):
+    asyncio.run(storage.start_conversation("user@example.com", session_id, [], timestamp))
+
+
+def test_deleting_unfinished_session_keeps_counter(storage):
+    start(storage, "finished")
+    asyncio.run(storage.finish_conversation("user@example.com", "finished", f"{DAY} 10:05:00"))
+    start(storage, "unfinished")
+
+    assert asyncio.run(storage.delete_user_conversation("user@example.com", "unfinished")) is True
+    assert count(storage) == 1
+
+
+def test_finish_counts_once_and_delete_uses_counted_date(storage):
+    # Started just before midnight, finished the next day: counted (and decremented) on the finish day
+    start(storage, "late", "2024-12-31 23:59:00")
+    asyncio.run(storage.finish_conversation("user@example.com", "late", f"{DAY} 00:01:00"))
+    asyncio.run(storage.finish_conversation("user@example.com", "late", f"{DAY} 00:01:00"))
+    assert count(storage) == 1
+
+    assert asyncio.run(storage.delete_user_all_conversations("user@example.com")) is True
+    assert count(storage) == 0
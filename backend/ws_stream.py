@@ -0,0 +1,136 @@
+"""
+WebSocket transport for a run's event stream (/ws/chat-stream).
+
+It carries the same frames as /chat-stream (through a SubscriberStream, so
+buffering, dropping and heartbeats behave the same) as JSON text messages:
+
+    {"type": "event", "id": 12, "event": "replace", "data": {...}}
+    {"type": "heartbeat"}
+    {"type": "end"}
+
+and accepts control messages from the client on the same connection:
+
+    {"type": "stop"}                        cancel the run (no separate /stop call)
+    {"type": "pause"}                       stop sending; the run keeps going
+    {"type": "resume", "last_event_id": n}  send again from after n (default: last ack, else last sent)
+    {"type": "ack", "id": n}                frames up to n were processed
+
+Each control message gets a {"type": "control", "action": ..., "status": ...}
+reply. Per-message compression (permessage-deflate) is negotiated by uvicorn's
+websockets implementation when the client offers it, which browsers do.
+"""
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+from starlette.websockets import WebSocket, WebSocketDisconnect, WebSocketState
+
+from event_stream import HEARTBEAT_FRAME, SubscriberStream
+from run_manager import Run
+
+logger = logging.getLogger("ws_stream")
+
+
+def frame_to_message(frame: str) -> Dict:
+    """Translate an SSE frame ("id:", "event:", "data:" lines) into a WebSocket message."""
+    if frame == HEARTBEAT_FRAME:
+        return {"type": "heartbeat"}
+    message = {"type": "event", "id": None, "event": "message", "data": None}
+    data_lines = []
+    for line in frame.rstrip("\n").split("\n"):
+        field, _, value = line.partition(": ")
+        if field == "id":
+            message["id"] = int(value)
+        elif field == "event":
+            message["event"] = value
+        elif field == "data":
+            data_lines.append(value)
+    data = "\n".join(data_lines)
+    try:
+        message["data"] = json.loads(data)
+    except json.JSONDecodeError:
+        message["data"] = data
+    return message
+
+
+class WebSocketStream:
+    def __init__(self, websocket: WebSocket, run: Run, after_id: int, stop: Callable[[], Awaitable[Dict]]):
+        self.websocket = websocket
+        self.run = run
+        self.stop = stop
+        self.last_sent = after_id
+        self.acked: Optional[int] = None
+        self._sender: Optional[asyncio.Task] = None
+        self._send_lock = asyncio.Lock()
+
+    async def _send(self, message: Dict) -> None:
+        async with self._send_lock:
+            await self.websocket.send_text(json.dumps(message))
+
+    async def _forward(self, after_id: int) -> None:
+        async for frame in SubscriberStream(self.run, after_id).frames():
+            message = frame_to_message(frame)
+            await self._send(message)
+            if message.get("id"):
+                self.last_sent = message["id"]
+        # Run finished: tell the client, then close from our side
+        await self._send({"type": "end"})
+        await self.websocket.close()
+
+    def _start(self, after_id: int) -> None:
+        self._sender = asyncio.create_task(self._forward(after_id))
+
+    async def _pause(self) -> None:
+        if self._sender is None:
+            return
+        sender, self._sender = self._sender, None
+        sender.cancel()
+        try:
+            await sender
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.debug(f"Sender of run {self.run.session_id} ended with: {e}")
+
+    async def _control(self, control: Dict) -> Dict:
+        action = control.get("type")
+        if action == "stop":
+            return {**await self.stop(), "action": action}
+        if action == "pause":
+            await self._pause()
+            return {"status": "ok", "action": action, "last_event_id": self.last_sent}
+        if action == "resume":
+            await self._pause()
+            after_id = control.get("last_event_id")
+            if after_id is None:
+                after_id = self.acked if self.acked is not None else self.last_sent
+            self.last_sent = int(after_id)
+            self._start(self.last_sent)
+            return {"status": "ok", "action": action, "last_event_id": self.last_sent}
+        if action == "ack":
+            self.acked = max(self.acked or 0, int(control.get("id") or 0))
+            return {"status": "ok", "action": action, "id": self.acked}
+        return {"status": "error", "action": action, "message": f"Unknown control message: {action}"}
+
+    async def serve(self) -> None:
+        self._start(self.last_sent)
+        try:
+            while True:
+                try:
+                    control = await self.websocket.receive_json()
+                except (WebSocketDisconnect, RuntimeError):
+                    break  # client left, or we closed it after the run ended
+                except (ValueError, KeyError):
+                    await self._send({"type": "control", "status": "error", "message": "Control messages must be JSON"})
+                    continue
+                if not isinstance(control, dict):
+                    continue
+                try:
+                    reply = await self._control(control)
+                except (TypeError, ValueError) as e:
+                    reply = {"status": "error", "action": control.get("type"), "message": str(e)}
+                if self.websocket.client_state == WebSocketState.CONNECTED:
+                    await self._send({"type": "control", **reply})
+        finally:
+            await self._pause()
@@ -52,6 +52,8 @@ import { Footer } from '@/components/Footer'
 import { BarChart, Bar, CartesianGrid, XAxis, YAxis, Tooltip as RTooltip, ResponsiveContainer } from 'recharts'
 
 const BASE_URL = import.meta.env.VITE_BASE_URL || "https://autogen-demo-be2.whiteground-dbb1b0b8.eastus.azurecontainerapps.io";
+// Images are served by the backend media store (/media/<sha256>); older messages still carry data URIs
+const mediaSrc = (src: string) => (src.startsWith('/media/') ? `${BASE_URL}${src}` : src);
 const ALLWAYS_LOGGED_IN =
   import.meta.env.VITE_ALLWAYS_LOGGED_IN === "true" ? true : false;
 const ACTIVATION_CODE = import.meta.env.VITE_ACTIVATON_CODE || "0000";
@@ -65,6 +67,9 @@ export default function PlaygroundHistory() {
   const [totalPages, setTotalPages] = useState(1);
   const [totalCount, setTotalCount] = useState(0);
   const [pageSize, setPageSize] = useState(20);
+  // cursors[i] is the cursor that loads page i + 1 (page 1 has no cursor)
+  const [cursors, setCursors] = useState<(string | null)[]>([null]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   // Stats state
   const [stats, setStats] = useState<{ start_date: string; end_date: string; buckets: any[]; summary: { total_runs: number; unique_users: number; days: number } } | null>(null)
   const [isStatsLoading, setIsStatsLoading] = useState(true)
@@ -117,20 +122,28 @@ export default function PlaygroundHistory() {
   
 
 
-    async function fetchHistory(userId: string, page = 1, itemsPerPage = 20) {
+    async function fetchHistory(userId: string, page = 1, itemsPerPage = 20, pageCursors: (string | null)[] = [null]) {
       try {
         setIsHistoryLoading(true);
         console.log('Fetching for:', userId, 'page:', page, 'pageSize:', itemsPerPage);
+        // Keyset paging: the total count is only requested with the first page
         const response = await axios.post(`${BASE_URL}/conversations`, { 
           user_id: userId,
-          page: page,
-          page_size: itemsPerPage
+          cursor: pageCursors[page - 1],
+          page_size: itemsPerPage,
+          include_count: page === 1
         });
         console.log('Response:', response.data);
         setHistoryItems(response.data.conversations);
-        setTotalCount(response.data.total_count);
-        setTotalPages(response.data.total_pages);
-        setCurrentPage(response.data.page);
+        if (page === 1) {
+          const count = response.data.total_count ?? 0;
+          setTotalCount(count);
+          setTotalPages(Math.max(1, Math.ceil(count / itemsPerPage)));
+        }
+        const next = response.data.next_cursor ?? null;
+        setNextCursor(next);
+        setCursors(next ? [...pageCursors.slice(0, page), next] : pageCursors.slice(0, page));
+        setCurrentPage(page);
         setPageSize(itemsPerPage);
         setIsHistoryLoading(false);
       } catch (error) {
@@ -384,7 +397,7 @@ export default function PlaygroundHistory() {
                       <Button
                         variant="outline"
                         size="sm"
-                        onClick={() => fetchHistory(userInfo.email, currentPage - 1, pageSize)}
+                        onClick={() => fetchHistory(userInfo.email, currentPage - 1, pageSize, cursors)}
                         disabled={currentPage === 1}
                       >
                         Previous
@@ -395,19 +408,11 @@ export default function PlaygroundHistory() {
                       <Button
                         variant="outline"
                         size="sm"
-                        onClick={() => fetchHistory(userInfo.email, currentPage + 1, pageSize)}
-                        disabled={currentPage === totalPages}
+                        onClick={() => fetchHistory(userInfo.email, currentPage + 1, pageSize, cursors)}
+                        disabled={!nextCursor}
                       >
                         Next
                       </Button>
-                      <Button
-                        variant="outline"
-                        size="sm"
-                        onClick={() => fetchHistory(userInfo.email, totalPages, pageSize)}
-                        disabled={currentPage === totalPages}
-                      >
-                        Last
-                      </Button>
                       <select
                         className="bg-background border rounded p-1 text-sm"
                         value={pageSize}
@@ -480,8 +485,13 @@ export default function PlaygroundHistory() {
                                 <div className="break-all max-w-[100%] message">
                                   <p className="text-sm font-semibold">{message.source}</p>
                                   <MarkdownRenderer markdownText={message.content} />
-                                  {message.content_image && (
-                                    <img src={`${message.content_image}`} alt="content" className="mt-2 max-w-[625px]" />
+                                  {message.content_image && message.content_thumbnail && (
+                                    <a href={mediaSrc(message.content_image)} target="_blank" rel="noreferrer">
+                                      <img src={mediaSrc(message.content_thumbnail)} alt="content" className="mt-2" loading="lazy" />
+                                    </a>
+                                  )}
+                                  {message.content_image && !message.content_thumbnail && (
+                                    <img src={mediaSrc(message.content_image)} alt="content" className="mt-2 max-w-[625px]" />
                                   )}
                                 </div>
                               </div>
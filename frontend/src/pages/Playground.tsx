@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react'
+import { useState, useEffect, useRef } from 'react'
 import { AppSidebar } from "@/components/app-sidebar"
 import { useUserContext } from '@/contexts/UserContext'
 import {
@@ -45,9 +45,13 @@ import React from 'react';
 
 // Define environment variables with default values
 const BASE_URL = import.meta.env.VITE_BASE_URL;
+// Images are served by the backend media store (/media/<sha256>); older messages still carry data URIs
+const mediaSrc = (src: string) => (src.startsWith('/media/') ? `${BASE_URL}${src}` : src);
 const ALLWAYS_LOGGED_IN =
   import.meta.env.VITE_ALLWAYS_LOGGED_IN === "true" ? true : false;
 const ACTIVATION_CODE = import.meta.env.VITE_ACTIVATON_CODE;
+// "ws" streams over /ws/chat-stream (events and stop on one connection), anything else uses EventSource
+const CHAT_TRANSPORT = import.meta.env.VITE_CHAT_TRANSPORT;
 
 console.log('BASE_URL:', BASE_URL);
 console.log('ALLWAYS_LOGGED_IN:', ALLWAYS_LOGGED_IN);
@@ -65,6 +69,7 @@ interface ChatMessage {
   content_image?: string;
   session_id?: string;
   elapsed_time?: number;
+  event_id?: string;
 }
 
 export default function App() {
@@ -99,6 +104,8 @@ export default function App() {
   // const [chatHistory, setChatHistory] = useState<ChatMessage[]>(debugMessages);
 
   const [sessionID, setSessionID] = useState('')
+  // Open /ws/chat-stream connection, so stop can go in-band
+  const socketRef = useRef<WebSocket | null>(null)
   const [userMessage, setUserMessage] = useState('')
   const [sessionTime, setSessionTime] = useState('')
   // const [files, setFiles] = useState<{ name: string, size: number, date: string }[]>([])
@@ -142,8 +149,14 @@ export default function App() {
 
   const stopSession = async () => {
     try {
-      const response = await axios.get(`${BASE_URL}/stop?session_id=${encodeURIComponent(sessionID)}`);
-      console.log('Stop session response:', response.data);
+      const socket = socketRef.current;
+      if (socket && socket.readyState === WebSocket.OPEN) {
+        // Stop in-band: the worker streaming this run cancels it directly
+        socket.send(JSON.stringify({ type: 'stop' }));
+      } else {
+        const response = await axios.get(`${BASE_URL}/stop?session_id=${encodeURIComponent(sessionID)}`);
+        console.log('Stop session response:', response.data);
+      }
       setIsTyping(false);
       setSessionID('');
       setSessionTime('');
@@ -176,21 +189,10 @@ export default function App() {
       });
       const sessionId = response.data.response;  // Get the session ID from the response
       setSessionID(sessionId);
-      const eventSource = new EventSource(`${BASE_URL}/chat-stream?session_id=${encodeURIComponent(sessionId)}&user_id=${encodeURIComponent(userInfo.email)}`);
-      eventSource.onmessage = (event) => {
-        // console.log('EventSource message:', event.data);
-        const data = JSON.parse(event.data);
-        if (data.stop_reason) {
-          setIsTyping(false);
-          // Measure elapsed time and set sessionTime (assumes sessionTime state exists)
-          const elapsedTime = Date.now() - startTime;
-          const minutes = Math.floor(elapsedTime / 60000);
-          const seconds = Math.floor((elapsedTime % 60000) / 1000);
-          setSessionTime(`${minutes}:${seconds < 10 ? '0' : ''}${seconds}`);
-          // eventSource.close();
-        }
-
+      const query = `session_id=${encodeURIComponent(sessionId)}&user_id=${encodeURIComponent(userInfo.email)}`;
 
+      // Returns true when the run has finished
+      const onMessage = (data: any) => {
         const aiMessage: ChatMessage = {
           user: data.source,
           message: data.content,
@@ -202,16 +204,133 @@ export default function App() {
           content_image: data.content_image,
           session_id: data.session_id,
           elapsed_time: data.elapsed_time,
+          event_id: data.event_id,
         };
   
         setChatHistory((prev) => [...prev, aiMessage]);
+
+        if (data.stop_reason) {
+          setIsTyping(false);
+          // Measure elapsed time and set sessionTime (assumes sessionTime state exists)
+          const elapsedTime = Date.now() - startTime;
+          const minutes = Math.floor(elapsedTime / 60000);
+          const seconds = Math.floor((elapsedTime % 60000) / 1000);
+          setSessionTime(`${minutes}:${seconds < 10 ? '0' : ''}${seconds}`);
+          return true;
+        }
+        return false;
       };
-  
-      eventSource.onerror = (error) => {
-        setIsTyping(false);
-        console.error('EventSource error:', error);
-        eventSource.close();
+
+      const eventHandlers: Record<string, (data: any) => void> = {
+        // Waiting for a run slot: one status line, updated in place until the run starts
+        queue: (data) => {
+          const queueMessage: ChatMessage = {
+            user: 'System',
+            message: `Waiting for a free slot… position ${data.position} in the queue.`,
+            session_id: data.session_id,
+            event_id: 'queue',
+          };
+          setChatHistory((prev) => prev.some((m) => m.event_id === 'queue' && m.session_id === data.session_id)
+            ? prev.map((m) => (m.event_id === 'queue' && m.session_id === data.session_id ? queueMessage : m))
+            : [...prev, queueMessage]);
+        },
+        // Pipelined formatting: the formatted content arrives later for an event already shown
+        replace: (data) => {
+          setChatHistory((prev) => prev.map((m) =>
+            m.event_id === data.event_id && m.session_id === data.session_id ? { ...m, message: data.content } : m
+          ));
+        },
+        // Streaming formatting: chunks of the formatted content; offset 0 replaces the raw text
+        delta: (data) => {
+          setChatHistory((prev) => prev.map((m) =>
+            m.event_id === data.event_id && m.session_id === data.session_id
+              ? { ...m, message: data.offset === 0 ? data.content : m.message + data.content }
+              : m
+          ));
+        },
       };
+
+      if (CHAT_TRANSPORT === 'ws') {
+        const wsBase = BASE_URL.replace(/^http/, 'ws');
+        let lastEventId = 0;
+        let finished = false;
+        const connect = () => {
+          const socket = new WebSocket(`${wsBase}/ws/chat-stream?${query}&last_event_id=${lastEventId}`);
+          socketRef.current = socket;
+          socket.onmessage = (event) => {
+            const message = JSON.parse(event.data);
+            if (message.type === 'event') {
+              lastEventId = message.id ?? lastEventId;
+              const handler = eventHandlers[message.event];
+              if (handler) {
+                handler(message.data);
+              } else if (onMessage(message.data)) {
+                finished = true;
+              }
+            } else if (message.type === 'end') {
+              finished = true;
+            } else if (message.type === 'error') {
+              // 409: the run lives on another worker; keep reconnecting until we reach it
+              if (message.status !== 409) {
+                finished = true;
+                setIsTyping(false);
+                console.error('WebSocket stream error:', message.detail);
+              }
+            }
+          };
+          socket.onclose = () => {
+            socketRef.current = null;
+            // Dropped mid-run: reconnect and resume after the last event received
+            if (!finished) {
+              setTimeout(connect, 1000);
+            }
+          };
+        };
+        connect();
+      } else {
+        let lastEventId = '';
+        let finished = false;
+        const open = () => {
+          const resume = lastEventId ? `&last_event_id=${encodeURIComponent(lastEventId)}` : '';
+          const eventSource = new EventSource(`${BASE_URL}/chat-stream?${query}${resume}`);
+          eventSource.onmessage = (event) => {
+            // console.log('EventSource message:', event.data);
+            lastEventId = event.lastEventId || lastEventId;
+            if (onMessage(JSON.parse(event.data))) {
+              // Run finished; don't let EventSource reconnect
+              finished = true;
+              eventSource.close();
+            }
+          };
+          Object.entries(eventHandlers).forEach(([name, handler]) => {
+            eventSource.addEventListener(name, (event) => {
+              lastEventId = (event as MessageEvent).lastEventId || lastEventId;
+              handler(JSON.parse((event as MessageEvent).data));
+            });
+          });
+      
+          eventSource.onerror = async (error) => {
+            // While CONNECTING the browser reconnects with Last-Event-ID and the server resumes the stream
+            if (eventSource.readyState !== EventSource.CLOSED || finished) {
+              return;
+            }
+            // Closed for good (e.g. 409 from a worker that doesn't own the run):
+            // keep going only if the run is still active somewhere
+            try {
+              const status = await axios.get(`${BASE_URL}/session?session_id=${encodeURIComponent(sessionId)}`);
+              if (status.data.active) {
+                setTimeout(open, 1000);
+                return;
+              }
+            } catch (statusError) {
+              console.error('Session status error:', statusError);
+            }
+            setIsTyping(false);
+            console.error('EventSource error:', error);
+          };
+        };
+        open();
+      }
     } catch (error) {
       console.error('Chat error:', error);
     }
@@ -469,7 +588,7 @@ export default function App() {
                               <MarkdownRenderer markdownText={message.message} />
                               {/* Display image if available */}
                               {message.content_image && (
-                                <img src={`${message.content_image}`} alt="content" className="mt-2 max-w-[625px]" />
+                                <img src={mediaSrc(message.content_image)} alt="content" className="mt-2 max-w-[625px]" />
                               )}
                               {/* <MarkdownRenderer>{message.message}</MarkdownRenderer> */}
                               <p className="text-xs text-muted-foreground">{message.time && new Date(message.time).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit', second: '2-digit',hour12: false })}</p>